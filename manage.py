@@ -1,3 +1,6 @@
+import os
+
 from weblog.app import create_app
 
-app = create_app('dev')
\ No newline at end of file
+# 配置名见 weblog/configs.py 中的 configs（dev、prod、test、bench），生产环境设置 WEBLOG_CONFIG=prod
+app = create_app(os.environ.get('WEBLOG_CONFIG', 'dev'))
@@ -0,0 +1,89 @@
+'''
+终端命令行执行
+python3 -m scripts.bench_mail [邮件数] [建连延迟毫秒]
+对比两种发信方式：原先的每封邮件一个线程、一个 SMTP 连接，和 weblog/mailqueue.py 的发送队列，
+邮件发到本地 SMTP 桩服务器（scripts/smtp_stub.py），统计吞吐量、SMTP 连接数和线程数峰值；
+最后让桩服务器随机拒收 30% 的邮件，检查失败的邮件会重试直到全部送达
+'''
+
+import sys
+import threading
+import time
+
+from flask_mail import Message
+
+from weblog.app import create_app, mail
+from weblog.mailqueue import mail_queue
+from scripts.smtp_stub import StubSMTPServer
+
+app = create_app('test')
+app.app_context().push()
+
+
+def use_server(server):
+    '''让 Flask-Mail 连接桩服务器（Flask-Mail 在 init_app 时读取配置，所以要重新初始化）'''
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.port, MAIL_USE_TLS=False,
+                      MAIL_USE_SSL=False, MAIL_SUPPRESS_SEND=False, MAIL_USERNAME=None)
+    mail.init_app(app)
+
+
+def messages(n):
+    for i in range(n):
+        msg = Message('To: bench{}'.format(i), sender=app.config['MAIL_DEFAULT_SENDER'],
+                      recipients=['bench{}@example.com'.format(i)])
+        msg.body = '确认链接 http://localhost/confirm-user/{}'.format(i)
+        msg.html = '<p>{}</p>'.format(msg.body)
+        yield msg
+
+
+def thread_per_email(n):
+    '''原先的做法：每封邮件一个线程，线程里 Mail(app).send(msg) 各自建立连接'''
+    def send(msg):
+        with app.app_context():
+            mail.send(msg)
+
+    threads = []
+    peak = 0
+    for msg in messages(n):
+        thread = threading.Thread(target=send, args=(msg,))
+        thread.start()
+        threads.append(thread)
+        peak = max(peak, threading.active_count())
+    for thread in threads:
+        thread.join()
+    return peak
+
+
+def queued(n):
+    peak = 0
+    for msg in messages(n):
+        mail_queue.enqueue(msg)
+        peak = max(peak, threading.active_count())
+    mail_queue.join(timeout=60)
+    return peak
+
+
+def run(label, func, n, delay, fail_rate=0):
+    server = StubSMTPServer(connect_delay=delay, fail_rate=fail_rate).start()
+    use_server(server)
+    start = time.perf_counter()
+    peak = func(n)
+    elapsed = time.perf_counter() - start
+    print('{:<16} {} 封用时 {:.2f} 秒，{:.0f} 封/秒，SMTP 连接 {} 次，送达 {} 封，线程峰值 {}'.format(
+        label, n, elapsed, n / elapsed, server.connections, server.messages, peak))
+    server.stop()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    delay = int(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+    run('每封一个线程', thread_per_email, n, delay)
+    run('发送队列', queued, n, delay)
+    # 退避时间缩短到 10 毫秒，方便观察重试
+    app.config.update(MAIL_QUEUE_BACKOFF=0.01, MAIL_QUEUE_POLL_INTERVAL=0.05)
+    run('队列 + 30% 拒收', queued, n, delay, fail_rate=0.3)
+    print('重试 {} 次，最终失败 {} 封'.format(mail_queue.retried, mail_queue.failed))
+
+
+if __name__ == '__main__':
+    main()
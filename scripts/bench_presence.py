@@ -0,0 +1,67 @@
+'''
+终端命令行执行
+python3 -m scripts.bench_presence [请求数] [用户数]
+对比 last_seen 同步写入（User.ping）和批量延迟写入（presence）时，
+每个请求平均产生多少次数据库提交，使用 TestConfig 的内存 SQLite 数据库
+'''
+
+import sys
+import time
+
+from sqlalchemy import event
+
+from weblog.app import create_app
+from weblog.models import db, Role, User
+from weblog.presence import presence
+
+app = create_app('test')
+app.app_context().push()
+
+
+def seed(n_users):
+    '''创建 n_users 个已验证的用户'''
+    db.create_all()
+    Role.insert_roles()
+    for i in range(n_users):
+        db.session.add(User(name='bench{}'.format(i), email='bench{}@example.com'.format(i),
+                            password='bench', confirmed=True))
+    db.session.commit()
+
+
+def run(n_requests, n_users, write_behind):
+    '''n_users 个用户登录后轮流请求首页，返回 (提交次数, 耗时)'''
+    app.config['PRESENCE_WRITE_BEHIND'] = write_behind
+    commits = [0]
+
+    def count(conn):
+        commits[0] += 1
+
+    event.listen(db.engine, 'commit', count)
+    start = time.perf_counter()
+    clients = []
+    for i in range(n_users):
+        client = app.test_client()
+        client.post('/login', data={'email': 'bench{}@example.com'.format(i), 'password': 'bench'})
+        clients.append(client)
+    for i in range(n_requests):
+        clients[i % n_users].get('/')
+    # 延迟写入模式下，把缓冲区剩余的记录也算进来
+    presence.flush()
+    elapsed = time.perf_counter() - start
+    event.remove(db.engine, 'commit', count)
+    return commits[0], elapsed
+
+
+def main():
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_users = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    seed(n_users)
+    print('{} 个请求，{} 个用户'.format(n_requests, n_users))
+    for label, write_behind in (('同步写入 (User.ping)', False), ('批量延迟写入 (presence)', True)):
+        commits, elapsed = run(n_requests, n_users, write_behind)
+        print('{:<24} 提交 {:>6} 次，每请求 {:.3f} 次，{:.1f} req/s'.format(
+            label, commits, commits / n_requests, n_requests / elapsed))
+
+
+if __name__ == '__main__':
+    main()
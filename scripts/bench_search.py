@@ -0,0 +1,87 @@
+'''
+终端命令行执行
+python3 -m scripts.bench_search [博客数] [查询数]
+用 Faker 生成中文博客和评论，重建全文搜索索引，统计查询延迟（p50/p95/p99）和增量更新的耗时，
+使用 TestConfig 的内存 SQLite 数据库和临时索引目录
+'''
+
+import random
+import sys
+import time
+
+from faker import Faker
+
+from weblog.app import create_app
+from weblog.models import db, Role, User, Blog, Comment
+from weblog.search import search_index
+
+app = create_app('test')
+app.app_context().push()
+fake = Faker('zh-cn')
+
+
+def seed(n_blogs):
+    '''用 Core 批量插入博客和评论，每篇博客两条评论'''
+    db.create_all()
+    Role.insert_roles()
+    db.session.execute(db.insert(User), [
+        {'id': i, 'name': 'bench{}'.format(i), 'email': 'bench{}@example.com'.format(i),
+         'password_hash': '-'} for i in range(1, 51)])
+    blogs = []
+    comments = []
+    for i in range(1, n_blogs + 1):
+        body = fake.text(max_nb_chars=600)
+        blogs.append({'id': i, 'title': fake.sentence(nb_words=4), 'body': body,
+                      'body_html': '<p>{}</p>'.format(body), 'author_id': random.randint(1, 50)})
+        for _ in range(2):
+            comments.append({'blog_id': i, 'body': fake.sentence(nb_words=8), 'author_id': random.randint(1, 50)})
+    db.session.execute(db.insert(Blog), blogs)
+    db.session.execute(db.insert(Comment), comments)
+    db.session.commit()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+    return 'p50 {:.2f} 毫秒，p95 {:.2f} 毫秒，p99 {:.2f} 毫秒'.format(pick(0.5), pick(0.95), pick(0.99))
+
+
+def measure(label, func, queries):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        func(query)
+        samples.append(time.perf_counter() - start)
+    print('{:<20} {}'.format(label, percentiles(samples)))
+
+
+def main():
+    n_blogs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    seed(n_blogs)
+
+    start = time.perf_counter()
+    total = search_index.rebuild()
+    print('重建索引：{} 篇文档，用时 {:.2f} 秒'.format(total, time.perf_counter() - start))
+
+    rng = random.Random(0)
+    queries = [' '.join(fake.word() for _ in range(rng.randint(1, 3))) for _ in range(n_queries)]
+    search_index.search(queries[0])  # 加载 segment
+    measure('只查索引', search_index.search, queries)
+    measure('查索引 + 摘要', search_index.results, queries)
+
+    # 增量更新：每次提交修改一篇博客，随后的查询要先读取日志
+    samples = []
+    for i in range(200):
+        blog = db.session.get(Blog, rng.randint(1, n_blogs))
+        blog.body = fake.text(max_nb_chars=600)
+        start = time.perf_counter()
+        db.session.commit()
+        search_index.refresh()
+        samples.append(time.perf_counter() - start)
+    print('{:<20} {}'.format('提交 + 增量更新', percentiles(samples)))
+    measure('增量更新后只查索引', search_index.search, queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+'''
+终端命令行执行
+python3 -m scripts.bench_seed [--scale tiny|small|large] [--users N] [--blogs N] [--follows N] [--tags N] [--comments N]
+为负载测试（scripts/bench_web.py）生成数据，写入 BenchConfig 的数据库：
+缺省为 instance/bench.db，用环境变量 BENCH_DATABASE_URL 指定其他数据库，例如
+BENCH_DATABASE_URL=mysql://root@localhost/weblog_bench?charset=utf8mb4 python3 -m scripts.bench_seed --scale large
+会先删除库中所有表再重建。
+
+数据规模：
+    tiny   1 千用户、1 万篇博客、2 万条关注、200 个标签、2 万条评论，几秒钟，用于检查脚本本身
+    small  1 万用户、10 万篇博客、50 万条关注、1 千个标签、20 万条评论（默认）
+    large  10 万用户、100 万篇博客、1000 万条关注、5 千个标签、200 万条评论
+用户 id 越小越「热门」：粉丝、博客、评论都向 id 小的用户和博客倾斜，标签的使用次数也一样，
+同一个 --seed 生成的数据完全相同，不同提交之间的结果可以对比。
+所有用户的密码都是 bench，邮箱为 bench{id}@example.com。
+计数列（粉丝数、博客数、标签的博客数）在生成时直接算好，正文用同一组预先渲染好的 Markdown，
+不需要再执行 repair-counters、render-blogs；首页时间线只在 --timelines 时重建（数据量是关注数 × 每人博客数）。
+'''
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+from werkzeug.security import generate_password_hash
+
+from weblog.app import create_app
+from weblog.models import db, Role, User, Blog, Tag, Follow, Comment, Timeline, blog_tags
+from weblog.rendering import renderer
+
+app = create_app('bench')
+app.app_context().push()
+
+SCALES = {
+    'tiny': dict(users=1000, blogs=10000, follows=20000, tags=200, comments=20000),
+    'small': dict(users=10000, blogs=100000, follows=500000, tags=1000, comments=200000),
+    'large': dict(users=100000, blogs=1000000, follows=10000000, tags=5000, comments=2000000),
+}
+
+BODIES = [
+    '# 第 {0} 篇笔记\n\n这是一段 **Markdown** 正文，包含 `代码`、[链接](https://example.com/{0}) 和列表：\n\n'
+    '- 第一项\n- 第二项\n- 第三项\n\n'.format(i) + '中文段落，用来撑起卡片的长度。' * (i % 5 + 1)
+    for i in range(20)
+]
+
+
+def skewed(rng, n, skew=2.0):
+    '''1..n 之间的整数，skew 越大越偏向小的 id'''
+    return 1 + int(n * rng.random() ** skew)
+
+
+def execute_chunks(conn, stmt, rows, chunk_size):
+    '''按 chunk_size 条一批执行 stmt（executemany），rows 可以是生成器，每批提交一次，返回行数'''
+    total, chunk = 0, []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            conn.execute(stmt, chunk)
+            conn.commit()
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        conn.execute(stmt, chunk)
+        conn.commit()
+        total += len(chunk)
+    return total
+
+
+def step(label, func, *args):
+    start = time.perf_counter()
+    count = func(*args)
+    elapsed = time.perf_counter() - start
+    print('  {:<8} {:>10} 行  {:>7.1f} 秒  {:>9.0f} 行/秒'.format(label, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def seed(sizes, seed_value, chunk_size, timelines):
+    n_users, n_blogs, n_tags = sizes['users'], sizes['blogs'], sizes['tags']
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    followers = [0] * (n_users + 1)
+    followed = [0] * (n_users + 1)
+    blogs = [0] * (n_users + 1)
+    tag_blogs = [0] * (n_tags + 1)
+
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    role_id = Role.query.filter_by(default=True).first().id
+    password = generate_password_hash('bench')
+    bodies = [(body, renderer.render(body)) for body in BODIES]
+
+    conn = db.engine.connect()
+    if conn.dialect.name == 'sqlite':
+        # 只是生成测试数据，不需要每批都等待写盘
+        conn.exec_driver_sql('PRAGMA synchronous = OFF')
+        conn.exec_driver_sql('PRAGMA journal_mode = MEMORY')
+
+    def users():
+        for i in range(1, n_users + 1):
+            email = 'bench{}@example.com'.format(i)
+            yield {'id': i, 'name': 'bench{}'.format(i), 'email': email, 'password': password,
+                   'role_id': role_id, 'confirmed': True, 'location': '城市{}'.format(i % 300),
+                   'about_me': '第 {} 号测试用户'.format(i),
+                   'created_at': now - timedelta(days=365), 'last_seen': now}
+
+    def tags():
+        for i in range(1, n_tags + 1):
+            yield {'id': i, 'name': 'tag{}'.format(i)}
+
+    def follows():
+        # 每人关注的人数在平均数上下浮动，被关注的人偏向 id 小的用户
+        average = sizes['follows'] / n_users
+        for follower in range(1, n_users + 1):
+            wanted = min(n_users - 1, int(rng.uniform(0, 2 * average) + 0.5))
+            targets = set()
+            while len(targets) < wanted:
+                target = skewed(rng, n_users, 2.5)
+                if target != follower:
+                    targets.add(target)
+            followed[follower] = len(targets)
+            for target in targets:
+                followers[target] += 1
+                yield {'follower_id': follower, 'followed_id': target,
+                       'time_stamp': now - timedelta(minutes=rng.randrange(525600))}
+
+    def blog_rows():
+        for i in range(1, n_blogs + 1):
+            author = skewed(rng, n_users, 1.5)
+            blogs[author] += 1
+            body, html = bodies[i % len(bodies)]
+            yield {'id': i, 'title': '博客 {}'.format(i), 'body': body, 'body_html': html,
+                   'body_html_version': renderer.version, 'version': 1, 'author_id': author,
+                   # id 越大越新，与真实数据一样按时间顺序插入
+                   'time_stamp': now - timedelta(seconds=(n_blogs - i) * 31536000 // n_blogs)}
+
+    def blog_tag_rows():
+        tag_rng = random.Random(seed_value + 1)
+        for i in range(1, n_blogs + 1):
+            for tag in {skewed(tag_rng, n_tags, 3.0) for _ in range(tag_rng.randrange(4))}:
+                tag_blogs[tag] += 1
+                yield {'blog_id': i, 'tag_id': tag}
+
+    def comments():
+        comment_rng = random.Random(seed_value + 2)
+        for i in range(1, sizes['comments'] + 1):
+            author = skewed(comment_rng, n_users, 1.5) if comment_rng.random() < 0.9 else None
+            yield {'id': i, 'body': '第 {} 条评论'.format(i), 'blog_id': skewed(comment_rng, n_blogs, 2.0),
+                   'author_id': author, 'author_name': None if author else '游客{}'.format(i % 100),
+                   'disable': False, 'time_stamp': now - timedelta(minutes=comment_rng.randrange(525600))}
+
+    print('写入 {}'.format(db.engine.url.render_as_string(hide_password=True)))
+    step('user', execute_chunks, conn, User.__table__.insert(), users(), chunk_size)
+    step('tag', execute_chunks, conn, Tag.__table__.insert(), tags(), chunk_size)
+    step('follows', execute_chunks, conn, Follow.__table__.insert(), follows(), chunk_size)
+    step('blog', execute_chunks, conn, Blog.__table__.insert(), blog_rows(), chunk_size)
+    step('tags', execute_chunks, conn, blog_tags.insert(), blog_tag_rows(), chunk_size)
+    step('comment', execute_chunks, conn, Comment.__table__.insert(), comments(), chunk_size)
+
+    def counters():
+        table = User.__table__
+        rows = ({'uid': i, 'f1': followers[i], 'f2': followed[i], 'b': blogs[i]} for i in range(1, n_users + 1))
+        stmt = table.update().where(table.c.id == bindparam('uid')).values(
+            followers_count=bindparam('f1'), followed_count=bindparam('f2'), blogs_count=bindparam('b'))
+        done = execute_chunks(conn, stmt, rows, chunk_size)
+        table = Tag.__table__
+        rows = ({'tid': i, 'n': tag_blogs[i], 'since': None if tag_blogs[i] else now} for i in range(1, n_tags + 1))
+        stmt = table.update().where(table.c.id == bindparam('tid')).values(
+            blog_count=bindparam('n'), unused_since=bindparam('since'))
+        return done + execute_chunks(conn, stmt, rows, chunk_size)
+
+    def timeline():
+        Timeline.rebuild()
+        return db.session.scalar(db.select(db.func.count()).select_from(Timeline))
+
+    step('counts', counters)
+    conn.close()
+    if timelines:
+        step('timeline', timeline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='为负载测试生成数据')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    for name in ('users', 'blogs', 'follows', 'tags', 'comments'):
+        parser.add_argument('--' + name, type=int, help='覆盖 --scale 中的数量')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子，相同的种子生成相同的数据')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='每批插入的行数')
+    parser.add_argument('--timelines', action='store_true', help='同时重建首页时间线')
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    sizes.update({name: getattr(args, name) for name in sizes if getattr(args, name) is not None})
+    print('{users} 个用户、{blogs} 篇博客、{follows} 条关注、{tags} 个标签、{comments} 条评论'.format(**sizes))
+    start = time.perf_counter()
+    seed(sizes, args.seed, args.chunk_size, args.timelines)
+    print('完成，用时 {:.1f} 秒'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
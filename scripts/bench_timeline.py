@@ -0,0 +1,114 @@
+'''
+终端命令行执行
+python3 -m scripts.bench_timeline [用户数] [每人博客数]
+对比「我关注的人的博客」两种读法每次的耗时：
+原来 User.followed_posts 使用的 JOIN 查询，和现在它读取的写扩散时间线 weblog.timeline.home_timeline，
+分别在每人关注很少和关注较多两种情况下测量，使用 TestConfig 的内存 SQLite 数据库。
+JOIN 要按时间倒序扫描博客，直到凑够一页关注的人的博客，关注的人越少、越不活跃，扫描的行越多；
+时间线只按 (user_id, time_stamp) 索引读一页，与关注多少人无关
+'''
+
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from weblog.app import create_app
+from weblog.models import db, Role, User, Blog, Follow, Timeline
+from weblog.queries import feed_query
+from weblog.timeline import home_timeline
+
+app = create_app('test')
+app.app_context().push()
+
+
+def seed(n_users, n_follows, n_blogs):
+    '''用 Core 批量插入用户、关注关系和博客，再重建计数和时间线'''
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    db.session.execute(db.insert(User), [
+        {'id': i, 'name': 'bench{}'.format(i), 'email': 'bench{}@example.com'.format(i),
+         'password_hash': '-', 'confirmed': True} for i in range(1, n_users + 1)])
+    rng = random.Random(0)
+    follows = []
+    for i in range(1, n_users + 1):
+        for j in rng.sample(range(1, n_users + 1), n_follows):
+            if j != i:
+                follows.append({'follower_id': i, 'followed_id': j, 'time_stamp': datetime.utcnow()})
+    db.session.execute(db.insert(Follow), follows)
+    start = datetime.utcnow()
+    db.session.execute(db.insert(Blog), [
+        {'title': 'blog', 'body': 'body', 'body_html': '<p>body</p>', 'author_id': i,
+         'time_stamp': start - timedelta(minutes=rng.randrange(10 ** 6))}
+        for i in range(1, n_users + 1) for _ in range(n_blogs)])
+    db.session.commit()
+    app.test_cli_runner().invoke(args=['repair-counters'])
+    Timeline.rebuild()
+
+
+def measure(label, fetch, user_ids, limit):
+    '''每个用户取一次首页时间线，打印平均耗时'''
+    start = time.perf_counter()
+    for user_id in user_ids:
+        fetch(db.session.get(User, user_id), limit)
+        db.session.expunge_all()
+    elapsed = time.perf_counter() - start
+    print('  {:<24} {:>8.2f} 毫秒/次'.format(label, elapsed / len(user_ids) * 1000))
+
+
+def joined_posts(user):
+    '''原来的 User.followed_posts：把 Follow 和 Blog 两张表 JOIN 起来'''
+    return Blog.query.join(Follow, Follow.followed_id == Blog.author_id).filter(Follow.follower_id == user.id)
+
+
+def joined_ids(user, limit):
+    '''只取博客 id 的 JOIN 查询'''
+    return db.session.execute(
+        db.select(Blog.id).join(Follow, Follow.followed_id == Blog.author_id)
+        .where(Follow.follower_id == user.id)
+        .order_by(Blog.time_stamp.desc(), Blog.id.desc()).limit(limit)).all()
+
+
+def timeline_ids(user, limit):
+    '''只取博客 id 的时间线查询'''
+    return db.session.execute(
+        db.select(Timeline.blog_id).where(Timeline.user_id == user.id)
+        .order_by(Timeline.time_stamp.desc()).limit(limit)).all()
+
+
+def run(n_users, n_follows, n_blogs, limit):
+    seed(n_users, n_follows, n_blogs)
+    app.config['TIMELINE_FANOUT_LIMIT'] = 1000
+    app.config['TIMELINE_HOT_AUTHORS_TTL'] = 300
+    print('每人关注 {} 人：'.format(n_follows))
+
+    user_ids = random.Random(1).sample(range(1, n_users + 1), min(200, n_users))
+    # 两种读法的结果应当一致
+    for user_id in user_ids[:20]:
+        user = db.session.get(User, user_id)
+        joined = [blog.id for blog in feed_query(joined_posts(user)).order_by(Blog.id.desc()).limit(limit)]
+        assert joined == [blog.id for blog in user.followed_posts(limit)], user_id
+
+    measure('只取 id：JOIN', joined_ids, user_ids, limit)
+    measure('只取 id：时间线', timeline_ids, user_ids, limit)
+    measure('整页：JOIN', lambda user, n: feed_query(joined_posts(user))
+            .order_by(Blog.id.desc()).limit(n).all(), user_ids, limit)
+    measure('整页：时间线', home_timeline, user_ids, limit)
+    # 把阈值调低，让所有作者都走读取时合并，看混合模式的开销
+    app.config['TIMELINE_FANOUT_LIMIT'] = 0
+    app.config['TIMELINE_HOT_AUTHORS_TTL'] = 0
+    measure('整页：全部读取时合并', home_timeline, user_ids, limit)
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_blogs = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    limit = app.config['BLOGS_PER_PAGE']
+    print('{} 个用户，每人发表 {} 篇博客，每次取 {} 篇'.format(n_users, n_blogs, limit))
+    for n_follows in (3, 50):
+        run(n_users, n_follows, n_blogs, limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+'''
+终端命令行执行
+python3 -m scripts.bench_web [--requests N] [--only 场景,...] [--anonymous] [--http [--processes P] [--url URL]]
+                             [--output 结果.json] [--compare 旧结果.json]
+对主要页面做负载测试，数据先由 scripts.bench_seed 生成，同样用环境变量 BENCH_DATABASE_URL 指定数据库。
+
+- 默认用 Flask 测试客户端在本进程内逐个请求，测的是应用本身（路由、SQL、模板）的耗时；
+- --http 时启动 P 个进程，每个进程一个 keep-alive 连接，同时发出 HTTP 请求：
+  --url 指定已经运行的服务器，服务器要使用 BenchConfig，例如
+  gunicorn -w 4 -b 127.0.0.1:8000 'weblog.app:create_app("bench")'，
+  缺省在子进程中启动一个多线程的 werkzeug 服务器。
+每个进程登录一个测试用户（--anonymous 时不登录，只测 GET 场景，此时会命中匿名访客的整页缓存），
+每个场景先预热 --warmup 次，再统计 p50/p95/p99 延迟、吞吐量、错误数，
+以及响应头 Server-Timing 中的 SQL 条数和 SQL 耗时（见 weblog/metrics.py）。
+结果连同当前提交、数据规模写入 JSON 文件（缺省 instance/bench-results/<提交>-<client|http>.json），
+--compare 旧结果.json 时逐项打印与旧结果相比的变化。
+请求的页面由固定的随机数种子选出，同一份数据、同样的参数，每次请求的页面都相同；
+写场景（post_comment、post_blog）会新增数据，要对比的几次测试之前都用同样的参数重新执行 bench_seed。
+'''
+
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from weblog.app import create_app
+from weblog.models import db, User, Blog, Tag, Comment
+
+app = create_app('bench')
+
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def skewed(rng, n, skew=2.0):
+    '''与 bench_seed 相同：1..n 之间的整数，偏向小的 id（热门的用户和博客）'''
+    return 1 + int(n * rng.random() ** skew)
+
+
+# 场景名 -> 生成请求的函数 (随机数, 数据规模) -> (方法, 路径, 表单)
+# 写操作放在最后，不影响前面的读场景
+SCENARIOS = {
+    'index': lambda rng, data: ('GET', '/', None),
+    'blogs': lambda rng, data: ('GET', '/blogs?page={}'.format(rng.randint(1, data['pages'])), None),
+    'blog': lambda rng, data: ('GET', '/blog/{}'.format(skewed(rng, data['blogs'])), None),
+    'tag': lambda rng, data: ('GET', '/tag/{}'.format(rng.choice(data['tags'])), None),
+    'user_index': lambda rng, data: ('GET', '/user/bench{}/index'.format(skewed(rng, data['users'])), None),
+    'user_followers': lambda rng, data: (
+        'GET', '/user/bench{}/followers'.format(skewed(rng, data['users'], 3.0)), None),
+    'post_comment': lambda rng, data: (
+        'POST', '/blog/{}'.format(skewed(rng, data['blogs'])), {'body': '压测评论 {}'.format(rng.random())}),
+    'post_blog': lambda rng, data: (
+        'POST', '/', {'title': '压测博客', 'tags_string': 'bench, {}'.format(rng.choice(data['tags'])),
+                      'body': '# 压测\n\n正文 {}'.format(rng.random())}),
+}
+WRITES = ('post_comment', 'post_blog')
+
+
+def dataset():
+    '''数据库中的数据规模，以及生成请求用到的标签名、页数'''
+    with app.app_context():
+        users = db.session.scalar(db.select(db.func.max(User.id))) or 0
+        blogs = db.session.scalar(db.select(db.func.max(Blog.id))) or 0
+        data = {
+            'users': users,
+            'blogs': blogs,
+            'follows': db.session.scalar(db.select(db.func.sum(User.followers_count))) or 0,
+            'tags': db.session.scalar(db.select(db.func.count()).select_from(Tag)) or 0,
+            'comments': db.session.scalar(db.select(db.func.max(Comment.id))) or 0,
+        }
+        if not users or not blogs:
+            sys.exit('数据库中没有数据，先执行 python3 -m scripts.bench_seed')
+        # 请求使用次数最多的 50 个标签，列表页只翻前 100 页
+        names = db.session.scalars(db.select(Tag.name).order_by(Tag.blog_count.desc()).limit(50)).all()
+        db.engine.dispose()
+    return data, {'users': users, 'blogs': blogs, 'tags': names or ['bench'],
+                  'pages': max(1, min(100, math.ceil(blogs / app.config['BLOGS_PER_PAGE'])))}
+
+
+class Samples:
+    '''一个场景的延迟（毫秒）、错误数，以及 Server-Timing 中的 SQL 条数和耗时'''
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.queries = []
+        self.db_ms = []
+
+    def add(self, elapsed, status, server_timing):
+        self.latencies.append(elapsed * 1000)
+        if status not in (200, 302):
+            self.errors += 1
+        match = SERVER_TIMING.search(server_timing or '')
+        if match:
+            self.db_ms.append(float(match.group(1)))
+            self.queries.append(int(match.group(2)))
+
+    def merge(self, other):
+        self.latencies += other.latencies
+        self.errors += other.errors
+        self.queries += other.queries
+        self.db_ms += other.db_ms
+
+    def summary(self, wall):
+        values = sorted(self.latencies)
+
+        def percentile(p):
+            return round(values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))], 3)
+
+        def mean(items):
+            return round(sum(items) / len(items), 3) if items else None
+
+        return {'requests': len(values), 'errors': self.errors,
+                'rps': round(len(values) / wall, 1) if wall else None,
+                'mean_ms': mean(values), 'p50_ms': percentile(50), 'p95_ms': percentile(95),
+                'p99_ms': percentile(99), 'max_ms': round(values[-1], 3),
+                'queries_mean': mean(self.queries), 'db_ms_mean': mean(self.db_ms)}
+
+
+# 测试客户端
+
+def run_client(names, data, requests, warmup, seed, anonymous):
+    client = app.test_client()
+    if not anonymous:
+        login_client(client, random.Random(seed).randint(1, data['users']))
+    results = {}
+    for name in names:
+        rng = random.Random('{}-{}'.format(seed, name))
+        for _ in range(warmup):
+            method, path, form = SCENARIOS[name](rng, data)
+            client.open(path, method=method, data=form)
+        samples = Samples()
+        start = time.perf_counter()
+        for _ in range(requests):
+            method, path, form = SCENARIOS[name](rng, data)
+            began = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            samples.add(time.perf_counter() - began, response.status_code, response.headers.get('Server-Timing'))
+        results[name] = samples.summary(time.perf_counter() - start)
+        report(name, results[name])
+    return results
+
+
+def login_client(client, user_id):
+    response = client.post('/login', data={'email': 'bench{}@example.com'.format(user_id), 'password': 'bench'})
+    if response.status_code != 302:
+        sys.exit('测试用户 bench{} 登录失败'.format(user_id))
+
+
+# HTTP
+
+class QuietRequestHandler(WSGIRequestHandler):
+    '''不打印每个请求的日志，使用 HTTP/1.1 以支持 keep-alive'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(port):
+    '''在子进程中运行多线程的 werkzeug 服务器'''
+    with app.app_context():
+        # 不使用从父进程继承来的连接
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    make_server('127.0.0.1', port, app, threaded=True, request_handler=QuietRequestHandler).serve_forever()
+
+
+def start_server():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = multiprocessing.get_context('fork').Process(target=serve, args=(port,), daemon=True)
+    process.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, 'http://127.0.0.1:{}'.format(port)
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    sys.exit('服务器没有启动')
+
+
+class HTTPClient:
+    '''一个 keep-alive 连接，自己保存 Cookie'''
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.cookies = {}
+        self.connection = None
+
+    def request(self, method, path, form=None):
+        '''返回 (状态码, Server-Timing)，连接出错时状态码为 0'''
+        headers = {}
+        body = None
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{}={}'.format(*item) for item in self.cookies.items())
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return 0, None
+        for cookie in response.msg.get_all('Set-Cookie') or ():
+            name, _, value = cookie.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        return response.status, response.getheader('Server-Timing')
+
+
+# 每个压测进程的客户端，由 init_worker 创建
+worker_client = None
+
+
+def init_worker(url, data, anonymous, seed, counter):
+    global worker_client
+    worker_client = HTTPClient(url)
+    with counter.get_lock():
+        counter.value += 1
+        index = counter.value
+    if not anonymous:
+        # 每个进程登录不同的用户
+        user_id = random.Random('{}-{}'.format(seed, index)).randint(1, data['users'])
+        status, _ = worker_client.request('POST', '/login', {'email': 'bench{}@example.com'.format(user_id),
+                                                             'password': 'bench'})
+        if status != 302:
+            raise RuntimeError('测试用户 bench{} 登录失败'.format(user_id))
+
+
+def run_batch(args):
+    name, data, requests, warmup, seed = args
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        worker_client.request(*SCENARIOS[name](rng, data))
+    samples = Samples()
+    for _ in range(requests):
+        method, path, form = SCENARIOS[name](rng, data)
+        began = time.perf_counter()
+        status, server_timing = worker_client.request(method, path, form)
+        samples.add(time.perf_counter() - began, status, server_timing)
+    return samples
+
+
+def run_http(names, data, requests, warmup, seed, anonymous, processes, url):
+    server = None
+    if url is None:
+        server, url = start_server()
+    print('压测 {}，{} 个进程'.format(url, processes))
+    results = {}
+    context = multiprocessing.get_context('fork')
+    try:
+        counter = context.Value('i', 0)
+        with context.Pool(processes, initializer=init_worker,
+                          initargs=(url, data, anonymous, seed, counter)) as pool:
+            for name in names:
+                # 每个进程分到的请求数相同，吞吐量按所有进程的总请求数除以墙上时间计算
+                per_process = max(1, requests // processes)
+                batches = [(name, data, per_process, warmup, '{}-{}-{}'.format(seed, name, i))
+                           for i in range(processes)]
+                start = time.perf_counter()
+                samples = Samples()
+                for batch in pool.map(run_batch, batches, chunksize=1):
+                    samples.merge(batch)
+                results[name] = samples.summary(time.perf_counter() - start)
+                report(name, results[name])
+    finally:
+        if server is not None:
+            server.terminate()
+    return results
+
+
+# 结果
+
+def report(name, result):
+    print('  {:<15} {:>6} 次  {:>8} 次/秒  p50 {:>8.2f}  p95 {:>8.2f}  p99 {:>8.2f} 毫秒  SQL {:>5} 条 {:>7} 毫秒  错误 {}'.format(
+        name, result['requests'], result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+        result['queries_mean'] if result['queries_mean'] is not None else '-',
+        result['db_ms_mean'] if result['db_ms_mean'] is not None else '-', result['errors']))
+
+
+def git(*args):
+    try:
+        return subprocess.run(('git',) + args, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    '''逐个场景打印 p50/p95/p99 和吞吐量的变化，延迟变大、吞吐量变小为负面变化'''
+    print('与 {}（{}）相比：'.format(old['meta'].get('commit'), old['meta'].get('time')))
+    for key in ('mode', 'processes', 'dataset'):
+        if old['meta'].get(key) != new['meta'].get(key):
+            print('  注意：两次的 {} 不同（{} / {}），结果不能直接比较'.format(
+                key, old['meta'].get(key), new['meta'].get(key)))
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'rps'):
+            if before.get(key) and result.get(key) is not None:
+                changes.append('{} {:+.1f}%'.format(key, (result[key] - before[key]) / before[key] * 100))
+        print('  {:<15} {}'.format(name, '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='主要页面的负载测试')
+    parser.add_argument('--requests', type=int, default=200, help='每个场景的请求数（--http 时为所有进程的总数）')
+    parser.add_argument('--warmup', type=int, default=10, help='每个场景（每个进程）预热的请求数，不计入结果')
+    parser.add_argument('--only', help='只测这些场景，用逗号分隔：' + ','.join(SCENARIOS))
+    parser.add_argument('--anonymous', action='store_true', help='不登录，只测 GET 场景')
+    parser.add_argument('--http', action='store_true', help='通过 HTTP 多进程压测')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='--http 时的压测进程数')
+    parser.add_argument('--url', help='--http 时已经运行的服务器地址，缺省自己启动一个')
+    parser.add_argument('--seed', type=int, default=0, help='选择请求页面的随机数种子')
+    parser.add_argument('--output', help='结果文件，缺省为 instance/bench-results/<提交>-<client|http>.json')
+    parser.add_argument('--compare', help='与这个结果文件比较')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error('没有这些场景：{}'.format(', '.join(unknown)))
+    if args.anonymous:
+        names = [name for name in names if name not in WRITES]
+
+    sizes, data = dataset()
+    print('{users} 个用户、{blogs} 篇博客、{follows} 条关注、{tags} 个标签、{comments} 条评论'.format(**sizes))
+    mode = 'http' if args.http else 'client'
+    if args.http:
+        results = run_http(names, data, args.requests, args.warmup, args.seed, args.anonymous,
+                           args.processes, args.url)
+    else:
+        results = run_client(names, data, args.requests, args.warmup, args.seed, args.anonymous)
+
+    commit = git('rev-parse', '--short', 'HEAD')
+    output = {
+        'meta': {
+            'commit': commit,
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'mode': mode,
+            'processes': args.processes if args.http else 1,
+            'anonymous': args.anonymous,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split('@')[-1],
+            'dataset': sizes,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    path = args.output or os.path.join(app.instance_path, 'bench-results', '{}-{}.json'.format(commit or 'unknown', mode))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print('结果已写入 {}'.format(path))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
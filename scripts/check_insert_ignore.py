@@ -0,0 +1,74 @@
+'''
+终端命令行执行
+python3 -m scripts.check_insert_ignore
+检查 insert_ignore（weblog/models.py）的两条路径：支持 RETURNING 的数据库（SQLite、PostgreSQL），
+以及不支持 RETURNING 的数据库（MySQL），后者在 TestConfig 的内存 SQLite 上把
+dialect.insert_returning 改为 False 来模拟。每条路径都检查：
+- 新建博客时同时出现新标签和已有的标签，Tag.resolve 不出错，已有的标签不重复创建；
+- 批量关注时同时包含已关注和未关注的用户，follow_many 只返回新关注的用户，计数正确。
+有检查不通过时以非 0 状态码退出
+'''
+
+import sys
+from datetime import datetime
+
+from weblog.app import create_app
+from weblog.models import db, Role, User, Blog, Tag, Follow
+
+app = create_app('test')
+app.app_context().push()
+
+
+def check(returning):
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    tag_ids = app.extensions['tag_ids']
+    tag_ids.clear()
+    db.engine.dialect.insert_returning = returning
+    users = [User(name='insert{}'.format(i), email='insert{}@example.com'.format(i), password='insert')
+             for i in range(4)]
+    db.session.add_all(users)
+    db.session.commit()
+
+    errors = []
+    for i, tags in enumerate(('python, flask', 'flask, sqlalchemy', 'python, sqlalchemy, mysql')):
+        # 不经过缓存，已有的标签要靠 insert_ignore 跳过
+        tag_ids.clear()
+        blog = Blog(title='blog {}'.format(i), author=users[0])
+        blog.body = '正文'
+        blog.tags_string = tags
+        db.session.add(blog)
+        db.session.commit()
+    names = sorted(db.session.scalars(db.select(Tag.name)))
+    if names != ['flask', 'mysql', 'python', 'sqlalchemy']:
+        errors.append('标签：{}'.format(names))
+
+    user, others = users[0], users[1:]
+    if user.follow_many(others[:1]) != {others[0].id}:
+        errors.append('第一次关注')
+    # 已有的关注关系是之前建立的，时间与这次不同（同一秒内写入的完全相同的行无法区分，见 insert_ignore）
+    db.session.execute(db.update(Follow).values(time_stamp=datetime(2000, 1, 1)))
+    db.session.commit()
+    changed = user.follow_many(others)
+    if changed != {other.id for other in others[1:]}:
+        errors.append('批量关注返回了 {}'.format(sorted(changed)))
+    if user.follow_many(others):
+        errors.append('重复关注返回了新关注的用户')
+    db.session.expire_all()
+    if user.followed_count != 3 or [other.followers_count for other in others] != [1, 1, 1]:
+        errors.append('关注计数：{} {}'.format(user.followed_count, [other.followers_count for other in others]))
+    return errors
+
+
+def main():
+    failed = False
+    for returning in (True, False):
+        errors = check(returning)
+        failed = failed or bool(errors)
+        print('{:<14} {}'.format('RETURNING' if returning else '无 RETURNING', '；'.join(errors) or 'OK'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
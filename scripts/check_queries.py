@@ -0,0 +1,85 @@
+'''
+终端命令行执行
+python3 -m scripts.check_queries
+检查列表页的 SQL 查询次数不随每页条数增长（没有 N+1 查询），
+再登录后访问 TestConfig.QUERY_BUDGETS 中的页面，超出预算时抛出 QueryBudgetExceeded（见 weblog/querywatch.py），
+使用 TestConfig 的内存 SQLite 数据库，有页面不满足时以非 0 状态码退出。
+准备数据时才进入应用上下文，请求在上下文之外发出：测试客户端为每个请求推入新的上下文，
+与真实请求一样，当前用户、session 中已加载的对象不会从上一个请求带过来
+'''
+
+import sys
+
+from sqlalchemy import event
+
+from weblog.app import create_app
+from weblog.models import db, Role, User, Blog, Comment
+
+app = create_app('test')
+# 片段缓存命中时不会访问关系属性，关掉它才能看出模板本身的查询次数
+app.config['FRAGMENT_CACHE_ENABLED'] = False
+
+
+def seed(start, stop):
+    '''创建编号为 start 到 stop-1 的已验证用户，每人一篇带标签的博客，并在第一篇博客下评论'''
+    with app.app_context():
+        for i in range(start, stop):
+            user = User(name='check{}'.format(i), email='check{}@example.com'.format(i), password='check',
+                        confirmed=True)
+            blog = Blog(title='blog {}'.format(i), author=user)
+            blog.body = '正文 {}'.format(i)
+            blog.tags_string = 'all, tag{}'.format(i)
+            db.session.add_all([user, blog])
+            db.session.add(Comment(body='评论 {}'.format(i), blog_id=1, author=user))
+        db.session.commit()
+
+
+def count_queries(client, url):
+    '''返回请求 url 时执行的 SQL 语句条数'''
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return len(statements)
+
+
+def main():
+    with app.app_context():
+        db.create_all()
+        Role.insert_roles()
+    client = app.test_client()
+    urls = ('/', '/blogs', '/tag/all', '/blog/1')
+    # 每页 10 条，先后在页面上有 2 条和 10 条数据时各统计一次
+    app.config['BLOGS_PER_PAGE'] = 10
+    seed(0, 2)
+    small = [count_queries(client, url) for url in urls]
+    seed(2, 10)
+    large = [count_queries(client, url) for url in urls]
+
+    failed = False
+    for url, a, b in zip(urls, small, large):
+        ok = a == b
+        failed = failed or not ok
+        print('{:<10} 2 条数据: {:>2} 条 SQL，10 条数据: {:>2} 条 SQL  {}'.format(
+            url, a, b, 'OK' if ok else 'N+1!'))
+
+    # 登录用户的页面查询更多，逐个页面检查预算，超出时 client.get 直接抛出 QueryBudgetExceeded；
+    # 未验证邮箱的用户会被重定向到 /unconfirmed，所以 seed 创建的都是已验证的用户
+    response = client.post('/login', data={'email': 'check1@example.com', 'password': 'check'})
+    assert response.status_code == 302, response.status_code
+    for url in urls + ('/tags', '/timeline', '/user/check1/index', '/user/check1/followed', '/user/check1/followers'):
+        print('{:<22} 登录后 {:>2} 条 SQL'.format(url, count_queries(client, url)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+终端命令行执行
+python3 -m scripts.smtp_stub [端口] [建连延迟毫秒] [拒收比例]
+本地 SMTP 桩服务器，不真正投递邮件，只统计连接数和收到的邮件数，供调试和 bench_mail 使用。
+开发时把 MAIL_SERVER 设为 127.0.0.1、MAIL_PORT 设为上面的端口、MAIL_USE_TLS 设为 False 即可。
+
+在脚本中使用：
+    server = StubSMTPServer(connect_delay=0.02).start()
+    app.config['MAIL_PORT'] = server.port
+    ...
+    server.messages, server.connections
+    server.stop()
+'''
+
+import random
+import socketserver
+import sys
+import threading
+import time
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    '''只实现 smtplib 发信需要的几条命令'''
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        if server.connect_delay:
+            # 模拟真实服务器的握手耗时（TCP + TLS + 认证）
+            time.sleep(server.connect_delay)
+        self.reply('220 stub ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].decode('ascii', 'replace').upper()
+            if command == 'EHLO':
+                self.reply('250-stub')
+                self.reply('250 8BITMIME')
+            elif command in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                with server.lock:
+                    server.received += 1
+                    fail = server.random.random() < server.fail_rate
+                    if not fail:
+                        server.messages += 1
+                        server.bytes += size
+                self.reply('451 Try again later' if fail else '250 OK queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    '''在后台线程运行的 SMTP 桩服务器，port=0 时自动选择空闲端口'''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, connect_delay=0, fail_rate=0, seed=0):
+        super().__init__((host, port), StubSMTPHandler)
+        self.connect_delay = connect_delay
+        self.fail_rate = fail_rate  # 按这个比例随机拒收（451），用来检查重试
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = 0
+        self.messages = 0
+        self.bytes = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1025
+    delay = int(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0
+    fail_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = StubSMTPServer(port=port, connect_delay=delay, fail_rate=fail_rate)
+    print('SMTP 桩服务器监听 127.0.0.1:{}，Ctrl+C 退出'.format(server.port))
+    try:
+        server.serve_forever(poll_interval=1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('连接 {} 次，收到邮件 {} 封'.format(server.connections, server.messages))
+
+
+if __name__ == '__main__':
+    main()
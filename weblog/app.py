@@ -7,8 +7,21 @@ from flask_mail import Mail
 from flask_pagedown import PageDown
 
 from .handlers import blueprint_list
+from .commands import register_commands
 from .configs import configs
-from .models import db, Role, User
+from .models import db, Role, User, AnonymousUser
+from .presence import presence
+from .database import configure_engine
+from .replicas import replicas
+from .metrics import request_metrics
+from .querywatch import query_watch
+from .mailqueue import mail_queue
+from .tagcache import tag_ids
+from .permissions import role_permissions
+from .tokens import tokens
+from .search import search_index
+from .cache import fragment_cache, response_cache, tag_cloud
+from .identity import session_identity
 
 mail = Mail()
 
@@ -19,11 +32,25 @@ def register_blueprints(app):
 
 def register_extensions(app):
     Bootstrap(app)
+    request_metrics.init_app(app)  # 每个请求的 SQL、模板耗时统计，最先注册，计时从最早的 before_request 开始
+    query_watch.init_app(app)  # 慢查询、N+1 查询和查询预算检查
+    configure_engine(app)  # 连接池统计，必须在 db.init_app 之前
+    replicas.init_app(app)  # 只读请求读从库，同样必须在 db.init_app 之前
     db.init_app(app)
     Moment(app)  # 现在 Moment 也注册到 Flask 了
     Migrate(app, db)
     mail.init_app(app)  # 初始化 Flask-Mail
+    mail_queue.init_app(app)  # 邮件发送队列
     PageDown().init_app(app)
+    presence.init_app(app)  # last_seen 批量延迟写入
+    tag_ids.init_app(app)  # 标签名 -> id 缓存
+    role_permissions.init_app(app)  # 角色 -> 权限位掩码缓存
+    tokens.init_app(app)  # 邮件链接中的令牌
+    fragment_cache.init_app(app)  # 博客卡片片段缓存
+    response_cache.init_app(app)  # 匿名访客整页缓存
+    tag_cloud.init_app(app)  # 首页侧边栏的标签云
+    search_index.init_app(app)  # 全文搜索
+    session_identity.init_app(app)  # 会话中的用户身份快照
 
     # 配置 Flask-Login
     login_manager = LoginManager()
@@ -31,8 +58,12 @@ def register_extensions(app):
 
     @login_manager.user_loader  # 这里加上装饰器
     def user_loader(id):
-        # 只有主键 id 才能用 query.get 方法查询
-        return User.query.get(id)
+        # 每个请求只调用一次（Flask-Login 会把结果存到请求上下文里）
+        # 用主键查询并 JOIN 角色；启用 SESSION_IDENTITY 时只读请求直接使用会话中的快照，见 weblog/identity.py
+        return session_identity.load_user(id)
+    
+    # 未登录时 current_user 为 AnonymousUser，同样可以调用 has_permission 等方法
+    login_manager.anonymous_user = AnonymousUser
     
     # 未登录状态下访问带有权限的页面时：自动跳转到此路由
     login_manager.login_view = 'front.login'
@@ -47,6 +78,7 @@ def create_app(config):
 
     register_extensions(app)
     register_blueprints(app)
+    register_commands(app)
     
     return app 
 
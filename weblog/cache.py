@@ -0,0 +1,450 @@
+'''
+页面缓存：博客卡片的片段缓存，以及匿名访客的整页缓存
+
+博客卡片（标题、作者、标签、字数、正文）对所有访问者都一样，渲染结果按
+(模板, 博客 id, 博客版本号, 渲染器版本号) 缓存；博客修改正文、标题或标签时 Blog.version 会加一（见 models.py），
+旧的缓存自然失效，删除博客时直接删掉对应的缓存。
+编辑、删除等和当前用户相关的按钮不放在缓存的片段里。
+
+缓存后端：
+    - 'lru'：进程内的 LRU 缓存（默认），只适合单进程部署：整页缓存的「代」也在进程内，
+      一个进程提交的修改只能让它自己的缓存失效，其他进程在 RESPONSE_CACHE_TIMEOUT 内仍返回旧页面
+    - 'shared'：多个进程共用的缓存，客户端接口与 redis-py 相同（get/set/delete），
+      由 FRAGMENT_CACHE_CLIENT 配置的工厂函数创建，缺省使用进程内的 LocalSharedClient 代替
+
+匿名访客看到的首页、博客详情、博客列表、标签页和关于页对所有人都一样（表单的 CSRF 令牌除外），
+整页缓存后直接返回，并支持 ETag/Last-Modified 和 304。
+每个页面声明自己依赖的数据（例如 'blogs'、'blog:{id}'），Blog、Comment、Tag、Follow
+等数据提交到数据库后，对应依赖的「代」加一，依赖旧代的缓存页面随即失效，不靠过期时间猜测。
+
+首页侧边栏的标签云（使用次数最多的若干标签及其博客数）也缓存在同一种后端中，标签变化提交后删除。
+'''
+
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import render_template, request, session, g, make_response, current_app
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .models import db, Blog, Comment, Tag, Follow, User
+from .rendering import renderer
+from .replicas import replicas
+
+
+class LRUBackend:
+    '''进程内的 LRU 缓存，条目数超过 size 时淘汰最久未使用的'''
+
+    def __init__(self, size=2048):
+        self.size = size
+        self._data = OrderedDict()   # key -> (过期时间, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LocalSharedClient:
+    '''本地开发和测试时代替 Redis 的客户端，只实现用到的 get/set/delete，值以 bytes 保存'''
+
+    def __init__(self):
+        self._data = {}   # key -> (过期时间, bytes)
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._data.get(name)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                del self._data[name]
+                return None
+            return entry[1]
+
+    def set(self, name, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        with self._lock:
+            self._data[name] = (time.time() + ex if ex else None, value)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedBackend:
+    '''把 redis-py 风格的客户端包装成与 LRUBackend 相同的接口'''
+
+    def __init__(self, client, prefix='weblog:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.prefix + key, value.encode('utf-8'), ex=timeout or None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        self.client.flushdb()
+
+
+def make_backend(app, prefix, size):
+    '''按 FRAGMENT_CACHE_BACKEND 配置创建缓存后端，片段缓存和整页缓存使用同一种后端'''
+    if app.config['FRAGMENT_CACHE_BACKEND'] == 'shared':
+        factory = app.config['FRAGMENT_CACHE_CLIENT']
+        client = factory(app) if factory else LocalSharedClient()
+        return SharedBackend(client, prefix=prefix)
+    return LRUBackend(size)
+
+
+class FragmentCache:
+    '''模板片段缓存，用法与 Flask 扩展相同：fragment_cache.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self._templates = set()   # 用过的片段模板，删除博客时据此删除缓存
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('FRAGMENT_CACHE_BACKEND', 'lru')
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 2048)
+        app.config.setdefault('FRAGMENT_CACHE_TIMEOUT', 3600)
+        app.config.setdefault('FRAGMENT_CACHE_CLIENT', None)
+        self.app = app
+        self.hits = self.misses = 0
+        self.backend = make_backend(app, 'weblog:', app.config['FRAGMENT_CACHE_SIZE'])
+        app.extensions['fragment_cache'] = self
+        # 模板中使用 {{ blog_fragment('_blog_card.html', blog) }}
+        app.add_template_global(self.render_blog, 'blog_fragment')
+
+    @staticmethod
+    def key(template, blog_id, version):
+        # 渲染器版本也是键的一部分，修改渲染配置后片段中的正文 HTML 同样会更新
+        return 'fragment:{}:{}:{}:{}'.format(template, blog_id, version or 0, renderer.version)
+
+    def render_blog(self, template, blog):
+        '''渲染一篇博客的卡片片段，命中缓存时不再渲染模板'''
+        if not self.app.config['FRAGMENT_CACHE_ENABLED']:
+            return Markup(render_template(template, blog=blog))
+        self._templates.add(template)
+        key = self.key(template, blog.id, blog.version)
+        html = self.backend.get(key)
+        if html is not None:
+            self.hits += 1
+            return Markup(html)
+        self.misses += 1
+        html = render_template(template, blog=blog)
+        self.backend.set(key, html, self.app.config['FRAGMENT_CACHE_TIMEOUT'])
+        return Markup(html)
+
+    def invalidate_blog(self, blog_id, version):
+        '''删除一篇博客所有片段的缓存'''
+        self.backend.delete(*[self.key(template, blog_id, version) for template in self._templates])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+fragment_cache = FragmentCache()
+
+
+class ResponseCache:
+    '''匿名访客的整页缓存，用法与 Flask 扩展相同：response_cache.init_app(app)
+
+    视图函数使用 @response_cache.cached('blogs', 'blog:{id}') 声明依赖，
+    依赖名中的 {id} 等会用视图函数的参数替换
+    '''
+
+    # 缓存的页面中，CSRF 令牌替换为这个占位符，返回时再换成当前访客自己的令牌
+    CSRF_PLACEHOLDER = '__RESPONSE_CACHE_CSRF_TOKEN__'
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        # 进程内后端时，依赖名 -> 当前的代，最多 RESPONSE_CACHE_GENERATIONS 个（每篇博客一个 blog:{id}）；
+        # 不在其中的依赖名的代都是 _epoch，淘汰任何一个依赖名时换一个新的 _epoch，
+        # 依赖被淘汰的名字的页面随之失效，不会因为代回到了旧值而返回旧页面
+        self._generations = OrderedDict()
+        self._epoch = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_SIZE', 512)
+        app.config.setdefault('RESPONSE_CACHE_TIMEOUT', 300)
+        app.config.setdefault('RESPONSE_CACHE_GENERATIONS', 10000)
+        self.app = app
+        self.hits = self.misses = 0
+        self.backend = make_backend(app, 'weblog:page:', app.config['RESPONSE_CACHE_SIZE'])
+        self._generations.clear()
+        self._epoch = uuid.uuid4().hex
+        app.extensions['response_cache'] = self
+        if (app.config['RESPONSE_CACHE_ENABLED'] and not isinstance(self.backend, SharedBackend)
+                and not (app.debug or app.testing)):
+            app.logger.warning("整页缓存使用进程内的 'lru' 后端，只适合单进程部署：多个工作进程时，"
+                               "修改只能让提交它的进程的缓存失效，其他进程最多 %s 秒内仍返回旧页面；"
+                               "多进程部署请设置 FRAGMENT_CACHE_BACKEND = 'shared' 并配置 FRAGMENT_CACHE_CLIENT",
+                               app.config['RESPONSE_CACHE_TIMEOUT'])
+
+    def generation(self, name):
+        '''依赖的当前代；共用后端时代保存在后端中，多个进程都能看到'''
+        if isinstance(self.backend, SharedBackend):
+            return self.backend.get('gen:' + name) or '0'
+        with self._lock:
+            return self._generations.get(name, self._epoch)
+
+    def invalidate(self, *names):
+        '''让依赖这些数据的缓存页面全部失效'''
+        for name in names:
+            new = uuid.uuid4().hex
+            if isinstance(self.backend, SharedBackend):
+                self.backend.set('gen:' + name, new)
+                continue
+            with self._lock:
+                self._generations[name] = new
+                self._generations.move_to_end(name)
+                while len(self._generations) > self.app.config['RESPONSE_CACHE_GENERATIONS']:
+                    self._generations.popitem(last=False)
+                    self._epoch = uuid.uuid4().hex
+
+    def cacheable(self):
+        '''只缓存匿名访客的 GET/HEAD 请求，有待显示的 flash 消息时不缓存'''
+        return (self.app.config['RESPONSE_CACHE_ENABLED']
+                and request.method in ('GET', 'HEAD')
+                and not current_user.is_authenticated
+                and not session.get('_flashes'))
+
+    def cached(self, *depends_on):
+        '''视图函数装饰器，depends_on 为页面依赖的数据'''
+        def decorator(func):
+            @wraps(func)
+            def decorated_func(*args, **kwargs):
+                if not self.cacheable():
+                    return func(*args, **kwargs)
+                names = [name.format(**kwargs) for name in depends_on]
+                key = 'page:' + request.full_path
+                entry = self._lookup(key, names)
+                if entry is not None:
+                    self.hits += 1
+                    return self._respond(entry, 'HIT')
+                self.misses += 1
+                # 先读取代，再渲染：渲染期间有数据提交的话，存下的页面会被视为过期
+                generations = {name: self.generation(name) for name in names}
+                # 要存进缓存的页面读主库，不读可能有复制延迟的从库
+                replicas.use_primary()
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200 or response.mimetype != 'text/html':
+                    return response
+                entry = self._store(key, response, generations)
+                return self._respond(entry, 'MISS')
+            return decorated_func
+        return decorator
+
+    def _lookup(self, key, names):
+        raw = self.backend.get(key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if any(entry['generations'].get(name) != self.generation(name) for name in names):
+            return None
+        return entry
+
+    def _store(self, key, response, generations):
+        body = response.get_data(as_text=True)
+        token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+        has_form = bool(token) and token in body
+        if has_form:
+            body = body.replace(token, self.CSRF_PLACEHOLDER)
+        entry = {
+            'body': body,
+            'has_form': has_form,
+            'last_modified': int(time.time()),
+            'etag': uuid.uuid4().hex,
+            'generations': generations,
+        }
+        self.backend.set(key, json.dumps(entry), self.app.config['RESPONSE_CACHE_TIMEOUT'])
+        return entry
+
+    def _respond(self, entry, status):
+        body = entry['body']
+        response = make_response(body.replace(self.CSRF_PLACEHOLDER, generate_csrf())
+                                 if entry['has_form'] else body)
+        response.headers['X-Cache'] = status
+        response.headers['Vary'] = 'Cookie'
+        # 浏览器每次都要向服务器确认，保证数据提交后能看到新页面
+        response.headers['Cache-Control'] = 'no-cache'
+        if not entry['has_form']:
+            # 带表单的页面不返回 304，否则浏览器会继续使用旧页面中可能已过期的 CSRF 令牌
+            response.set_etag(entry['etag'])
+            response.last_modified = entry['last_modified']
+            response.make_conditional(request)
+        return response
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+response_cache = ResponseCache()
+
+
+class TagCloud:
+    '''首页侧边栏的标签云，用法与 Flask 扩展相同：tag_cloud.init_app(app)
+
+    top() 返回使用次数最多的 TAG_CLOUD_SIZE 个标签 [(标签名, 博客数), ...]，
+    模板拿到的是简单的元组，不再加载全部 Tag 对象，也不用逐个统计博客数
+    '''
+
+    KEY = 'tagcloud'
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TAG_CLOUD_SIZE', 20)
+        app.config.setdefault('TAG_CLOUD_TIMEOUT', 600)
+        self.app = app
+        self.hits = self.misses = 0
+        self.backend = make_backend(app, 'weblog:', 16)
+        app.extensions['tag_cloud'] = self
+
+    def top(self):
+        cached = self.backend.get(self.KEY)
+        if cached is not None:
+            self.hits += 1
+            return [tuple(item) for item in json.loads(cached)]
+        self.misses += 1
+        # 要存进缓存，读主库
+        replicas.use_primary()
+        # Tag.blog_count 由 models.update_tag_counts 维护，按它的索引取前 N 个即可，不用 GROUP BY
+        rows = db.session.execute(
+            db.select(Tag.name, Tag.blog_count)
+            .where(Tag.blog_count > 0)
+            .order_by(Tag.blog_count.desc(), Tag.name)
+            .limit(self.app.config['TAG_CLOUD_SIZE'])
+        ).all()
+        items = [tuple(row) for row in rows]
+        self.backend.set(self.KEY, json.dumps(items), self.app.config['TAG_CLOUD_TIMEOUT'])
+        return items
+
+    def invalidate(self):
+        self.backend.delete(self.KEY)
+
+
+tag_cloud = TagCloud()
+
+
+def changed_page_data(session):
+    '''根据本次 flush 中新增、修改、删除的对象，计算需要失效的页面依赖'''
+    names = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Blog):
+            state = inspect(obj)
+            tags_changed = state.attrs.tags.history.has_changes()
+            if obj in session.dirty and not tags_changed and not any(
+                    state.attrs[name].history.has_changes() for name in ('title', 'body', 'time_stamp', 'author_id')):
+                continue
+            names.update(('blogs', 'blog:{}'.format(obj.id)))
+            if obj not in session.dirty or tags_changed:
+                names.add('tags')
+        elif isinstance(obj, Comment):
+            names.add('blog:{}'.format(obj.blog_id))
+        elif isinstance(obj, Tag):
+            names.update(('tags', 'blogs'))
+        elif isinstance(obj, Follow):
+            names.add('follows')
+        elif isinstance(obj, User) and obj in session.dirty:
+            # 博客卡片上显示作者名，只关心改名
+            if inspect(obj).attrs.name.history.has_changes():
+                names.add('users')
+    return names
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    '''记下本次事务中删除的博客和变化的页面依赖，提交后再让缓存失效（回滚时缓存不受影响）'''
+    deleted = [(obj.id, obj.version) for obj in session.deleted if isinstance(obj, Blog)]
+    if deleted:
+        session.info.setdefault('deleted_blogs', []).extend(deleted)
+    names = changed_page_data(session)
+    if names:
+        session.info.setdefault('changed_pages', set()).update(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_caches(session):
+    deleted = session.info.pop('deleted_blogs', None)
+    if deleted and fragment_cache.backend is not None:
+        for blog_id, version in deleted:
+            fragment_cache.invalidate_blog(blog_id, version)
+    names = session.info.pop('changed_pages', None)
+    if names and response_cache.backend is not None:
+        response_cache.invalidate(*names)
+    if names and 'tags' in names and tag_cloud.backend is not None:
+        tag_cloud.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('deleted_blogs', None)
+    session.info.pop('changed_pages', None)
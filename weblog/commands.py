@@ -0,0 +1,363 @@
+'''
+flask 命令行命令
+
+在 create_app 中通过 register_commands(app) 注册，使用方式：
+    export FLASK_APP=manage.py
+    flask render-blogs --help
+'''
+
+import os
+import json
+import time
+from collections import deque, defaultdict
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, case, null, or_, select, func
+
+from .models import db, User, Blog, Follow, Tag, Timeline, blog_tags
+from .rendering import renderer
+from .cache import tag_cloud
+from .search import search_index
+from .email import send_many
+from .mailqueue import mail_queue
+from .replicas import replicas
+
+
+def render_chunk(rows):
+    '''在子进程中渲染一批博客，rows 为 [(id, body), ...]，返回 [(id, html), ...]
+
+    每个子进程导入 weblog.rendering 时都会创建自己的 renderer，互不影响
+    '''
+    return [(blog_id, renderer.render(body or '')) for blog_id, body in rows]
+
+
+def iter_blog_chunks(chunk_size, after_id, only_stale):
+    '''按 id 做 keyset 分页，逐批读取 (id, body)，不用 OFFSET，也不会一次读入全部数据'''
+    while True:
+        query = select(Blog.id, Blog.body).where(Blog.id > after_id)
+        if only_stale:
+            query = query.where(or_(Blog.body_html_version.is_(None),
+                                    Blog.body_html_version != renderer.version))
+        rows = db.session.execute(query.order_by(Blog.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        # 读完就结束事务，避免长时间持有读事务
+        db.session.rollback()
+        after_id = rows[-1][0]
+        yield [tuple(row) for row in rows]
+
+
+def write_rendered(results):
+    '''用一条 executemany 的 UPDATE 写回一批渲染结果'''
+    table = Blog.__table__
+    stmt = (table.update()
+            .where(table.c.id == bindparam('_id'))
+            .values(body_html=bindparam('_html'), body_html_version=renderer.version))
+    db.session.execute(stmt, [{'_id': blog_id, '_html': html} for blog_id, html in results])
+    db.session.commit()
+
+
+@click.command('render-blogs')
+@click.option('--chunk-size', default=500, show_default=True, help='每批读取和写回的博客数')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              help='渲染进程数，为 1 时在当前进程中渲染')
+@click.option('--after-id', default=0, show_default=True, help='从 id 大于该值的博客开始，用于中断后继续')
+@click.option('--all', 'render_all', is_flag=True, help='重新渲染全部博客，而不只是渲染器版本过期的')
+@with_appcontext
+def render_blogs(chunk_size, workers, after_id, render_all):
+    '''批量重新渲染博客的 body_html
+
+    修改 weblog/rendering.py 中的渲染配置并把 RENDERER_VERSION 加一后执行，
+    默认只处理版本过期的博客，所以中断后直接重新执行也能从剩下的部分继续
+    '''
+    only_stale = not render_all
+    query = select(func.count(Blog.id)).where(Blog.id > after_id)
+    if only_stale:
+        query = query.where(or_(Blog.body_html_version.is_(None),
+                                Blog.body_html_version != renderer.version))
+    total = db.session.execute(query).scalar()
+    click.echo('渲染器版本 {}，共 {} 篇博客需要渲染'.format(renderer.version, total))
+    if not total:
+        return
+
+    chunks = iter_blog_chunks(chunk_size, after_id, only_stale)
+    done = 0
+    start = time.perf_counter()
+
+    def report(last_id):
+        elapsed = time.perf_counter() - start
+        # 中断后可以用 --after-id 加上这里打印的 id 继续
+        click.echo('已渲染 {}/{} 篇，{:.0f} 篇/秒，最后 id {}'.format(
+            done, total, done / elapsed if elapsed else 0, last_id))
+
+    if workers <= 1:
+        for rows in chunks:
+            write_rendered(render_chunk(rows))
+            done += len(rows)
+            report(rows[-1][0])
+    else:
+        # 同时在途的批次数有上限，读库、渲染、写库可以并行，内存占用也不会随数据量增长
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for rows in chunks:
+                pending.append((rows[-1][0], executor.submit(render_chunk, rows)))
+                if len(pending) >= workers * 2:
+                    last_id, future = pending.popleft()
+                    results = future.result()
+                    write_rendered(results)
+                    done += len(results)
+                    report(last_id)
+            # 按提交顺序写回，保证打印出的「最后 id」之前的博客都已经写入
+            while pending:
+                last_id, future = pending.popleft()
+                results = future.result()
+                write_rendered(results)
+                done += len(results)
+                report(last_id)
+    click.echo('完成，共渲染 {} 篇'.format(done))
+
+
+@click.command('rebuild-timelines')
+@with_appcontext
+def rebuild_timelines():
+    '''按关注关系重建全部用户的首页时间线
+
+    上线写扩散时间线时执行一次，之后发表博客、关注、取消关注都会增量维护
+    '''
+    start = time.perf_counter()
+    Timeline.rebuild()
+    total = db.session.execute(select(func.count()).select_from(Timeline)).scalar()
+    click.echo('完成，共写入 {} 条时间线记录，用时 {:.1f} 秒'.format(total, time.perf_counter() - start))
+
+
+@click.command('repair-counters')
+@click.option('--chunk-size', default=5000, show_default=True, help='每条 UPDATE 处理的用户数')
+@with_appcontext
+def repair_counters(chunk_size):
+    '''按 follows 和 blog 表重新统计每个用户的粉丝数、关注数和博客数
+
+    每批用户只执行一条带相关子查询的 UPDATE，批与批之间提交，不会长时间锁住整张 user 表
+    '''
+    table = User.__table__
+    values = {
+        'followers_count': select(func.count()).where(Follow.followed_id == table.c.id).scalar_subquery(),
+        'followed_count': select(func.count()).where(Follow.follower_id == table.c.id).scalar_subquery(),
+        'blogs_count': select(func.count()).where(Blog.author_id == table.c.id).scalar_subquery(),
+    }
+    after_id = 0
+    done = 0
+    while True:
+        ids = db.session.execute(select(table.c.id).where(table.c.id > after_id)
+                                 .order_by(table.c.id).limit(chunk_size)).scalars().all()
+        if not ids:
+            break
+        db.session.execute(table.update()
+                           .where(table.c.id > after_id, table.c.id <= ids[-1])
+                           .values(values))
+        db.session.commit()
+        after_id = ids[-1]
+        done += len(ids)
+    click.echo('完成，共重新统计 {} 个用户'.format(done))
+
+
+@click.command('sweep-tags')
+@click.option('--chunk-size', default=5000, show_default=True, help='每条 UPDATE 处理的标签数')
+@with_appcontext
+def sweep_tags(chunk_size):
+    '''重新统计每个标签的博客数，并删除没有博客的标签
+
+    发表、编辑、删除博客时只加减涉及的标签的计数，计数变为 0 的标签留到这里删除，
+    未使用不到 TAG_CACHE_TIMEOUT 秒的标签留到下次执行再删除（见 weblog/tagcache.py），
+    这个命令需要定期执行，例如在 crontab 中每天执行一次
+    '''
+    table = Tag.__table__
+    count = select(func.count()).where(blog_tags.c.tag_id == table.c.id).scalar_subquery()
+    now = datetime.utcnow()
+    after_id = 0
+    while True:
+        ids = db.session.execute(select(table.c.id).where(table.c.id > after_id)
+                                 .order_by(table.c.id).limit(chunk_size)).scalars().all()
+        if not ids:
+            break
+        db.session.execute(table.update()
+                           .where(table.c.id > after_id, table.c.id <= ids[-1])
+                           .values(blog_count=count,
+                                   unused_since=case((count > 0, null()),
+                                                     else_=func.coalesce(table.c.unused_since, now))))
+        db.session.commit()
+        after_id = ids[-1]
+    removed = Tag.remove_unused()
+    db.session.commit()
+    # 计数是用 Core 语句改的，不会触发提交后的缓存失效，这里手动让标签云失效
+    tag_cloud.invalidate()
+    click.echo('完成，删除了 {} 个未使用的标签'.format(len(removed)))
+
+
+@click.command('rebuild-search-index')
+@click.option('--chunk-size', default=1000, show_default=True, help='每批读取的博客、评论数')
+@with_appcontext
+def rebuild_search_index(chunk_size):
+    '''从数据库重建全文搜索索引，同时合并增量日志
+
+    第一次启用搜索时执行一次，之后可以定期执行，避免增量日志过长
+    '''
+    start = time.perf_counter()
+
+    def report(done):
+        elapsed = time.perf_counter() - start
+        click.echo('已读取 {} 篇文档，{:.0f} 篇/秒'.format(done, done / elapsed if elapsed else 0))
+
+    total = search_index.rebuild(chunk_size, progress=report)
+    click.echo('完成，共索引 {} 篇文档，用时 {:.1f} 秒，索引目录 {}'.format(
+        total, time.perf_counter() - start, search_index.directory))
+
+def collect_digests(user_ids, since, until, limit):
+    '''一条查询算出一批用户的摘要：follows ⋈ blog，返回 {用户 id: (新博客总数, [最近 limit 篇])}
+
+    每篇博客是 (id, 标题, 作者名, 时间)，按时间倒序
+    '''
+    author = db.aliased(User)
+    ranked = (select(Follow.follower_id, Blog.id, Blog.title, author.name, Blog.time_stamp,
+                     func.row_number().over(partition_by=Follow.follower_id,
+                                            order_by=(Blog.time_stamp.desc(), Blog.id.desc())).label('n'),
+                     func.count().over(partition_by=Follow.follower_id).label('total'))
+              .join(Blog, Blog.author_id == Follow.followed_id)
+              .join(author, author.id == Blog.author_id)
+              .where(Follow.follower_id.in_(user_ids),
+                     Follow.followed_id != Follow.follower_id,
+                     Blog.time_stamp >= since, Blog.time_stamp < until)
+              .subquery())
+    rows = db.session.execute(select(ranked).where(ranked.c.n <= limit)
+                              .order_by(ranked.c.follower_id, ranked.c.n))
+    digests = defaultdict(lambda: [0, []])
+    for follower_id, blog_id, title, author_name, time_stamp, n, total in rows:
+        digest = digests[follower_id]
+        digest[0] = total
+        digest[1].append((blog_id, title, author_name, time_stamp))
+    return digests
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path, data):
+    '''先写临时文件再改名，中途被杀掉也不会留下写了一半的检查点'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+@click.command('send-digests')
+@click.option('--hours', default=24, show_default=True, help='第一次执行时统计最近多少小时的博客')
+@click.option('--chunk-size', default=500, show_default=True, help='每批处理的用户数')
+@click.option('--limit', default=10, show_default=True, help='每封邮件最多列出的博客数')
+@click.option('--checkpoint', default=None, help='检查点文件，缺省为 instance/digest-checkpoint.json')
+@click.option('--base-url', default='http://localhost:5000', show_default=True,
+              help='邮件中链接的网站地址')
+@click.option('--wait', default=600, show_default=True, help='处理完后最多等待发送队列发完邮件的秒数')
+@with_appcontext
+def send_digests(hours, chunk_size, limit, checkpoint, base_url, wait):
+    '''给每个已验证的用户发一封「关注的人发表了新博客」摘要邮件
+
+    按用户 id 分批，每批只用一条查询算出所有人的摘要，邮件交给发送队列。
+    每批处理完都会更新检查点：中断后重新执行会从断点继续，统计区间不变；
+    执行完后，下次执行从这次的截止时间开始统计，适合放在 crontab 中定期执行。
+    检查点只说明邮件已经写进待发目录，退出前等待发送队列发完（最多 --wait 秒），
+    到时还没发完的留在待发目录，命令以非 0 状态退出，应用下次启动时继续发送
+    '''
+    path = checkpoint or os.path.join(current_app.instance_path, 'digest-checkpoint.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state = load_checkpoint(path)
+    if 'after_id' in state:
+        since = datetime.fromisoformat(state['since'])
+        until = datetime.fromisoformat(state['until'])
+        after_id = state['after_id']
+        click.echo('从检查点继续：用户 id > {}'.format(after_id))
+    else:
+        until = datetime.now()
+        since = datetime.fromisoformat(state['until']) if 'until' in state else until - timedelta(hours=hours)
+        after_id = 0
+    click.echo('统计 {:%Y-%m-%d %H:%M} 至 {:%Y-%m-%d %H:%M} 的博客'.format(since, until))
+
+    users_done = mails = 0
+    start = time.perf_counter()
+    sent, failed = mail_queue.sent, mail_queue.failed
+    # 命令行中没有请求，邮件模板里的 url_for(..., _external=True) 用 base_url 生成链接
+    with current_app.test_request_context(base_url=base_url):
+        while True:
+            users = db.session.execute(
+                select(User.id, User.name, User.email)
+                .where(User.id > after_id, User.confirmed.is_(True))
+                .order_by(User.id).limit(chunk_size)).all()
+            if not users:
+                break
+            digests = collect_digests([user.id for user in users], since, until, limit)
+            db.session.rollback()
+
+            def context(user):
+                if user.id not in digests:
+                    return None
+                total, blogs = digests[user.id]
+                return {'subject': '你关注的人发表了 {} 篇新博客'.format(total),
+                        'total': total, 'blogs': blogs, 'since': since}
+
+            mails += send_many(users, 'digest', context)
+            after_id = users[-1].id
+            users_done += len(users)
+            save_checkpoint(path, {'since': since.isoformat(), 'until': until.isoformat(),
+                                   'after_id': after_id})
+            elapsed = time.perf_counter() - start
+            click.echo('已处理 {} 个用户，{:.0f} 个/秒，发出 {} 封，最后 id {}'.format(
+                users_done, users_done / elapsed if elapsed else 0, mails, after_id))
+    save_checkpoint(path, {'until': until.isoformat()})
+    click.echo('共处理 {} 个用户，生成 {} 封摘要邮件，用时 {:.1f} 秒'.format(
+        users_done, mails, time.perf_counter() - start))
+
+    if not current_app.config['MAIL_QUEUE_ENABLED']:
+        return
+    # 命令退出时 atexit 中的 mail_queue.stop() 会直接结束发送线程，这里先等队列发完
+    click.echo('等待发送队列发完邮件……')
+    if not mail_queue.join(wait):
+        raise click.ClickException('等待 {} 秒后还有 {} 封邮件没有发出，留在待发目录 {} 中'.format(
+            wait, mail_queue.pending(), os.path.join(mail_queue.dir, 'pending')))
+    click.echo('完成，发出 {} 封，{} 封多次重试失败后移到了 {}'.format(
+        mail_queue.sent - sent, mail_queue.failed - failed, os.path.join(mail_queue.dir, 'failed')))
+
+
+@click.command('sync-replicas')
+@with_appcontext
+def sync_replicas():
+    '''本地用 SQLite 文件模拟主从库时，把主库整个复制到各个从库（SQLite 的在线备份）'''
+    primary = db.engines[None]
+    if primary.dialect.name != 'sqlite':
+        raise click.ClickException('只支持 SQLite，其他数据库请使用数据库自己的复制')
+    if not replicas.binds:
+        raise click.ClickException('没有配置从库（SQLALCHEMY_REPLICAS）')
+    for bind in replicas.binds:
+        source, target = primary.raw_connection(), db.engines[bind].raw_connection()
+        try:
+            source.driver_connection.backup(target.driver_connection)
+        finally:
+            target.close()
+            source.close()
+        click.echo('已复制到 {}'.format(db.engines[bind].url))
+
+
+def register_commands(app):
+    app.cli.add_command(render_blogs)
+    app.cli.add_command(rebuild_timelines)
+    app.cli.add_command(repair_counters)
+    app.cli.add_command(sweep_tags)
+    app.cli.add_command(rebuild_search_index)
+    app.cli.add_command(send_digests)
+    app.cli.add_command(sync_replicas)
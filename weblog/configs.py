@@ -11,6 +11,105 @@ class BaseConfig:
     USERS_PER_PAGE = 10
     COMMENTS_PER_PAGE = 10  
 
+    # last_seen 延迟写入：同一用户多少秒内只记录一次，多久/攒多少条批量写一次
+    PRESENCE_WRITE_BEHIND = True
+    PRESENCE_THROTTLE_SECONDS = 60
+    PRESENCE_FLUSH_INTERVAL = 10
+    PRESENCE_FLUSH_SIZE = 500
+
+    # 列表页是否默认使用游标分页（?after=/?before=），以及游标分页下总数的缓存秒数
+    CURSOR_PAGINATION = False
+    PAGINATION_COUNT_TTL = 60
+
+    # 博客卡片片段缓存，后端为 'lru'（进程内）或 'shared'（多进程共用，见 weblog/cache.py）
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_BACKEND = 'lru'
+    FRAGMENT_CACHE_SIZE = 2048
+    FRAGMENT_CACHE_TIMEOUT = 3600
+
+    # 匿名访客整页缓存，主要靠数据提交时失效，RESPONSE_CACHE_TIMEOUT 只是兜底；
+    # 'lru' 后端时失效只对本进程有效（多进程部署要用 'shared'），RESPONSE_CACHE_GENERATIONS 为进程内最多记住的依赖名数
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_SIZE = 512
+    RESPONSE_CACHE_TIMEOUT = 300
+    RESPONSE_CACHE_GENERATIONS = 10000
+
+    # 首页侧边栏标签云显示的标签数，缓存主要靠标签变化时失效，TAG_CLOUD_TIMEOUT 只是兜底
+    TAG_CLOUD_SIZE = 20
+    TAG_CLOUD_TIMEOUT = 600
+
+    # 首页时间线：粉丝数超过 TIMELINE_FANOUT_LIMIT 的作者不写扩散，读取时合并；
+    # 关注某人时补进他最近的 TIMELINE_BACKFILL 篇博客
+    TIMELINE_FANOUT_LIMIT = 1000
+    TIMELINE_BACKFILL = 100
+    TIMELINE_HOT_AUTHORS_TTL = 300
+
+    # 标签名 -> 标签 id 的进程内缓存，TAG_CACHE_TIMEOUT 为缓存的有效期，
+    # 也是标签未使用多久之后 flask sweep-tags 才删除它，见 weblog/tagcache.py
+    TAG_CACHE_SIZE = 4096
+    TAG_CACHE_TIMEOUT = 300
+
+    # 角色权限位掩码的进程内缓存，其他进程修改角色后最多这么多秒生效
+    ROLE_CACHE_TIMEOUT = 300
+
+    # 只读请求由会话中签名的身份快照恢复当前用户，不查 user 表；快照最多使用这么多秒。
+    # 启用时必须设置 FRAGMENT_CACHE_BACKEND = 'shared'（见 weblog/identity.py）
+    SESSION_IDENTITY = False
+    SESSION_IDENTITY_MAX_AGE = 300
+
+    # 邮件链接中令牌的有效期（秒）：验证邮箱、重置密码、更换邮箱；最近验证过的令牌缓存条数
+    TOKEN_CONFIRM_MAX_AGE = 7 * 24 * 3600
+    TOKEN_RESET_MAX_AGE = 3600
+    TOKEN_CHANGE_EMAIL_MAX_AGE = 24 * 3600
+    TOKEN_CACHE_SIZE = 1024
+
+    # 连接池统计（/_metrics 中查看）；只读的批处理任务是否使用服务器端游标，见 weblog/database.py
+    SQLALCHEMY_POOL_METRICS = True
+    SQLALCHEMY_STREAM_RESULTS = False
+
+    # 从库的连接地址列表，为空时不启用；只有 REPLICA_ENDPOINTS 中的视图的 GET/HEAD 请求读从库，
+    # 客户端自己提交写操作后 REPLICA_STICKY_SECONDS 秒内仍读主库，见 weblog/replicas.py
+    SQLALCHEMY_REPLICAS = []
+    REPLICA_ENDPOINTS = ('front.index', 'front.blog', 'front.blogs', 'front.tag', 'front.tags',
+                         'front.timeline', 'user.index', 'user.followed', 'user.followers')
+    REPLICA_STICKY_SECONDS = 5
+
+    # 每个请求的 SQL 条数、SQL 耗时、模板耗时统计（/_metrics 中查看），以及是否在响应中加 Server-Timing 头
+    METRICS_ENABLED = True
+    METRICS_SERVER_TIMING = True
+
+    # 同一请求中同一条语句执行超过 QUERY_REPEAT_THRESHOLD 次（N+1）、单条语句超过 SLOW_QUERY_SECONDS 秒时记警告日志；
+    # QUERY_BUDGETS = {视图: 最多执行的语句条数}，QUERY_BUDGET_STRICT 时超出预算直接抛出异常，见 weblog/querywatch.py
+    QUERY_WATCH_ENABLED = True
+    QUERY_REPEAT_THRESHOLD = 5
+    SLOW_QUERY_SECONDS = 0.5
+    QUERY_BUDGETS = {}
+    QUERY_BUDGET_STRICT = False
+
+    # 访问 /_metrics 等内部接口：带有 X-Metrics-Token: METRICS_TOKEN 请求头的请求，
+    # 或来自 METRICS_ALLOW_FROM 中的地址、且没有经过反向代理的请求；缺省不按地址放行，开发和测试时放行本机
+    METRICS_ALLOW_FROM = ()
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # 全文搜索索引所在目录，缺省为 instance/search-index（测试时为临时目录）；标题中的词按几倍计入词频；每次最多返回的结果数
+    SEARCH_ENABLED = True
+    SEARCH_INDEX_DIR = os.environ.get('SEARCH_INDEX_DIR')
+    SEARCH_TITLE_WEIGHT = 3
+    SEARCH_RESULTS = 20
+
+    # 邮件发送队列：待发邮件保存在 MAIL_QUEUE_DIR（缺省为 instance/mail-spool，测试时为临时目录），
+    # 固定几个后台线程，每个 SMTP 连接最多连发 MAIL_QUEUE_BATCH 封，失败后按 MAIL_QUEUE_BACKOFF 秒起指数退避重试；
+    # 认领后超过 MAIL_QUEUE_CLAIM_TIMEOUT 秒还没发完的邮件放回待发目录，由其他线程或进程重新发送
+    MAIL_QUEUE_ENABLED = True
+    MAIL_QUEUE_DIR = os.environ.get('MAIL_QUEUE_DIR')
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_QUEUE_WORKERS = 2
+    MAIL_QUEUE_BATCH = 50
+    MAIL_QUEUE_RETRIES = 5
+    MAIL_QUEUE_BACKOFF = 30
+    MAIL_QUEUE_POLL_INTERVAL = 5
+    MAIL_QUEUE_CLAIM_TIMEOUT = 600
+
 class DevConfig(BaseConfig):
     '''
     开发阶段使用的配置类
@@ -24,6 +123,8 @@ class DevConfig(BaseConfig):
     pwd = ':{}'.format(pwd) if pwd else ''
     SQLALCHEMY_DATABASE_URI = url.format(pwd)    
 
+    METRICS_ALLOW_FROM = ('127.0.0.1', '::1')
+
     # 用gmail作为测试邮箱服务器
     # ！！！BUG未解决
     # smtplib.SMTPSenderRefused: (530, b'5.7.0 Authentication Required.
@@ -40,12 +141,91 @@ class DevConfig(BaseConfig):
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
 
 
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+class ProdConfig(BaseConfig):
+    '''
+    生产环境使用的配置类，数据库为 MySQL，连接池参数都可以用环境变量调整
+    '''
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'mysql://weblog@localhost/weblog?charset=utf8mb4'
+
+    # 连接池：
+    # - DB_POOL_SIZE：常驻连接数，一般取每个进程的线程数
+    # - DB_MAX_OVERFLOW：高峰时允许额外创建的连接数
+    # - DB_POOL_TIMEOUT：连接都被占用时最多等待的秒数，超过抛出异常
+    # - DB_POOL_RECYCLE：连接使用超过这么多秒后重建，要小于 MySQL 的 wait_timeout，
+    #   否则会拿到已被服务器断开的连接（MySQL server has gone away）
+    # - DB_POOL_PRE_PING：取出连接时先 ping 一下，断开了就重连
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True),
+    }
+    SQLALCHEMY_POOL_METRICS = env_bool('DB_POOL_METRICS', True)
+    # 重建搜索索引等只读批处理任务使用服务器端游标，不把整张表读进内存
+    SQLALCHEMY_STREAM_RESULTS = env_bool('DB_STREAM_RESULTS', True)
+    # 从库，多个地址用逗号分隔
+    SQLALCHEMY_REPLICAS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))
+    MAIL_USE_TLS = env_bool('MAIL_USE_TLS', False)
+    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
+
+
 class TestConfig(BaseConfig):
-    pass
+    '''
+    测试和性能基准使用的配置类，默认使用内存 SQLite 数据库
+    '''
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    MAIL_SUPPRESS_SEND = True
+    MAIL_DEFAULT_SENDER = 'test@weblog.local'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+    # 没有指定时，每个测试应用使用自己的临时索引目录和邮件待发目录（见 SearchIndex.init_app、MailQueue.init_app）
+    SEARCH_INDEX_DIR = os.environ.get('TEST_SEARCH_INDEX_DIR')
+    MAIL_QUEUE_DIR = os.environ.get('TEST_MAIL_QUEUE_DIR')
+    METRICS_ALLOW_FROM = ('127.0.0.1', '::1')
+    # 页面执行的语句条数超出预算时直接报错（登录用户访问时的条数，留了一两条余量）
+    QUERY_BUDGET_STRICT = True
+    QUERY_BUDGETS = {
+        'front.index': 6,
+        'front.blogs': 5,
+        'front.blog': 6,
+        'front.tag': 6,
+        'front.tags': 4,
+        'front.timeline': 6,
+        'user.index': 8,
+        'user.followed': 5,
+        'user.followers': 5,
+    }
 
 
 
+class BenchConfig(TestConfig):
+    '''
+    负载测试使用的配置类：数据库由 BENCH_DATABASE_URL 指定（缺省为 instance/bench.db），
+    数据由 scripts/bench_seed.py 生成，见 scripts/bench_web.py
+    '''
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or 'sqlite:///bench.db'
+    # 测量的是真实的耗时，超出查询预算只记日志
+    QUERY_BUDGET_STRICT = False
+
+
 configs = {
     'dev': DevConfig,
-    'test': TestConfig
+    'prod': ProdConfig,
+    'test': TestConfig,
+    'bench': BenchConfig,
 }
\ No newline at end of file
@@ -0,0 +1,112 @@
+'''
+数据库连接池的统计和大查询的流式读取
+
+连接池参数（大小、溢出、回收时间、pre-ping）在 ProdConfig.SQLALCHEMY_ENGINE_OPTIONS 中由环境变量配置，
+这里把连接池换成 TimedQueuePool，额外记录取连接时的等待次数、总时长、最长时长和超时次数，
+与 QueuePool 自己的 size/checkedout/overflow 一起由 pool_stats() 返回，
+在 /_metrics 中查看（见 weblog/handlers/internal.py），用来估算 worker 数和连接池大小。
+
+iter_chunks 按批读取大表：默认按主键 keyset 分页，批与批之间结束读事务；
+SQLALCHEMY_STREAM_RESULTS = True 时改用服务器端游标（stream_results），只执行一条查询，
+适合 MySQL 上只读的批处理任务（例如重建搜索索引）。注意服务器端游标没读完之前，
+同一个连接上不能执行别的语句，所以读的同时要写库的任务不要用它。
+'''
+
+import time
+import threading
+
+from flask import current_app
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from .models import db
+
+
+class TimedQueuePool(QueuePool):
+    '''记录取连接等待时间的 QueuePool'''
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._stats_lock = threading.Lock()
+        self.waits = 0          # 取连接的次数
+        self.wait_total = 0.0   # 累计等待秒数
+        self.wait_max = 0.0
+        self.timeouts = 0       # 等待超过 pool_timeout 的次数
+
+    def recreate(self):
+        # 连接池失效重建时保留统计数据
+        pool = super().recreate()
+        pool.waits, pool.wait_total = self.waits, self.wait_total
+        pool.wait_max, pool.timeouts = self.wait_max, self.timeouts
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self.waits += 1
+                self.wait_total += elapsed
+                self.wait_max = max(self.wait_max, elapsed)
+
+
+def configure_engine(app):
+    '''在 db.init_app(app) 之前调用：开启统计时使用 TimedQueuePool
+
+    内存 SQLite 由 Flask-SQLAlchemy 强制使用 StaticPool，不受影响
+    '''
+    app.config.setdefault('SQLALCHEMY_POOL_METRICS', True)
+    app.config.setdefault('SQLALCHEMY_STREAM_RESULTS', False)
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    if app.config['SQLALCHEMY_POOL_METRICS']:
+        options.setdefault('poolclass', TimedQueuePool)
+    # 复制一份，不修改配置类上共用的字典
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def pool_stats():
+    '''每个数据库（bind）连接池的当前状态，key 为 bind 名，主库为 'default'
+
+    checked_out 为正在使用的连接数，overflow 为超出 pool_size 的连接数（可能为负，表示还没建满）
+    '''
+    stats = {}
+    for bind, engine in db.engines.items():
+        pool = engine.pool
+        item = {'pool': type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            item.update(size=pool.size(), checked_in=pool.checkedin(),
+                        checked_out=pool.checkedout(), overflow=pool.overflow())
+        if isinstance(pool, TimedQueuePool):
+            item.update(waits=pool.waits, timeouts=pool.timeouts,
+                        wait_avg_ms=round(pool.wait_total / pool.waits * 1000, 3) if pool.waits else 0.0,
+                        wait_max_ms=round(pool.wait_max * 1000, 3))
+        stats[bind or 'default'] = item
+    return stats
+
+
+def iter_chunks(query, key, chunk_size):
+    '''按 key（单调递增的主键列，且是 query 的第一列）分批读取 query 的结果，每次产出一批行'''
+    if current_app.config['SQLALCHEMY_STREAM_RESULTS']:
+        result = db.session.execute(query.order_by(key).execution_options(
+            stream_results=True, yield_per=chunk_size))
+        for rows in result.partitions():
+            yield rows
+        db.session.rollback()
+        return
+
+    after = None
+    while True:
+        page = query if after is None else query.where(key > after)
+        rows = db.session.execute(page.order_by(key).limit(chunk_size)).all()
+        if not rows:
+            return
+        # 读完就结束事务，避免长时间持有读事务
+        db.session.rollback()
+        after = rows[-1][0]
+        yield rows
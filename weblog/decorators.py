@@ -28,7 +28,8 @@ def permission_required(permission):
         def decorated_func(*args, **kwargs):
             '''包装后的函数，先检查权限再决定是否执行原始函数'''
             # 检查用户是否有指定权限
-            if not current_user.role.permissions & permission:
+            # 只是位运算，未登录的访客（AnonymousUser）没有任何权限
+            if not current_user.has_permission(permission):
                 flash('你这个号权限太低啦', 'warning')
                 return redirect(url_for('front.index'))
             # 有权限就执行原始函数
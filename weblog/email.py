@@ -1,52 +1,54 @@
-from flask import current_app, render_template, flash
-from flask_mail import Mail, Message
-from threading import Thread
+'''
+邮件的组装与发送
 
-def send_async_email(app, msg):
-    '''
-    该函数作为线程类实例化时 target 参数的值，在线程中执行
-    在单独的线程中发送邮件，防止 Flask 服务器因邮件发送而阻塞。
-
-    参数：
-        app (Flask): Flask 应用实例，需要手动提供应用上下文。
-        msg (Message): Flask-Mail 的 Message 对象，包含邮件内容。
-
-    运行流程：
-    1. 由于 Flask 线程默认不会继承应用上下文，因此需要手动创建上下文 `with app.app_context():`。
-    2. 在该上下文中实例化 Flask-Mail 并调用 `send(msg)` 发送邮件。
-    3. 该函数通常不会直接调用，而是作为 `Thread(target=send_async_email, args=(app, msg))` 的目标函数，
-       这样邮件发送就在一个单独的后台线程中进行，不影响 Flask 主线程的运行。
-
-    用法示例：
-        thread = Thread(target=send_async_email, args=(app, msg))
-        thread.start()
-    '''
+每个邮件模板由 email/<名称>.txt 和 email/<名称>.html 两个文件组成，
+第一次使用时编译好缓存起来，之后直接用编译好的模板渲染，
+不再每封邮件都走一遍 render_template（查找模板、执行上下文处理器、发送信号）。
+开启调试模式（app.debug）时不缓存，修改模板后立即生效。
 
-    with app.app_context():  # 确保在 Flask 应用上下文中运行
-        Mail(app).send(msg)  # 发送邮件
+注意：模板渲染时只能用到传入的变量和 url_for 等 Jinja 全局函数，
+current_user、request 等由上下文处理器注入的变量是没有的。
 
+组装好的邮件交给发送队列（weblog/mailqueue.py），由后台线程发送。
+'''
 
-def send_email(user, email, tmp, token):
-    '''
-    发送邮件的主函数，参数分别是：
-    当前登录用户, 收件人的邮箱, 前端文件名片段, token
-    '''
-    # 如果使用多线程，就不能用 current_app 了，它被看作是一个代理
-    # 类似 socket 服务器中的主套接字，每次接收请求后都要创建一个临时套接字去处理
-    # 此处使用 current_app 对象的 _get_curent_object 方法
-    # 新创建的临时应用对象 app 包含独立的上下文信息，交给子线程处理
+import logging
+
+from flask import current_app
+from flask_mail import Message
+
+from .mailqueue import mail_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+def email_templates(name):
+    '''返回编译好的 (纯文本模板, HTML 模板)'''
     app = current_app._get_current_object()
-    print(f"邮件发件人: {app.config.get('MAIL_DEFAULT_SENDER')}")
+    cache = app.extensions.setdefault('email_templates', {})
+    templates = cache.get(name)
+    if templates is None:
+        env = app.jinja_env
+        templates = (env.get_template('email/{}.txt'.format(name)),
+                     env.get_template('email/{}.html'.format(name)))
+        if not app.debug:
+            cache[name] = templates
+    return templates
 
+
+def compose(email, tmp, subject, **context):
+    '''用模板 tmp 组装一封发给 email 的邮件'''
+    text, html = email_templates(tmp)
     # Message 是一个类，它接收以下参数：
     # 1、默认参数 subject 字符串（邮件主题
     # 2、sender 字符串（发件人邮箱
     # 3、recipients 列表（收件人邮箱列表
     msg = Message(
-            'To: ' + user.name, # 邮件主题
-            sender = app.config.get('MAIL_DEFAULT_SENDER'), # 发件人邮箱
+            subject, # 邮件主题
+            sender = current_app.config.get('MAIL_DEFAULT_SENDER'), # 发件人邮箱
             recipients = [email]  # 收件人列表
-    ) 
+    )
 
     '''
     特性:
@@ -60,15 +62,41 @@ def send_email(user, email, tmp, token):
        - **可以减少垃圾邮件过滤的风险**，某些邮件服务器可能会屏蔽纯 HTML 邮件，但如果有 `msg.body`（纯文本版本），更容易通过审核。
     '''
 
-    msg.body = render_template('email/{}.txt'.format(tmp), user=user,
-            token=token)    # 纯文本文件
-    
-    msg.html = render_template('email/{}.html'.format(tmp), user=user,
-            token=token)    # HTML 文件
-    
-    print(msg)
-    
-    thread = Thread(target=send_async_email, args=(app, msg))
-    thread.start()          # 创建一个子线程并启动
-
-    return thread
+    msg.body = text.render(context)    # 纯文本
+    msg.html = html.render(context)    # HTML
+    return msg
+
+
+def send_email(user, email, tmp, token):
+    '''
+    发送邮件的主函数，参数分别是：
+    当前登录用户, 收件人的邮箱, 前端文件名片段, token
+    返回发送队列中的待发文件名
+    '''
+    msg = compose(email, tmp, 'To: ' + user.name, user=user, token=token)
+    logger.info('邮件 %s 发往 %s', tmp, email)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('邮件内容：\n%s', msg.body)
+    # 不再每封邮件开一个线程，交给发送队列：先写入待发目录，由后台线程复用 SMTP 连接发送，
+    # 失败会退避重试，见 weblog/mailqueue.py
+    return mail_queue.enqueue(msg)
+
+
+def send_many(recipients, tmp, context_fn):
+    '''
+    群发邮件（摘要、通知等），模板只编译一次
+    recipients 为用户对象序列，context_fn(user) 返回该用户的模板变量，
+    可以包含 subject 指定邮件主题，返回 None 时跳过该用户
+    返回发出的邮件数
+    '''
+    count = 0
+    for user in recipients:
+        context = context_fn(user)
+        if context is None:
+            continue
+        context.setdefault('user', user)
+        subject = context.pop('subject', None) or 'To: ' + user.name
+        mail_queue.enqueue(compose(user.email, tmp, subject, **context))
+        count += 1
+    logger.info('群发邮件 %s：%d 封', tmp, count)
+    return count
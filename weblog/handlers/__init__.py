@@ -1,4 +1,5 @@
 from .front import front
 from .user import user
+from .internal import internal
 
-blueprint_list = [front, user]
+blueprint_list = [front, user, internal]
@@ -1,13 +1,17 @@
 from flask import Blueprint, url_for, redirect, flash, abort, request
 from flask import render_template, current_app, make_response
 from flask_login import login_required, login_user, logout_user, current_user
-from datetime import datetime
 import hashlib
 
 from ..forms import RegisterForm, LoginForm, BlogForm, CommentForm
-from ..models import db, User, Blog, Comment, Permission, Tag
+from ..models import db, User, Blog, Comment, Permission, Tag, Timeline
 from ..email import send_email
 from ..decorators import moderate_required
+from ..presence import presence
+from ..queries import feed_query, comment_query
+from ..pagination import paginate, CursorPagination, encode_cursor, decode_cursor
+from ..cache import response_cache, tag_cloud
+from ..search import search_index
 
 
 front = Blueprint('front', __name__) # front.py - 主页相关
@@ -42,9 +46,9 @@ def gravatar_filter(email):
 
 
 @front.route('/', methods=['GET', 'POST'])
+@response_cache.cached('blogs', 'tags', 'users')
 def index():
     '''主页'''
-    date_time = datetime.utcnow()
     form = BlogForm()
     # 只要用户登录成功，就可以发表博客
     if current_user.is_authenticated and form.validate_on_submit():
@@ -52,34 +56,33 @@ def index():
         form.populate_obj(blog)
         blog.author = current_user
         db.session.add(blog)
+        # 先 flush 拿到博客 id，写进粉丝的时间线，与博客在同一个事务中提交
+        db.session.flush()
+        Timeline.fan_out(blog)
         db.session.commit()
         flash('发表成功', 'success')
         return redirect(url_for('.index'))
-    # 从 URL 参数中获取页码，默认为第 1 页
-    # 例如：/?page=2，如果没有 page 参数则返回 1
-    page = request.args.get('page', 1, type=int)
-
-    # 使用 SQLAlchemy 的 paginate 方法进行分页查询
-    pagination = Blog.query.order_by(Blog.time_stamp.desc()).paginate(
-            page=page,  # 当前页码
-            per_page=current_app.config['BLOGS_PER_PAGE'],  # 每页显示的博客数量
-            error_out=False  # 当页码超出范围时不报错，而是返回空列表
-    )
+    # 分页查询：默认从 URL 参数 ?page= 中获取页码（缺省为第 1 页），
+    # 启用游标分页时使用 ?after= / ?before= 参数，见 weblog/pagination.py
+    # feed_query 会预加载作者和标签，避免模板中逐篇查询
+    pagination = paginate(feed_query(), (Blog.time_stamp, Blog.id),
+                          per_page=current_app.config['BLOGS_PER_PAGE'],  # 每页显示的博客数量
+                          count_key='blogs')
 
     # 获取当前页的博客列表
     blogs = pagination.items
 
-    # 获取所有标签
-    tags = Tag.query.order_by(Tag.name).all()
+    # 侧边栏的标签云：最常用的若干标签 [(标签名, 博客数), ...]，有缓存
+    tags = tag_cloud.top()
     # 将分页对象和博客列表传递给模板
     return render_template('index.html', 
                          form=form,  # 发博客的表单
                          blogs=blogs,  # 当前页的博客列表
                          pagination=pagination, # 分页对象，用于生成分页导航
-                         date_time=date_time, 
                          tags=tags)
 
 @front.route('/blog/<int:id>', methods=['GET', 'POST'])
+@response_cache.cached('blog:{id}', 'users')
 def blog(id):
     '''博客详情页'''
     blog = Blog.query.get_or_404(id)
@@ -104,13 +107,10 @@ def blog(id):
         flash('评论发表成功', 'success')
         return redirect(url_for('.blog', id=blog.id))
     
-    page = request.args.get('page', 1, type=int)
-    pagination = blog.comments.order_by(Comment.time_stamp.desc()).paginate(
-        page=page,
-        per_page=10, # 暂时使用固定值
-        # per_page=current_app.config['COMMENTS_PER_PAGE'],
-        error_out=False
-    )
+    pagination = paginate(comment_query(blog), (Comment.time_stamp, Comment.id),
+                          per_page=10, # 暂时使用固定值
+                          # per_page=current_app.config['COMMENTS_PER_PAGE'],
+                          count_key='comments:{}'.format(blog.id))
     comments = pagination.items
     return render_template('blog.html', blogs=[blog], hidebloglink = True, noblank = True, form=form, comments=comments, pagination=pagination, Permission=Permission, author=blog.author)
 
@@ -179,8 +179,8 @@ def before_request():
     # current_user 默认为匿名用户，is_authenticated = False (default)
     # 用户登录后，current_user 为登录用户，is_autheticated = True
     if current_user.is_authenticated:        
-        # 执行此方法刷新【最后登录时间】
-        current_user.ping()
+        # 刷新【最后登录时间】，先记在内存里，由 presence 定时批量写入数据库
+        presence.touch(current_user)
         # 未验证的用户登录后要发出 POST 请求的话，让用户先通过验证
         # 如果用户未通过邮箱确认身份，且为 POST 请求
         if not current_user.confirmed and request.method == 'POST':
@@ -253,42 +253,68 @@ def delete_comment(id):
     return redirect(request.headers.get('Referer') or url_for('.index'))
 
 @front.route('/blogs')
+@response_cache.cached('blogs', 'users')
 def blogs():
     '''博客列表'''
-    page = request.args.get('page', 1, type=int)
-    pagination = Blog.query.order_by(Blog.time_stamp.desc()).paginate(
-        page=page,
-        per_page=current_app.config['BLOGS_PER_PAGE'],
-        error_out=False
-    )
+    pagination = paginate(feed_query(), (Blog.time_stamp, Blog.id),
+                          per_page=current_app.config['BLOGS_PER_PAGE'],
+                          count_key='blogs')
     blogs = pagination.items
     # 注意这里改用 blogs.html 模板
     return render_template('blog_list.html', 
                          blogs=blogs, 
                          pagination=pagination)
 
+@front.route('/timeline')
+@login_required
+def timeline():
+    '''我关注的人的博客，读写扩散时间线（User.followed_posts），只能向后翻页'''
+    per_page = current_app.config['BLOGS_PER_PAGE']
+    after = request.args.get('after')
+    cursor = decode_cursor(after) if after else None
+    # 多取一篇，用来判断是否还有下一页
+    blogs = current_user.followed_posts(per_page + 1, before=cursor)
+    has_next = len(blogs) > per_page
+    blogs = blogs[:per_page]
+    # 时间线不支持向前翻页，「上一页」回到第一页
+    pagination = CursorPagination(
+        None, blogs, per_page,
+        has_next=has_next, has_prev=cursor is not None,
+        next_cursor=encode_cursor(blogs[-1].time_stamp, blogs[-1].id) if has_next else None,
+        prev_cursor=None, count_key=None)
+    return render_template('timeline.html', blogs=blogs, pagination=pagination)
+
 @front.route('/tag/<name>')
+@response_cache.cached('blogs', 'tags', 'users')
 def tag(name):
     '''显示特定标签的博客'''
-    tag = Tag.query.filter_by(name=name).first()
-    blogs = tag.blogs.order_by(Blog.time_stamp.desc()).paginate(
-        page=request.args.get('page', 1, type=int),
-        per_page=10,
-        error_out=False
-    )
+    tag = Tag.query.filter_by(name=name).first_or_404()
+    blogs = paginate(feed_query(tag.blogs), (Blog.time_stamp, Blog.id),
+                     per_page=10,
+                     count_key='tag:{}'.format(tag.id))
     return render_template('tag.html', tag=tag, blogs=blogs, pagination=blogs)
 
 @front.route('/tags')
+@response_cache.cached('tags')
 def tags():
-    '''显示所有标签'''
-    tags = Tag.query.order_by(Tag.name).paginate(
+    '''显示所有标签，常用的标签排在前面'''
+    # 没有博客的标签等 flask sweep-tags 删除，这里不显示
+    tags = Tag.query.filter(Tag.blog_count > 0).order_by(Tag.blog_count.desc(), Tag.name).paginate(
         page=request.args.get('page', 1, type=int),
         per_page=10,
         error_out=False
     )
     return render_template('tags.html', tags=tags, pagination=tags)
 
+@front.route('/search')
+def search():
+    '''搜索博客和评论'''
+    q = request.args.get('q', '').strip()
+    results = search_index.results(q) if q else []
+    return render_template('search.html', q=q, results=results)
+
 @front.route('/about')
+@response_cache.cached()
 def about():
     '''关于'''
     return render_template('about.html')
\ No newline at end of file
@@ -0,0 +1,68 @@
+'''
+内部接口：运行指标等，只对带令牌的请求，或 METRICS_ALLOW_FROM 中的地址直接发来的请求开放
+'''
+
+import hmac
+
+from flask import Blueprint, abort, current_app, request, make_response, jsonify
+
+from ..database import pool_stats
+from ..replicas import replicas
+from ..metrics import request_metrics, labels
+from ..querywatch import query_watch
+
+
+internal = Blueprint('internal', __name__)
+
+# 反向代理转发请求时加上的请求头
+PROXY_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')
+
+
+@internal.before_request
+def restrict():
+    '''只允许请求头 X-Metrics-Token 与 METRICS_TOKEN 相同的请求，或 METRICS_ALLOW_FROM 中的地址直接发来的请求
+
+    应用在同一台机器上的反向代理后面时，所有外部请求的 remote_addr 都是 127.0.0.1，
+    所以带有代理请求头的请求不按地址放行，只认令牌
+    '''
+    config = current_app.config
+    token = config.get('METRICS_TOKEN')
+    given = request.headers.get('X-Metrics-Token')
+    if token and given and hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8')):
+        return None
+    if (request.remote_addr in config.get('METRICS_ALLOW_FROM', ())
+            and not any(name in request.headers for name in PROXY_HEADERS)):
+        return None
+    abort(404)
+
+
+@internal.route('/_metrics')
+def metrics():
+    '''Prometheus 文本格式的运行指标：各视图的耗时直方图（见 weblog/metrics.py）、
+    连接池状态（见 weblog/database.py）和从库的查询数（见 weblog/replicas.py）'''
+    lines = request_metrics.prometheus() + query_watch.prometheus()
+
+    pools = pool_stats()
+    for name, description in (('checked_out', '正在使用的连接数'), ('checked_in', '空闲的连接数'),
+                              ('overflow', '超出 pool_size 的连接数'), ('waits', '取连接的次数'),
+                              ('timeouts', '取连接超时的次数'), ('wait_max_ms', '取连接的最长等待（毫秒）')):
+        lines += ['# HELP weblog_db_pool_{} {}'.format(name, description),
+                  '# TYPE weblog_db_pool_{} {}'.format(name, 'counter' if name in ('waits', 'timeouts') else 'gauge')]
+        lines += ['weblog_db_pool_{}{} {}'.format(name, labels(bind=bind), stats[name])
+                  for bind, stats in sorted(pools.items()) if name in stats]
+
+    lines += ['# HELP weblog_replica_reads_total 在从库执行的查询数',
+              '# TYPE weblog_replica_reads_total counter']
+    lines += ['weblog_replica_reads_total{} {}'.format(labels(bind=bind), count)
+              for bind, count in sorted(replicas.stats()['reads'].items())]
+
+    response = make_response('\n'.join(lines) + '\n')
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+@internal.route('/_metrics/queries')
+def queries():
+    '''按视图列出重复查询、慢查询的语句和调用位置，见 weblog/querywatch.py'''
+    return jsonify(query_watch.report())
@@ -8,10 +8,11 @@ from flask import request, current_app
 from flask_login import login_required, current_user, login_user
 import flask_bootstrap
 
-from ..models import User, db, Role, Blog, Permission, Tag
+from ..models import User, db, Role, Blog, Permission, Follow, Timeline
 from ..forms import ProfileForm, AdminProfileForm, ChangePasswordForm, BeforeResetPasswordForm, ResetPasswordForm, ChangeEmailForm, BlogForm
 from ..decorators import admin_required
 from ..email import send_email
+from ..pagination import paginate
 
 user = Blueprint('user', __name__, url_prefix='/user') # URL 前缀，所有该蓝图的路由都会加上这个前缀
 
@@ -28,22 +29,13 @@ def index(name):
 @login_required
 def edit_profile():
     '''修改个人信息'''
-    print("=== 进入 edit_profile 函数 ===")
-    print(f"请求方法: {request.method}")
-    print(f"表单数据: {request.form}")  # 打印表单数据
-    
     form = ProfileForm(current_user, obj=current_user)
     if form.validate_on_submit():
-        print("表单验证通过")
         form.populate_obj(current_user)
         db.session.add(current_user)
         db.session.commit()
         flash('个人信息已更新', 'success')
         return redirect(url_for ('.index', name=current_user.name))
-    else:
-        print("表单验证失败")
-        print("表单错误:", form.errors)  # 打印表单错误
-    
     return render_template('user/edit_profile.html', form=form)
     
 
@@ -54,7 +46,6 @@ def admin_edit_profile(id):
     '''管理员修改用户信息'''
     user = User.query.get(id)
     form = AdminProfileForm(user, obj=user)
-    print("Hello")
     if form.validate_on_submit():
         form.populate_obj(user)
         db.session.add(user)
@@ -83,16 +74,8 @@ def before_reset_password():
     form = BeforeResetPasswordForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        token = user.generate_confirm_user_token()
-        
-        # 打印调试信息
-        print("\n=== 重置密码邮件信息 ===")
-        print(f"用户: {user.name}")
-        print(f"邮箱: {user.email}")
-        print(f"令牌: {token}")
-        print(f"邮件内容:")
-        print(render_template('email/reset_password.txt', user=user, token=token))
-        
+        token = user.generate_reset_token()
+        # 邮件内容在 DEBUG 日志级别下由 send_email 记录
         send_email(user, user.email, 'reset_password', token)
         flash('重置密码邮件已发送', 'success')
     return render_template('user/reset_password.html', form=form)
@@ -103,17 +86,16 @@ def before_reset_password():
 def reset_password(name, token):
     '''重置密码时，点击验证邮件中的链接时，用此视图函数处理'''
     user = User.query.filter_by(name=name).first()
-    if user and user.confirm_user(token):
+    # 令牌有效期见 TOKEN_RESET_MAX_AGE，重置成功后令牌作废
+    if user and user.verify_reset_token(token):
         form = ResetPasswordForm()
         if request.method == 'GET':
             flash('邮箱已确认，请重置密码')
             return render_template('user/reset_password.html', form=form)
-        if form.validate_on_submit():
-            user.password = form.password.data
-            db.session.add(user)
-            db.session.commit()
+        if form.validate_on_submit() and user.reset_password(token, form.password.data):
             flash('密码已更新', 'success')
             return redirect(url_for('.index', name=user.name))
+        return render_template('user/reset_password.html', form=form)
     flash('链接错误，请重试')
     return redirect(url_for('front.index'))
 
@@ -127,7 +109,7 @@ def change_email():
         current_user.confirmed = 0
         db.session.add(current_user)
         db.session.commit()
-        token = current_user.generate_confirm_user_token()
+        token = current_user.generate_change_email_token()
         send_email(current_user, current_user.email, 'change_email', token)
         flash('邮箱已更新，请验证新邮箱', 'success')
     return render_template('user/change_email.html', form=form)
@@ -137,12 +119,9 @@ def change_email():
 @login_required
 def confirm_change_email(token):
     '''变更邮箱时，验证新邮箱，邮箱中的链接用此视图函数处理'''
-    if current_user.confirmed(token):
-        current_user.confirmed = 1
-        db.session.add(current_user)
-        db.session.commit()
-        flash('邮箱已确认，请登录', 'success')
-        return redirect(url_for('.login', name=current_user.name))
+    if current_user.confirm_change_email(token):
+        flash('邮箱已确认', 'success')
+        return redirect(url_for('.index', name=current_user.name))
     flash('验证链接错误，请重试', 'danger')
     return redirect(url_for('front.index'))
 
@@ -173,8 +152,10 @@ def delete_blog(id):
     
     if request.method == 'POST':  # 只在 POST 请求时执行删除操作
         try:
+            Timeline.remove_blog(blog)
+            # models.update_tag_counts 只减少标签的 blog_count，不再被使用的标签
+            # 由 flask sweep-tags 删除（Tag.remove_unused）
             db.session.delete(blog)
-            Tag.remove_unused()
             db.session.commit()
             flash('博客已删除', 'success')
         except Exception as e:
@@ -192,11 +173,11 @@ def follow(name):
     if not user:
         flash('用户不存在', 'warning')
         return redirect(url_for('front.index'))
-    if current_user.is_following(user):
-        flash('已关注', 'info')
-    else:
-        current_user.follow(user)
+    # 是否已关注和关注在一条语句中完成
+    if current_user.follow(user):
         flash('关注成功！', 'success')
+    else:
+        flash('已关注', 'info')
     return redirect(url_for('.index', name=name))
 
 @user.route('/unfollow/<name>')
@@ -207,11 +188,10 @@ def unfollow(name):
     if not user:
         flash('用户不存在', 'warning')
         return redirect(url_for('front.index'))
-    if not current_user.is_following(user):
-        flash('用户未关注！', 'info')
-    else:
-        current_user.unfollow(user)
+    if current_user.unfollow(user):
         flash('取消关注成功！', 'success')
+    else:
+        flash('用户未关注！', 'info')
     return redirect(url_for('.index', name=name))
 
 @user.route('<name>/followed')
@@ -221,13 +201,11 @@ def followed(name):
     if not user:
         flash('用户不存在', 'warning')
         return redirect(url_for('front.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page=page,
-        # per_page=current_app.config['USERS_PER_PAGE'],
-        per_page=10, # 暂时使用固定值
-        error_out=False
-    )
+    pagination = paginate(user.followed, (Follow.time_stamp, Follow.followed_id),
+                          # per_page=current_app.config['USERS_PER_PAGE'],
+                          per_page=10, # 暂时使用固定值
+                          count_key='followed:{}'.format(user.id),
+                          total=user.followed_count)
 
     follows = []
     for follow in pagination.items:
@@ -248,13 +226,11 @@ def followers(name):
     if not user:
         flash('用户不存在', 'warning')
         return redirect(url_for('front.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page=page,
-        # per_page=current_app.config['USERS_PER_PAGE'],
-        per_page=10, # 暂时使用固定值
-        error_out=False
-    )
+    pagination = paginate(user.followers, (Follow.time_stamp, Follow.follower_id),
+                          # per_page=current_app.config['USERS_PER_PAGE'],
+                          per_page=10, # 暂时使用固定值
+                          count_key='followers:{}'.format(user.id),
+                          total=user.followers_count)
     follows = []
     for follow in pagination.items:
         follow_dict = {
@@ -277,6 +253,9 @@ def write_blog(name):
        
         blog.author = current_user
         db.session.add(blog)
+        # 先 flush 拿到博客 id，写进粉丝的时间线，与博客在同一个事务中提交
+        db.session.flush()
+        Timeline.fan_out(blog)
         db.session.commit()
 
         flash('发表成功', 'success')
@@ -0,0 +1,184 @@
+'''
+会话中的用户身份快照（可选，SESSION_IDENTITY = True 时启用）
+
+登录用户的每个请求都要经过 user_loader 查一次 user 表，而大多数只读页面只用到
+用户名和权限位。启用后，会话中额外保存一份签名的快照 (id, 用户名, 是否已验证, 角色 id, 权限位)，
+GET/HEAD 请求直接由快照恢复 current_user（SessionUser），不查数据库；
+访问快照中没有的属性或调用 follow() 等方法时，才按 id 加载完整的 User 对象，之后全部交给它处理。
+POST 等写请求始终加载完整的 User 对象。
+
+快照用 itsdangerous 的 TimedSerializer 签名，超过 SESSION_IDENTITY_MAX_AGE 秒即作废；
+用户的用户名、密码、邮箱、验证状态、角色变化（修改密码、管理员编辑资料等），
+或任何角色的权限变化并提交后，对应的「代」加一，旧快照随即作废（见文件末尾的 _collect_identity_changes），
+「代」复用整页缓存的机制保存，所以启用时必须使用多个进程共用的缓存后端
+（FRAGMENT_CACHE_BACKEND = 'shared'，并由 FRAGMENT_CACHE_CLIENT 连接 Redis 等外部服务）：
+进程内的后端中，其他工作进程看不到代的变化，会继续接受已作废的快照，进程重启后代也会回到初始值。
+'''
+
+from flask import request, session
+from flask_login import UserMixin, user_logged_out
+from itsdangerous import TimedSerializer, BadSignature
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .models import db, User, Role
+from .cache import response_cache, SharedBackend
+
+
+# 这些属性变化后，会话中的快照作废
+IDENTITY_ATTRS = ('name', 'email', '_password', 'confirmed', 'role_id')
+
+SESSION_KEY = '_identity'
+
+
+class SessionUser(UserMixin):
+    '''由会话快照恢复的当前用户，用法与 User 相同
+
+    快照中的属性直接返回；其他属性和方法在第一次用到时加载完整的 User 对象，
+    之后所有读写都转给这个对象
+    '''
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_user', None)
+
+    def _get_user(self):
+        user = self.__dict__['_user']
+        if user is None:
+            user = db.session.get(User, self._data['id'], options=[db.joinedload(User.role)])
+            object.__setattr__(self, '_user', user)
+        return user
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self.__dict__['_user'] is None and name in self.__dict__['_data']:
+            return self.__dict__['_data'][name]
+        return getattr(self._get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_user(), name, value)
+
+    @property
+    def permissions(self):
+        if self.__dict__['_user'] is not None:
+            return self._user.permissions
+        return self._data['permissions']
+
+    # 权限判断与 User 相同，只是位运算
+    has_permission = User.has_permission
+    is_administrator = User.is_administrator
+    is_moderator = User.is_moderator
+
+    def __repr__(self):
+        return '<SessionUser: {}>'.format(self._data['name'])
+
+
+class SessionIdentity:
+    '''会话身份快照，用法与 Flask 扩展相同：session_identity.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.serializer = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SESSION_IDENTITY', False)
+        app.config.setdefault('SESSION_IDENTITY_MAX_AGE', 300)
+        self.app = app
+        # 须在 response_cache.init_app(app) 之后调用；代只保存在进程内时快照无法可靠作废，拒绝启用。
+        # 测试时没有外部服务，允许使用 LocalSharedClient
+        shared = isinstance(response_cache.backend, SharedBackend) and (
+            app.config.get('FRAGMENT_CACHE_CLIENT') is not None or app.testing)
+        if app.config['SESSION_IDENTITY'] and not shared:
+            raise RuntimeError("SESSION_IDENTITY 需要多个进程共用的缓存后端："
+                               "请设置 FRAGMENT_CACHE_BACKEND = 'shared' 和 FRAGMENT_CACHE_CLIENT")
+        self.serializer = TimedSerializer(app.config['SECRET_KEY'], salt='session-identity')
+        app.extensions['session_identity'] = self
+        user_logged_out.connect(self._forget, app)
+
+    @staticmethod
+    def generations(user_id):
+        return [response_cache.generation('identity:{}'.format(user_id)),
+                response_cache.generation('roles')]
+
+    def load_user(self, user_id):
+        '''供 login_manager.user_loader 使用：快照有效时返回 SessionUser，否则查询数据库'''
+        user_id = int(user_id)
+        if not self.app.config['SESSION_IDENTITY']:
+            return self._query(user_id)
+
+        data = self._verify(user_id)
+        if data is not None and request.method in ('GET', 'HEAD'):
+            self.hits += 1
+            return SessionUser(data)
+
+        self.misses += 1
+        user = self._query(user_id)
+        if user is not None and data is None:
+            self.issue(user)
+        return user
+
+    def issue(self, user):
+        '''把用户的快照写进会话'''
+        data = {'id': user.id, 'name': user.name, 'confirmed': bool(user.confirmed),
+                'role_id': user.role_id, 'permissions': user.permissions,
+                'gen': self.generations(user.id)}
+        session[SESSION_KEY] = self.serializer.dumps(data)
+
+    @staticmethod
+    def _query(user_id):
+        # 用主键查询，同时 JOIN 角色，之后判断权限时不用再单独查 Role
+        return db.session.get(User, user_id, options=[db.joinedload(User.role)])
+
+    def _verify(self, user_id):
+        '''返回有效的快照数据，签名错误、过期、不属于该用户或「代」已变化时返回 None'''
+        token = session.get(SESSION_KEY)
+        if not token:
+            return None
+        try:
+            data = self.serializer.loads(token, max_age=self.app.config['SESSION_IDENTITY_MAX_AGE'])
+        except BadSignature:  # SignatureExpired 是它的子类
+            return None
+        if data.get('id') != user_id or data.get('gen') != self.generations(user_id):
+            return None
+        data.pop('gen')
+        return data
+
+    @staticmethod
+    def _forget(app, user=None):
+        session.pop(SESSION_KEY, None)
+
+
+session_identity = SessionIdentity()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_identity_changes(session, flush_context):
+    '''记下身份信息变化的用户和角色，提交后让对应的快照作废'''
+    names = set()
+    for obj in (*session.dirty, *session.deleted):
+        if isinstance(obj, User):
+            state = inspect(obj)
+            if obj in session.deleted or any(
+                    state.attrs[attr].history.has_changes() for attr in IDENTITY_ATTRS):
+                names.add('identity:{}'.format(obj.id))
+    if any(isinstance(obj, Role) for obj in (*session.dirty, *session.deleted)):
+        names.add('roles')
+    if names:
+        session.info.setdefault('identity_changes', set()).update(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_identities(session):
+    names = session.info.pop('identity_changes', None)
+    if names and response_cache.backend is not None:
+        response_cache.invalidate(*names)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_identity_changes(session):
+    session.info.pop('identity_changes', None)
@@ -0,0 +1,311 @@
+'''
+邮件发送队列
+
+原先 send_email 每封邮件都新开一个线程、新建一个 Mail(app)、重新连一次 SMTP 服务器，
+发送失败就丢了；注册高峰时线程数和 SMTP 握手次数都没有上限。
+这里改为：
+- 邮件先写进磁盘上的待发目录（MAIL_QUEUE_DIR/pending，一封一个 JSON 文件），进程重启不丢失；
+- 文件名放进有界队列（MAIL_QUEUE_SIZE），队列满了也没关系，文件还在待发目录里，
+  后台线程空闲时每 MAIL_QUEUE_POLL_INTERVAL 秒扫描一次待发目录补发；
+- 固定 MAIL_QUEUE_WORKERS 个后台线程，每次取最多 MAIL_QUEUE_BATCH 封，
+  共用一个 SMTP 连接（Flask-Mail 的 mail.connect()）发送；
+- 发送失败的邮件按 MAIL_QUEUE_BACKOFF * 2^(n-1) 秒退避后重试，
+  重试 MAIL_QUEUE_RETRIES 次仍失败的移到 failed 目录，留给人工处理。
+
+多个进程共用同一个目录时，用 os.rename 把文件从 pending 移到 claimed 来"认领"，
+rename 是原子操作，同一封邮件只会被一个线程发送；
+认领文件名带有认领进程的进程号和启动标识，进程崩溃时留在 claimed 里的文件，
+在启动时和后台线程扫描待发目录时移回 pending（见 _recover），待发目录不为空时启动后立即开始发送。
+'''
+
+import os
+import json
+import uuid
+import time
+import queue
+import atexit
+import random
+import shutil
+import logging
+import smtplib
+import tempfile
+import threading
+
+from flask_mail import Message
+
+
+logger = logging.getLogger(__name__)
+
+# 持久化时保存的 Message 字段
+FIELDS = ('subject', 'sender', 'recipients', 'body', 'html', 'cc', 'bcc', 'reply_to')
+
+
+def dump_message(msg):
+    return {field: getattr(msg, field) for field in FIELDS}
+
+
+def load_message(data):
+    return Message(**{field: data.get(field) for field in FIELDS})
+
+
+class MailQueue:
+    '''邮件发送队列，用法与 Flask 扩展相同：mail_queue.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.dir = None
+        self._queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # 本次启动的标识，与进程号一起写进认领文件名；进程号可能被复用（例如容器里重启后总是同一个），标识不会
+        self._boot = uuid.uuid4().hex[:12]
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_QUEUE_ENABLED', True)
+        app.config.setdefault('MAIL_QUEUE_DIR', None)
+        app.config.setdefault('MAIL_QUEUE_SIZE', 1000)
+        app.config.setdefault('MAIL_QUEUE_WORKERS', 2)
+        app.config.setdefault('MAIL_QUEUE_BATCH', 50)
+        app.config.setdefault('MAIL_QUEUE_RETRIES', 5)
+        app.config.setdefault('MAIL_QUEUE_BACKOFF', 30)
+        app.config.setdefault('MAIL_QUEUE_POLL_INTERVAL', 5)
+        app.config.setdefault('MAIL_QUEUE_CLAIM_TIMEOUT', 600)
+        self.app = app
+        app.extensions['mail_queue'] = self
+        self.dir = app.config['MAIL_QUEUE_DIR']
+        if not self.dir and app.testing:
+            # 测试时每个应用使用自己的临时目录，进程退出时删除（atexit 后注册的先执行，stop 在删除之前）
+            self.dir = tempfile.mkdtemp(prefix='weblog-mail-')
+            atexit.register(shutil.rmtree, self.dir, True)
+        elif not self.dir:
+            self.dir = os.path.join(app.instance_path, 'mail-spool')
+        self._queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        if app.config['MAIL_QUEUE_ENABLED']:
+            for name in ('pending', 'claimed', 'failed'):
+                os.makedirs(os.path.join(self.dir, name), exist_ok=True)
+            self._recover()
+            atexit.register(self.stop)
+            # 后台线程原本在第一次 enqueue 时才启动；重启前没发完的邮件（包括刚从 claimed 移回的）
+            # 不能等到有新邮件才发，待发目录不为空时现在就启动
+            if any(not name.startswith('.') for name in os.listdir(os.path.join(self.dir, 'pending'))):
+                self._ensure_workers()
+
+    def enqueue(self, msg):
+        '''把邮件放进发送队列，返回待发文件名；关闭队列时直接同步发送，返回 None'''
+        if not self.app.config['MAIL_QUEUE_ENABLED']:
+            self.app.extensions['mail'].send(msg)
+            return None
+
+        name = self._write(dump_message(msg), attempts=0, due=time.time())
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait(name)
+        except queue.Full:
+            # 文件已经写进待发目录，后台线程扫描时会发出去
+            logger.warning('邮件队列已满，%s 等待后台扫描补发', name)
+        return name
+
+    def pending(self):
+        '''待发（含等待重试）和正在发送的邮件数'''
+        return sum(len(os.listdir(os.path.join(self.dir, name)))
+                   for name in ('pending', 'claimed'))
+
+    def join(self, timeout=None):
+        '''等待待发目录清空（测试和基准脚本用），返回是否已清空'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self._ensure_workers()
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        '''通知后台线程退出；没发完的邮件留在待发目录，下次启动后继续发送'''
+        self._stopped.set()
+        for _ in self._workers:
+            try:
+                self._queue.put_nowait(None)  # 唤醒阻塞在队列上的线程
+            except queue.Full:
+                break
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._workers = []
+
+    # 以下为内部实现
+
+    def _path(self, state, name):
+        return os.path.join(self.dir, state, name)
+
+    def _write(self, data, attempts, due, id=None):
+        '''写入待发目录，文件名以计划发送时间开头，扫描时按文件名就能判断是否到期'''
+        data = dict(data, attempts=attempts)
+        name = '{:015d}-{}.json'.format(int(due * 1000), id or uuid.uuid4().hex)
+        # 先写临时文件再改名，扫描时不会读到写了一半的文件
+        tmp = self._path('pending', '.' + name)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.rename(tmp, self._path('pending', name))
+        return name
+
+    def _owner(self):
+        '''认领文件名的前缀：进程号-启动标识（fork 出的子进程标识相同，进程号不同）'''
+        return '{}-{}'.format(os.getpid(), self._boot)
+
+    def _claim(self, name):
+        '''把待发文件移到 claimed 目录，返回 (文件路径, 邮件数据)；已被别人认领时返回 None'''
+        path = self._path('claimed', '{}.{}'.format(self._owner(), name))
+        try:
+            os.rename(self._path('pending', name), path)
+        except FileNotFoundError:
+            return None
+        # rename 不改修改时间，这里记下认领的时间，_recover 据此判断认领是否超时
+        os.utime(path)
+        with open(path, encoding='utf-8') as f:
+            return path, json.load(f)
+
+    def _recover(self):
+        '''把失效的认领移回待发目录
+
+        以下认领视为失效：进程号是本进程但启动标识不同（进程号被复用，之前的进程已经退出）、
+        认领的进程已经不存在、认领超过 MAIL_QUEUE_CLAIM_TIMEOUT 秒仍未发完
+        （进程号被其他进程复用，或者认领的进程卡住了）
+        '''
+        owner = self._owner()
+        expired = time.time() - self.app.config['MAIL_QUEUE_CLAIM_TIMEOUT']
+        for filename in os.listdir(os.path.join(self.dir, 'claimed')):
+            prefix, _, name = filename.partition('.')
+            if prefix == owner:
+                continue
+            pid = prefix.partition('-')[0]
+            if not pid.isdigit():
+                continue
+            path = self._path('claimed', filename)
+            try:
+                if int(pid) != os.getpid() and _alive(int(pid)) and os.path.getmtime(path) > expired:
+                    continue
+                os.rename(path, self._path('pending', name))
+            except FileNotFoundError:
+                pass
+
+    def _due(self, limit):
+        '''扫描待发目录，返回最多 limit 个已到发送时间的文件名'''
+        now = '{:015d}'.format(int(time.time() * 1000))
+        names = sorted(os.listdir(os.path.join(self.dir, 'pending')))
+        return [name for name in names if not name.startswith('.') and name[:15] <= now][:limit]
+
+    def _ensure_workers(self):
+        if len(self._workers) >= self.app.config['MAIL_QUEUE_WORKERS']:
+            return
+        with self._lock:
+            self._stopped.clear()
+            while len(self._workers) < self.app.config['MAIL_QUEUE_WORKERS']:
+                worker = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        config = self.app.config
+        while not self._stopped.is_set():
+            names = []
+            try:
+                names.append(self._queue.get(timeout=config['MAIL_QUEUE_POLL_INTERVAL']))
+            except queue.Empty:
+                pass
+            while len(names) < config['MAIL_QUEUE_BATCH']:
+                try:
+                    names.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if len(names) < config['MAIL_QUEUE_BATCH'] and self._queue.empty():
+                # 队列里没有了，再看看待发目录：队列满时溢出的、到期重试的、重启前留下的，
+                # 以及其他进程退出后留在 claimed 里的
+                self._recover()
+                names.extend(self._due(config['MAIL_QUEUE_BATCH'] - len(names)))
+            names = [name for name in dict.fromkeys(names) if name]
+            claimed = [item for item in map(self._claim, names) if item]
+            if claimed:
+                try:
+                    self._deliver(claimed)
+                except Exception:
+                    logger.exception('邮件发送线程出错')
+
+    def _deliver(self, claimed):
+        '''用同一个 SMTP 连接发送一批邮件'''
+        mail = self.app.extensions['mail']
+        with self.app.app_context():
+            try:
+                connection = mail.connect()
+                connection.__enter__()
+            except (smtplib.SMTPException, OSError) as e:
+                logger.warning('连接 SMTP 服务器失败：%s', e)
+                for path, data in claimed:
+                    self._retry(path, data, e)
+                return
+
+            try:
+                for i, (path, data) in enumerate(claimed):
+                    try:
+                        connection.send(load_message(data))
+                    except Exception as e:
+                        if _disconnected(e):
+                            # 连接断了，这一批剩下的都放回去等下次重试
+                            for path, data in claimed[i:]:
+                                self._retry(path, data, e)
+                            return
+                        # 服务器暂时拒收、收件人被拒、邮件格式有误等，只影响这一封
+                        self._retry(path, data, e)
+                        continue
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        # 发送太久，认领超时后已被放回待发目录（见 _recover），那边会再发一次
+                        pass
+                    self.sent += 1
+            finally:
+                try:
+                    connection.__exit__(None, None, None)
+                except (smtplib.SMTPException, OSError):
+                    pass
+
+    def _retry(self, path, data, error):
+        attempts = data.get('attempts', 0) + 1
+        name = os.path.basename(path).partition('.')[2]
+        if attempts >= self.app.config['MAIL_QUEUE_RETRIES']:
+            os.rename(path, self._path('failed', name))
+            self.failed += 1
+            logger.error('邮件 %s 发送 %d 次均失败，已移到 failed 目录：%s', name, attempts, error)
+            return
+        # 指数退避，加一点随机量，避免同一时间失败的邮件又同时重试
+        delay = self.app.config['MAIL_QUEUE_BACKOFF'] * 2 ** (attempts - 1)
+        delay *= random.uniform(1, 1.25)
+        self._write(data, attempts, time.time() + delay, id=name[16:-5])
+        os.remove(path)
+        self.retried += 1
+        logger.info('邮件 %s 第 %d 次发送失败，%.0f 秒后重试：%s', name, attempts, delay, error)
+
+
+def _disconnected(error):
+    '''SMTP 连接是否已不可用（SMTPException 也是 OSError 的子类，要区分开）'''
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+mail_queue = MailQueue()
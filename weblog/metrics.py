@@ -0,0 +1,202 @@
+'''
+每个请求的耗时统计：SQL 条数、SQL 耗时、模板渲染耗时、总耗时
+
+- SQL：监听所有 Engine 的 before_cursor_execute / after_cursor_execute（主库和从库都算）；
+- 模板：Flask 的 before_render_template / template_rendered 信号，模板中嵌套调用的
+  render_template（例如博客卡片的片段缓存）只算最外层一次，模板渲染期间执行的 SQL
+  （延迟加载关系等）计入 SQL 耗时，不重复计入模板耗时；
+- 总耗时：从 before_request 到 after_request。
+
+每个响应带上 Server-Timing 头，浏览器开发者工具的「网络 → 时间」中可以直接看到：
+    Server-Timing: db;dur=3.2;desc="5 queries", tpl;dur=8.1, total;dur=14.0
+同时按 (视图, 请求方法) 汇总进内存中的直方图，由 /_metrics 以 Prometheus 文本格式输出
+（见 weblog/handlers/internal.py）。直方图在每个进程内，多进程部署时由 Prometheus 分别抓取再汇总。
+'''
+
+import time
+import threading
+from collections import defaultdict
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# 耗时直方图的桶（秒）和 SQL 条数直方图的桶
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    '''固定分桶的直方图，只记录每个桶的个数、总和和总数'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''[(上界, 小于等于上界的个数), ...]，最后一项为 +Inf'''
+        total, result = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        result.append(('+Inf', self.count))
+        return result
+
+
+class RequestStats:
+    '''当前请求的统计，保存在 g.request_stats 中'''
+
+    __slots__ = ('start', 'queries', 'db_time', 'template_time', 'template_depth', 'template_start')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_start = None  # (开始时间, 开始时的 SQL 耗时)
+
+
+def current_stats():
+    '''当前请求的统计，不在请求中或没有启用时返回 None'''
+    if not has_request_context():
+        return None
+    return g.get('request_stats')
+
+
+class RequestMetrics:
+    '''请求耗时统计，用法与 Flask 扩展相同：request_metrics.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_SERVER_TIMING', True)
+        self.app = app
+        app.extensions['request_metrics'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        # 扩展在蓝图之前注册，这里的 before_request 先于加载当前用户等其他处理执行
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+
+    def reset(self):
+        with self._lock:
+            # (视图, 请求方法) -> 直方图；(视图, 请求方法, 状态码) -> 请求数
+            self.duration = defaultdict(lambda: Histogram(TIME_BUCKETS))
+            self.db_time = defaultdict(lambda: Histogram(TIME_BUCKETS))
+            self.template_time = defaultdict(lambda: Histogram(TIME_BUCKETS))
+            self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+            self.requests = defaultdict(int)
+
+    @staticmethod
+    def _start():
+        g.request_stats = RequestStats()
+
+    def _finish(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        total = time.perf_counter() - stats.start
+        key = (request.endpoint or 'none', request.method)
+        with self._lock:
+            self.duration[key].observe(total)
+            self.db_time[key].observe(stats.db_time)
+            self.template_time[key].observe(stats.template_time)
+            self.queries[key].observe(stats.queries)
+            self.requests[key + (response.status_code,)] += 1
+        if self.app.config['METRICS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                'db;dur={:.1f};desc="{} queries", tpl;dur={:.1f}, total;dur={:.1f}'.format(
+                    stats.db_time * 1000, stats.queries, stats.template_time * 1000, total * 1000))
+        return response
+
+    @staticmethod
+    def _template_started(app, template, context, **extra):
+        stats = current_stats()
+        if stats is None:
+            return
+        if stats.template_depth == 0:
+            stats.template_start = (time.perf_counter(), stats.db_time)
+        stats.template_depth += 1
+
+    @staticmethod
+    def _template_finished(app, template, context, **extra):
+        stats = current_stats()
+        if stats is None or stats.template_depth == 0:
+            return
+        stats.template_depth -= 1
+        if stats.template_depth == 0:
+            start, db_time = stats.template_start
+            stats.template_time += time.perf_counter() - start - (stats.db_time - db_time)
+
+    def prometheus(self):
+        '''以 Prometheus 文本格式输出所有直方图和计数'''
+        lines = []
+        with self._lock:
+            lines += histogram_lines('weblog_request_duration_seconds', '请求总耗时（秒）', self.duration)
+            lines += histogram_lines('weblog_request_db_seconds', '请求中 SQL 的总耗时（秒）', self.db_time)
+            lines += histogram_lines('weblog_request_template_seconds', '请求中模板渲染的耗时（秒），不含其中的 SQL',
+                                     self.template_time)
+            lines += histogram_lines('weblog_request_queries', '请求中执行的 SQL 条数', self.queries)
+            lines += ['# HELP weblog_requests_total 请求数',
+                      '# TYPE weblog_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append('weblog_requests_total{} {}'.format(
+                    labels(endpoint=endpoint, method=method, status=status), count))
+        return lines
+
+
+request_metrics = RequestMetrics()
+
+
+def labels(**values):
+    '''{name="value",...}，按 Prometheus 的规则转义'''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in values.items()) + '}'
+
+
+def histogram_lines(name, description, histograms):
+    lines = ['# HELP {} {}'.format(name, description), '# TYPE {} histogram'.format(name)]
+    for (endpoint, method), hist in sorted(histograms.items()):
+        for bound, count in hist.cumulative():
+            lines.append('{}_bucket{} {}'.format(name, labels(endpoint=endpoint, method=method, le=bound), count))
+        lines.append('{}_sum{} {:.6f}'.format(name, labels(endpoint=endpoint, method=method), hist.sum))
+        lines.append('{}_count{} {}'.format(name, labels(endpoint=endpoint, method=method), hist.count))
+    return lines
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # 开始时间记在这次执行的 context 上，语句出错时不会留下残余
+    if context is not None and current_stats() is not None:
+        context._weblog_query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    start = getattr(context, '_weblog_query_start', None)
+    if stats is None or start is None:
+        return
+    stats.queries += 1
+    stats.db_time += time.perf_counter() - start
@@ -1,19 +1,25 @@
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import UserMixin
+from flask_login import UserMixin, AnonymousUserMixin
 from flask import current_app
-from itsdangerous import TimedSerializer as Serializer  # 使用 TimedSerializer
-from itsdangerous import BadSignature
-from datetime import datetime
-from markdown import markdown
-from markdown.extensions import codehilite, fenced_code
+from datetime import datetime, timedelta
 import enum
+import time
 import hashlib
-import bleach
-from sqlalchemy import event
-from bleach.css_sanitizer import CSSSanitizer
+from collections import defaultdict, Counter
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 
-db = SQLAlchemy()
+from .rendering import renderer
+from .tagcache import tag_ids
+from .permissions import role_permissions
+from .tokens import tokens
+from .replicas import RoutingSession
+
+# RoutingSession：只读请求的查询可以交给从库，见 weblog/replicas.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 blog_tags = db.Table('blog_tags',
     db.Column('blog_id', db.Integer, db.ForeignKey('blog.id'), primary_key=True),
@@ -22,6 +28,57 @@ blog_tags = db.Table('blog_tags',
 
 
 
+def insert_ignore(table, rows, column):
+    '''用一条语句插入多行，主键或唯一键冲突的行跳过，返回实际插入的行的 column 值集合
+
+    SQLite、PostgreSQL 使用 INSERT ... ON CONFLICT DO NOTHING RETURNING，MySQL 使用 INSERT IGNORE。
+    不支持 RETURNING 时只执行 INSERT，由 rowcount 得到插入的行数，全部插入或全部跳过时不再查询；
+    只插入了一部分时再用一条不加锁的 SELECT 查出这些行，库中各列的值与要插入的值完全相同的算作本次插入的
+    （两个请求同时插入完全相同的行时无法区分，例如只有 name 的标签，这时都算作本次插入的）。
+    不在插入前用 SELECT ... FOR UPDATE 锁定已存在的行：MySQL 上它会加间隙锁，并发插入时容易死锁
+    '''
+    dialect = db.session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect.name == 'mysql':
+        stmt = mysql.insert(table).prefix_with('IGNORE')
+    else:
+        stmt = sqlite.insert(table).on_conflict_do_nothing()
+    stmt = stmt.values(rows)
+    if dialect.insert_returning:
+        return set(db.session.execute(stmt.returning(column)).scalars())
+    inserted = db.session.execute(stmt).rowcount
+    if inserted >= len(rows):
+        return {row[column.name] for row in rows}
+    if inserted <= 0:
+        return set()
+    # 按冲突的列查找；行中带有主键列时（例如 follows 的双主键）一起作为条件，
+    # 标签这样只有 name、没有 id 的行只按 name 查找
+    keys = [column] + [col for col in table.primary_key.columns if col.name in rows[0] and col is not column]
+    condition = (column.in_([row[column.name] for row in rows]) if len(keys) == 1 else
+                 db.tuple_(*keys).in_([tuple(row[col.name] for col in keys) for row in rows]))
+    names = list(rows[0])
+    sent = {tuple(row[name] for name in names) for row in rows}
+    stored = db.session.execute(db.select(*[table.c[name] for name in names]).where(condition)).all()
+    return {row._mapping[column.name] for row in stored if tuple(row) in sent}
+
+
+def update_counts(connection, table, deltas):
+    '''按 {行 id: {计数列名: 增量}} 加减 table 中的计数列
+
+    使用 UPDATE 表 SET 列 = 列 + 增量，由数据库保证并发时不丢失更新；
+    增量相同的行合并为一条 UPDATE ... WHERE id IN (...)
+    '''
+    groups = defaultdict(list)
+    for id, columns in deltas.items():
+        key = tuple(sorted((name, delta) for name, delta in columns.items() if delta))
+        if key:
+            groups[key].append(id)
+    for key, ids in groups.items():
+        values = {name: table.c[name] + delta for name, delta in key}
+        connection.execute(table.update().where(table.c.id.in_(ids)).values(values))
+
+
 class Gender(enum.Enum):
     '''性别类, Role 类 gender 属性要用到此类'''
     MALE = '男'
@@ -92,6 +149,13 @@ class User(db.Model, UserMixin):
 
     confirmed = db.Column(db.Boolean, default=False) # 用于验证user是否已经通过邮箱验证，缺省值为 False
 
+    # 冗余保存的粉丝数、关注数、博客数，页面上直接读取，不用每次 COUNT(*)
+    # 关注/取消关注、发表/删除博客时在同一事务中原子地加减，见 update_user_counts 和 update_counts
+    # 数据不一致时执行 flask repair-counters 重新统计
+    followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False, index=True)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    blogs_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
     # 此属性为「我关注了谁」，属性值为查询对象，里面是 Follow 类的实例
     # 参数 foreign_keys 意为查询 User.id 值等于 Follow.follower_id 的数据
     followed = db.relationship('Follow', foreign_keys=[Follow.follower_id],
@@ -173,85 +237,96 @@ class User(db.Model, UserMixin):
         """
         return '<User: {}>'.format(self.name)
     
-    # 当前用户类的实例的 serializer 属性值即为令牌生成器
-    @property
-    def serializer(self):
-        """
-        创建用于生成和解析 Token 的 Serializer（令牌生成器）。
-
-        - `SECRET_KEY` 作为加密密钥，确保 Token 只能由相同密钥解密。
-        - `dumps(data)` 生成 Token，`loads(token)` 解析 Token。
-        - **如果 `SECRET_KEY` 变了，所有之前生成的 Token 都无法解析！**
-        """
-        return Serializer(secret_key=current_app.config['SECRET_KEY'])
-
+    # 令牌的生成和验证由 weblog/tokens.py 中的 tokens 负责，
+    # 不同用途的令牌使用不同的盐和有效期，不能混用
     def generate_confirm_user_token(self):
         """
         生成邮箱验证 Token，包含当前用户 ID。
 
-        - `self.serializer.dumps({'confirm_user': self.id})` 生成 Token。
         - 生成的 Token **只能用相同 `SECRET_KEY` 解密**，否则解析失败。
-        - 这个 Token 可用于邮箱验证、账号激活等功能。
+        - 有效期为 TOKEN_CONFIRM_MAX_AGE 秒。
         """
-        return self.serializer.dumps({'confirm_user': self.id})
+        return tokens.generate('confirm', confirm_user=self.id)
 
     def confirm_user(self, token):
         """
         验证 Token 是否有效，并确认用户身份。
 
-        - `loads(token)` 解析 Token，检查数据是否匹配当前用户 ID。
-        - **如果 `SECRET_KEY` 变了，Token 解析会失败（BadSignature 异常）。**
-        - **如果 Token 过期或被篡改，解析也会失败。**
-        - 解析成功后，设置 `self.confirmed = True` 并更新数据库。
+        - **如果 Token 过期或被篡改，解析失败，返回 False。**
+        - 解析成功后，设置 `self.confirmed = True` 并更新数据库；
+          已经验证过的用户（例如重复点击链接）直接返回 True，不再写数据库。
         """
-        try:
-            data = self.serializer.loads(token)  # 解析 Token
-        except BadSignature:  # Token 可能被篡改或密钥不匹配
+        data = tokens.verify('confirm', token)
+        if not data or data.get('confirm_user') != self.id:  # 确保 Token 归属当前用户
             return False
+        if not self.confirmed:
+            self.confirmed = True  # 认证成功，标记用户为已验证
+            db.session.add(self)
+            db.session.commit()
+        return True
 
-        if data.get('confirm_user') != self.id:  # 确保 Token 归属当前用户
-            return False
+    def _password_fingerprint(self):
+        '''当前密码哈希的指纹，放进重置密码令牌，密码改过之后旧令牌自动失效'''
+        return hashlib.sha256((self._password or '').encode()).hexdigest()[:16]
+
+    def generate_reset_token(self):
+        '''生成重置密码的令牌，有效期为 TOKEN_RESET_MAX_AGE 秒，只能使用一次'''
+        return tokens.generate('reset', reset=self.id, password=self._password_fingerprint())
+
+    def verify_reset_token(self, token):
+        data = tokens.verify('reset', token)
+        return bool(data) and data.get('reset') == self.id \
+            and data.get('password') == self._password_fingerprint()
 
-        self.confirmed = True  # 认证成功，标记用户为已验证
+    def reset_password(self, token, password):
+        '''用令牌重置密码，成功返回 True'''
+        if not self.verify_reset_token(token):
+            return False
+        self.password = password
         db.session.add(self)
         db.session.commit()
+        tokens.consume('reset', token)
+        return True
+
+    def generate_change_email_token(self):
+        '''生成验证新邮箱的令牌，令牌中带着新邮箱，用户再次更换邮箱后旧令牌失效'''
+        return tokens.generate('change-email', change_email=self.id, email=self.email)
+
+    def confirm_change_email(self, token):
+        '''验证新邮箱，成功返回 True'''
+        data = tokens.verify('change-email', token)
+        if not data or data.get('change_email') != self.id or data.get('email') != self.email:
+            return False
+        if not self.confirmed:
+            self.confirmed = True
+            db.session.add(self)
+            db.session.commit()
         return True
 
+    @property
+    def permissions(self):
+        '''角色的权限位掩码，优先从进程内缓存读取，见 weblog/permissions.py'''
+        permissions = role_permissions.get(self.role_id)
+        if permissions is None:
+            # user_loader 已经把角色 JOIN 进来，这里不会再查数据库
+            permissions = (self.role.permissions or 0) if self.role else 0
+            if self.role_id is not None:
+                role_permissions.set(self.role_id, permissions)
+        return permissions
+
     @property
     def is_administrator(self):
         '''判断用户是否是管理员'''
-        result = self.role.permissions & Permission.ADMINISTER
-        if result:
-            print(f"用户 {self.name} 有管理员权限 (权限值: {result})")
-        else:
-            print(f"用户 {self.name} 没有管理员权限 (权限值: {result})")
-        return result
+        return self.has_permission(Permission.ADMINISTER)
     
     @property
     def is_moderator(self):
         '''判断用户是否是协管员'''
-        result = self.role.permissions & Permission.MODERATE
-        print(f"用户 {self.name}:")
-        print(f"- 当前角色: {self.role.name}")
-        print(f"- 协管员权限: {'是' if result else '否'} (权限值: {result})")
-        return result
+        return self.has_permission(Permission.MODERATE)
     
     def has_permission(self, permission):
-        '''判断用户是否有指定权限'''
-        result = self.role.permissions & permission
-        permission_name = {
-            Permission.FOLLOW: "关注",
-            Permission.COMMENT: "评论",
-            Permission.WRITE: "写作",
-            Permission.MODERATE: "管理",
-            Permission.ADMINISTER: "超级管理"
-        }.get(permission, "未知权限")
-        
-        print(f"用户 {self.name}:")
-        print(f"- 当前角色: {self.role.name}")
-        print(f"- 检查权限: {permission_name}")
-        print(f"- 是否拥有: {'是' if result else '否'} (权限值: {result})")
-        return result
+        '''判断用户是否有指定权限（permission 可以是多个权限按位或的组合，需要全部拥有）'''
+        return self.permissions & permission == permission
 
     def ping(self):
         '''用户登录时，自动执行此方法刷新操作时间'''
@@ -278,25 +353,85 @@ class User(db.Model, UserMixin):
         return self.followed.filter_by(follower_id=user.id).first() is not None
     
     def follow(self, user):
-        '''关注指定用户'''
-        if not self.is_following(user):
-            follow = Follow(follower_id=self.id, followed_id=user.id)
-            db.session.add(follow)
-            db.session.commit()
+        '''关注指定用户，返回关注状态是否有变化（已经关注过时返回 False）'''
+        return bool(self.follow_many([user]))
 
     def unfollow(self, user):
-        '''取消关注指定用户'''
-        follow = self.followed.filter_by(followed_id=user.id).first()
-        if follow:
-            db.session.delete(follow)
-            db.session.commit()
+        '''取消关注指定用户，返回关注状态是否有变化（本来就没有关注时返回 False）'''
+        return bool(self.unfollow_many([user]))
 
-    @property
-    def followed_posts(self):
-        '''获取当前用户关注的人的博客'''
-        return Blog.query.join(Follow, Follow.followed_id==Blog.author_id).filter(Follow.follower_id==self.id)
-        # 使用 join 连接 Follow 和 Blog 表，只需一次数据库查询
+    def follow_many(self, users):
+        '''在一个事务中批量关注，users 为用户或用户 id，返回实际新关注的用户 id 集合
+
+        「是否已关注」和插入由一条 INSERT ... ON CONFLICT DO NOTHING 完成，重复调用是安全的
+        '''
+        ids = {getattr(user, 'id', user) for user in users}
+        if not ids:
+            return set()
+        # MySQL 的 DATETIME 不保存微秒，去掉微秒后 insert_ignore 才能按写入的值认出本次插入的行
+        now = datetime.now().replace(microsecond=0)
+        rows = [{'follower_id': self.id, 'followed_id': id, 'time_stamp': now} for id in ids]
+        changed = insert_ignore(Follow.__table__, rows, Follow.__table__.c.followed_id)
+        self._after_follow_change(changed, 1)
+        # 把新关注的人最近的博客补进自己的时间线
+        Timeline.add_authors(self, changed)
+        db.session.commit()
+        return changed
+
+    def unfollow_many(self, users):
+        '''在一个事务中批量取消关注，返回实际取消关注的用户 id 集合'''
+        ids = {getattr(user, 'id', user) for user in users}
+        if not ids:
+            return set()
+        table = Follow.__table__
+        stmt = table.delete().where(table.c.follower_id == self.id, table.c.followed_id.in_(ids))
+        if db.session.get_bind().dialect.delete_returning:
+            changed = set(db.session.execute(stmt.returning(table.c.followed_id)).scalars())
+        else:
+            # 不支持 DELETE ... RETURNING 的数据库（MySQL），先锁定要删除的行
+            changed = set(db.session.execute(
+                db.select(table.c.followed_id)
+                .where(table.c.follower_id == self.id, table.c.followed_id.in_(ids))
+                .with_for_update()).scalars())
+            if changed:
+                db.session.execute(stmt)
+        self._after_follow_change(changed, -1)
+        Timeline.remove_authors(self, changed)
+        db.session.commit()
+        return changed
+
+    def _after_follow_change(self, changed, delta):
+        '''关注关系用 Core 语句修改，不经过 update_user_counts，这里自己更新计数'''
+        if changed:
+            deltas = {id: {'followers_count': delta} for id in changed}
+            deltas.setdefault(self.id, {})['followed_count'] = delta * len(changed)
+            update_counts(db.session.connection(), User.__table__, deltas)
+
+
+    def followed_posts(self, limit, before=None):
+        '''获取当前用户关注的人的博客，按发表时间倒序取 limit 篇
+
+        before 为翻页游标 (time_stamp, id)，只取排在它后面的博客。
+        读的是写扩散时间线，粉丝很多的作者在读取时合并，见 weblog/timeline.py
+        '''
+        from .timeline import home_timeline
+        return home_timeline(self, limit, before)
     
+class AnonymousUser(AnonymousUserMixin):
+    '''未登录的访客，没有任何权限，模板和权限检查装饰器不用先判断是否登录'''
+    permissions = 0
+
+    def has_permission(self, permission):
+        return False
+
+    @property
+    def is_administrator(self):
+        return False
+
+    @property
+    def is_moderator(self):
+        return False
+
 class Permission:
     '''权限类'''
     FOLLOW = 1 # 关注
@@ -309,17 +444,84 @@ class Tag(db.Model):
     '''标签类'''
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
+    # 使用此标签的博客数，博客的标签变化时在同一事务中加减，见 update_tag_counts
+    # 标签云按它排序；数据不一致时执行 flask sweep-tags 重新统计
+    blog_count = db.Column(db.Integer, default=0, server_default='0', nullable=False, index=True)
+    # blog_count 变为 0 的时间（UTC），使用中的标签为 NULL；新建的标签在关联博客之前也算未使用。
+    # 未使用超过 TAG_CACHE_TIMEOUT 秒的标签才能删除，见 remove_unused 和 weblog/tagcache.py
+    unused_since = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
         return '<Tag: {}>'.format(self.name)  # 返回标签的名称
     
     @classmethod
-    def remove_unused(cls):
-        '''删除未使用的标签'''
-        unused = cls.query.filter(~cls.blogs.any()).all()
-        for tag in unused:
-            db.session.delete(tag)
-        db.session.commit()
+    def remove_unused(cls, ids=None):
+        '''删除未使用（blog_count 为 0）超过 TAG_CACHE_TIMEOUT 秒的标签，返回删除的标签名
+
+        ids 为要检查的标签 id，缺省检查全部标签；不加载 ORM 对象，用一条 DELETE 删除。
+        其他进程的标签缓存只保存读取时正在使用的标签，并且从读取时起最多保留 TAG_CACHE_TIMEOUT 秒，
+        所以删除的标签不会再从缓存中被取出
+        '''
+        table = cls.__table__
+        deadline = datetime.utcnow() - timedelta(seconds=tag_ids.timeout)
+        condition = db.and_(table.c.blog_count <= 0, table.c.unused_since < deadline)
+        if ids is not None:
+            condition = db.and_(condition, table.c.id.in_(ids))
+        # 先锁定要删除的行，期间其他事务不能再给这些标签加博客
+        rows = db.session.execute(db.select(table.c.id, table.c.name).where(condition)
+                                  .with_for_update()).all()
+        if rows:
+            db.session.execute(table.delete().where(table.c.id.in_([id for id, _ in rows]), condition))
+            # 提交后从标签缓存中去掉，见 _publish_tag_ids
+            db.session.info.setdefault('deleted_tags', []).extend(name for _, name in rows)
+        return [name for _, name in rows]
+
+    @classmethod
+    def resolve(cls, names):
+        '''把标签名列表解析为 Tag 对象列表，去掉空白和重复的名字，保持原来的顺序
+
+        - 进程内缓存（weblog/tagcache.py）命中的标签直接按 id 得到对象，不查数据库
+        - 其余的标签名用一条 WHERE name IN (...) 查询
+        - 仍然不存在的标签用一条 INSERT ... ON CONFLICT DO NOTHING 批量创建，
+          两个请求同时创建同一个新标签时不会违反 name 的唯一约束
+
+        只有查询时正在使用（unused_since 为 NULL）的标签才写入缓存，缓存的有效期从查询时算起，
+        这样缓存中的 id 在过期之前不会被 remove_unused 删除
+        '''
+        names = list(dict.fromkeys(name.strip() for name in names if name and name.strip()))
+        if not names:
+            return []
+        ids = tag_ids.get_many(names)
+        table = cls.__table__
+        read_at = time.monotonic()
+        in_use = {}
+        # 在 blog.tags_string 的 setter 中调用时，博客可能还没有写入数据库，不要提前 flush
+        with db.session.no_autoflush:
+            missing = [name for name in names if name not in ids]
+            if missing:
+                for name, id, unused_since in db.session.execute(
+                        db.select(table.c.name, table.c.id, table.c.unused_since)
+                        .where(table.c.name.in_(missing))):
+                    ids[name] = id
+                    if unused_since is None:
+                        in_use[name] = id
+            missing = [name for name in names if name not in ids]
+            if missing:
+                insert_ignore(table, [{'name': name} for name in missing], table.c.name)
+                # 被其他请求抢先插入的标签也一起查出来
+                ids.update(db.session.execute(
+                    db.select(table.c.name, table.c.id).where(table.c.name.in_(missing))).all())
+        # 提交后再写入缓存，见 _publish_tag_ids
+        if in_use:
+            db.session.info.setdefault('resolved_tags', []).append((read_at, in_use))
+        return [cls._from_id(ids[name], name) for name in names]
+
+    @classmethod
+    def _from_id(cls, id, name):
+        '''由已知的 id 和名字得到 session 中的 Tag 对象，不发 SELECT'''
+        tag = cls(id=id, name=name)
+        make_transient_to_detached(tag)
+        return db.session.merge(tag, load=False)
 
 
 class Blog(db.Model):
@@ -328,6 +530,8 @@ class Blog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
+    body_html_version = db.Column(db.Integer)  # 生成 body_html 的渲染器版本，见 weblog/rendering.py
+    version = db.Column(db.Integer, default=1)  # 卡片内容（正文、标题、标签等）每次修改加一，用于片段缓存，见 weblog/cache.py
     title = db.Column(db.String(64))
     time_stamp = db.Column(db.DateTime, index=True, default=datetime.now)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))  # 当用户被删除时，删除该用户发表的博客
@@ -355,19 +559,22 @@ class Blog(db.Model):
     def tags_string(self, value):
         """从字符串设置标签"""
         if value:  # 如果有输入标签
-            self.tags = []  # 清除现有标签
             # 将字符串分割成列表：'Python, Flask' -> ['Python', 'Flask']
-            tag_names = [name.strip() for name in value.split(',')]
-            
-            # 处理每个标签名
-            for tag_name in tag_names:
-                if tag_name:  # 忽略空标签
-                    # 查找或创建标签
-                    tag = Tag.query.filter_by(name=tag_name).first()
-                    if tag is None:
-                        tag = Tag(name=tag_name)
-                    # 添加到博客的标签列表
-                    self.tags.append(tag)
+            # 所有标签一次解析（查找或创建），重复和空的标签名会被忽略
+            self.tags = Tag.resolve(value.split(','))
+
+    @property
+    def html(self):
+        '''模板中使用的正文 HTML
+
+        如果 body_html 是旧版本渲染器生成的（渲染配置改过），在这里重新渲染（有缓存），
+        只更新内存中的值，不会把对象标记为已修改，GET 请求不会因此多出 UPDATE；
+        数据库中的旧值会在下次保存正文时，或由 flask render-blogs 命令批量刷新
+        '''
+        if self.body and renderer.is_stale(self.body_html_version):
+            set_committed_value(self, 'body_html', renderer.render(self.body))
+            set_committed_value(self, 'body_html_version', renderer.version)
+        return self.body_html
 
     # 该方法为静态方法，可以写在类外部，Blog().body 有变化时自动运行
     # target 为 Blog 类的实例，value 为实例的 body 属性值
@@ -382,55 +589,204 @@ class Blog(db.Model):
         - value: 实例的 body 属性的新值（Markdown 文本）
         - old_value: 数据库中原有的 body_html 值
         - initiator: 事件对象（此处未使用）
+
+        渲染由 weblog.rendering.renderer 完成，相同的正文直接使用缓存结果
         '''
-        # 定义允许的 HTML 标签列表
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                       'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                       'h1', 'h2', 'h3', 'p', 'img', 'div', 'span',
-                       'table', 'tr', 'td', 'th', 'tbody', 'thead']
-        
-        # 创建 CSS 清理器，定义允许的 CSS 属性
-        css_sanitizer = CSSSanitizer(
-            allowed_css_properties=['color', 'text-align']
-        )
-
-        # 处理流程：Markdown → HTML → 清洗 HTML → 处理链接 → 存储
-        html = markdown(value, 
-                       extensions=['fenced_code',  # 支持 ``` 代码块语法
-                                 'tables',         # 支持表格
-                                 'nl2br'],         # 支持换行
-                       extension_configs={
-                           'markdown.extensions.fenced_code': {
-                               'lang_prefix': 'language-'  # 保留语言标识前缀,便于 highlight.js 识别
-                           }
-                       },
-                       output_format='html5')
-        
-        print("Markdown 转换后的 HTML:", html)  # 添加这行来查看中间结果
-
-        allowed_tags.extend(['pre', 'code', 'span', 'div'])
-
-
-        cleaned = bleach.clean(
-            html,
-            tags=allowed_tags + ['pre', 'code', 'span'],
-            attributes={
-                '*': ['class', 'id', 'style', 'data-lang'],
-                'a': ['href', 'rel', 'target'],
-                'img': ['src', 'alt'],
-                'pre': ['class', 'data-lang'],  # 添加 data-lang 属性支持
-                'code': ['class', 'data-lang', 'language-*','javascript', 'python', 'html', 'css'],
-                'div': ['style', 'class']
-            },
-            css_sanitizer=css_sanitizer  # 使用 CSS 清理器
-        )
-        
-        # 处理链接并存储
-        target.body_html = bleach.linkify(cleaned)
+        target.body_html = renderer.render(value)
+        # 记录渲染器版本，渲染配置变化后可以据此判断是否需要重新渲染
+        target.body_html_version = renderer.version
 
 # 设置 SQLAlchemy 事件监听器
 event.listen(Blog.body, 'set', Blog.on_changed_body)
 
+
+# 这些属性出现在博客卡片上，修改后需要让卡片的片段缓存失效
+BLOG_CARD_ATTRS = ('title', 'body', 'time_stamp', 'author_id', 'author', 'tags')
+
+@event.listens_for(Session, 'before_flush')
+def bump_blog_version(session, flush_context, instances):
+    '''写入数据库前，卡片内容有变化的博客版本号加一'''
+    for obj in session.dirty:
+        if isinstance(obj, Blog):
+            state = inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in BLOG_CARD_ATTRS):
+                obj.version = (obj.version or 0) + 1
+
+@event.listens_for(Session, 'after_flush')
+def bump_author_blog_versions(session, flush_context):
+    '''卡片上还显示作者的用户名：用户改名后，他的所有博客版本号加一（一条 UPDATE）'''
+    ids = [obj.id for obj in session.dirty
+           if isinstance(obj, User) and inspect(obj).attrs.name.history.has_changes()]
+    if ids:
+        table = Blog.__table__
+        session.connection().execute(table.update().where(table.c.author_id.in_(ids))
+                                     .values(version=db.func.coalesce(table.c.version, 0) + 1))
+
+@event.listens_for(Session, 'after_flush')
+def update_user_counts(session, flush_context):
+    '''新增或删除了关注关系、博客时，在同一事务中更新相关用户的计数'''
+    deltas = defaultdict(Counter)
+    for objects, delta in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if isinstance(obj, Follow):
+                deltas[obj.followed_id]['followers_count'] += delta
+                deltas[obj.follower_id]['followed_count'] += delta
+            elif isinstance(obj, Blog):
+                deltas[obj.author_id]['blogs_count'] += delta
+    deltas.pop(None, None)
+    if deltas:
+        update_counts(session.connection(), User.__table__, deltas)
+
+@event.listens_for(Session, 'before_flush')
+def _collect_tag_changes(session, flush_context, instances):
+    '''写入数据库前，按博客标签集合的变化记下每个标签的增量（新标签此时还没有 id，先记对象）'''
+    deltas = session.info.setdefault('tag_deltas', Counter())
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Blog):
+                history = inspect(obj).attrs.tags.history
+                deltas.update(history.added)
+                deltas.subtract(history.deleted)
+        for obj in session.deleted:
+            if isinstance(obj, Blog):
+                deltas.subtract(obj.tags)
+
+
+@event.listens_for(Session, 'after_flush')
+def update_tag_counts(session, flush_context):
+    '''更新标签的 blog_count
+
+    计数变为 0 的标签不在这里删除：其他进程的标签缓存（weblog/tagcache.py）中可能还有它的 id，
+    删除后别的请求会把博客关联到不存在的标签上。未使用的标签由 flask sweep-tags 定期删除
+    '''
+    deltas = session.info.pop('tag_deltas', None)
+    if not deltas:
+        return
+    deltas = {tag.id: delta for tag, delta in deltas.items() if delta and tag.id is not None}
+    if not deltas:
+        return
+    table = Tag.__table__
+    connection = session.connection()
+    update_counts(connection, table, {id: {'blog_count': delta} for id, delta in deltas.items()})
+    # 计数变为 0 时记下时间，重新被使用时清空，remove_unused 据此判断能否删除
+    connection.execute(table.update().where(table.c.id.in_(deltas)).values(
+        unused_since=db.case((table.c.blog_count > 0, db.null()),
+                             else_=db.func.coalesce(table.c.unused_since, datetime.utcnow()))))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_deleted_tags(session, flush_context):
+    '''记下本次事务中删除的标签，提交后从标签缓存中去掉'''
+    names = [obj.name for obj in session.deleted if isinstance(obj, Tag)]
+    if names:
+        session.info.setdefault('deleted_tags', []).extend(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_tag_ids(session):
+    '''事务提交后，解析过的标签 id 才确实存在，这时写入缓存'''
+    resolved = session.info.pop('resolved_tags', None)
+    deleted = session.info.pop('deleted_tags', None)
+    for read_at, mapping in resolved or ():
+        tag_ids.set_many({name: id for name, id in mapping.items() if name not in (deleted or ())}, read_at)
+    if deleted:
+        tag_ids.forget(deleted)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_tag_ids(session):
+    session.info.pop('resolved_tags', None)
+    session.info.pop('deleted_tags', None)
+    session.info.pop('tag_deltas', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_role_changes(session, flush_context):
+    '''角色有增删改时做个标记，提交后清空角色权限缓存'''
+    if any(isinstance(obj, Role) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info['roles_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _clear_role_permissions(session):
+    if session.info.pop('roles_changed', False):
+        role_permissions.clear()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_role_changes(session):
+    session.info.pop('roles_changed', None)
+
+class Timeline(db.Model):
+    '''首页时间线（写扩散）
+
+    用户发表博客时，把博客写进每个粉丝的时间线，读取「我关注的人的博客」时只查自己的时间线，
+    不用每次都把 follows 和 blog 两张表 JOIN 起来再排序。
+    粉丝数超过 TIMELINE_FANOUT_LIMIT 的作者不写扩散，读取时再合并，见 weblog/timeline.py
+    '''
+    __tablename__ = 'timeline'
+    __table_args__ = (db.Index('ix_timeline_user_time', 'user_id', 'time_stamp'),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)  # 时间线的主人
+    blog_id = db.Column(db.Integer, db.ForeignKey('blog.id', ondelete='CASCADE'), primary_key=True)
+    author_id = db.Column(db.Integer)  # 冗余保存作者，取消关注时按作者删除
+    time_stamp = db.Column(db.DateTime)  # 冗余保存博客的发表时间，按它排序
+
+    @staticmethod
+    def fan_out(blog):
+        '''把新发表的博客写进作者所有粉丝的时间线，只执行一条 INSERT ... SELECT
+
+        blog 需要已经 flush 过（有 id），粉丝太多的作者不写扩散，返回是否执行了写扩散
+        '''
+        if blog.author.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            return False
+        rows = db.select(Follow.follower_id, db.literal(blog.id), db.literal(blog.author_id),
+                         db.literal(blog.time_stamp)).where(Follow.followed_id == blog.author_id)
+        db.session.execute(db.insert(Timeline).from_select(
+            ['user_id', 'blog_id', 'author_id', 'time_stamp'], rows))
+        return True
+
+    @staticmethod
+    def add_authors(follower, author_ids):
+        '''关注一些人后，把每个人最近的 TIMELINE_BACKFILL 篇博客补进时间线，只执行一条 INSERT ... SELECT'''
+        if not author_ids:
+            return
+        # 按作者分组编号，每个作者只取最近的若干篇
+        ranked = db.select(
+            Blog.id, Blog.author_id, Blog.time_stamp,
+            db.func.row_number().over(partition_by=Blog.author_id,
+                                      order_by=Blog.time_stamp.desc()).label('n')
+        ).where(Blog.author_id.in_(author_ids)).subquery()
+        rows = (db.select(db.literal(follower.id), ranked.c.id, ranked.c.author_id, ranked.c.time_stamp)
+                .where(ranked.c.n <= current_app.config['TIMELINE_BACKFILL']))
+        # 数据修复等情况下可能已经有这些记录，先删再插，保证主键不冲突
+        Timeline.remove_authors(follower, author_ids)
+        db.session.execute(db.insert(Timeline).from_select(
+            ['user_id', 'blog_id', 'author_id', 'time_stamp'], rows))
+
+    @staticmethod
+    def remove_authors(follower, author_ids):
+        '''取消关注一些人后，从时间线中删除他们的博客'''
+        if author_ids:
+            db.session.execute(db.delete(Timeline).where(Timeline.user_id == follower.id,
+                                                         Timeline.author_id.in_(author_ids)))
+
+    @staticmethod
+    def remove_blog(blog):
+        '''删除博客前，从所有时间线中删除它'''
+        db.session.execute(db.delete(Timeline).where(Timeline.blog_id == blog.id))
+
+    @staticmethod
+    def rebuild():
+        '''按 follows 表重建全部时间线，用于上线时初始化或数据修复'''
+        db.session.execute(db.delete(Timeline))
+        rows = (db.select(Follow.follower_id, Blog.id, Blog.author_id, Blog.time_stamp)
+                .join(Blog, Blog.author_id == Follow.followed_id))
+        db.session.execute(db.insert(Timeline).from_select(
+            ['user_id', 'blog_id', 'author_id', 'time_stamp'], rows))
+        db.session.commit()
+
+
 class Comment(db.Model):
     '''评论类'''
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,146 @@
+'''
+游标（keyset）分页
+
+Query.paginate(page=...) 每次都要执行 OFFSET 查询，再对整张表 COUNT(*)，越往后翻越慢。
+游标分页按 (time_stamp, id) 排序，记住上一页最后一条的键值，
+下一页直接用 WHERE (time_stamp, id) < (上一页最后一条) 取数据，能用上索引，翻到多深都一样快。
+总数只在模板需要时才统计，并在进程内缓存 PAGINATION_COUNT_TTL 秒。
+
+游标分页是可选的：配置 CURSOR_PAGINATION = True，或者请求带有 ?after= / ?before= 参数时启用，
+否则仍然使用原来的页码分页。
+'''
+
+import base64
+import json
+import time
+import threading
+from datetime import datetime
+
+from flask import current_app, request
+from sqlalchemy import and_, or_
+
+
+_count_cache = {}   # 缓存的键 -> (过期时间, 总数)
+_count_lock = threading.Lock()
+
+
+def encode_cursor(time_stamp, id):
+    '''把 (time_stamp, id) 编码为 URL 中使用的不透明字符串'''
+    raw = json.dumps([time_stamp.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    '''解码游标字符串，无效的游标返回 None（当作第一页处理）'''
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        time_stamp, id = json.loads(raw)
+        return datetime.fromisoformat(time_stamp), int(id)
+    except (ValueError, TypeError):
+        return None
+
+
+def approximate_count(query, key):
+    '''带缓存的总数统计，同一个 key 在 PAGINATION_COUNT_TTL 秒内只统计一次'''
+    now = time.monotonic()
+    with _count_lock:
+        cached = _count_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    total = query.order_by(None).count()
+    with _count_lock:
+        _count_cache[key] = (now + current_app.config['PAGINATION_COUNT_TTL'], total)
+    return total
+
+
+class CursorPagination:
+    '''游标分页的结果，属性名与 Flask-SQLAlchemy 的 Pagination 对象尽量一致'''
+
+    def __init__(self, query, items, per_page, has_next, has_prev,
+                 next_cursor, prev_cursor, count_key, total=None):
+        self.query = query
+        self.items = items
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.count_key = count_key
+        self._total = total
+
+    @property
+    def total(self):
+        '''近似总数，只有在模板用到时才统计；调用方已知总数时直接使用'''
+        if self._total is not None:
+            return self._total
+        return approximate_count(self.query, self.count_key)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def cursor_paginate(query, order_by, per_page, after=None, before=None, count_key=None, total=None):
+    '''按 order_by = (时间列, id 列) 倒序做游标分页
+
+    after 为下一页的游标（取比它更早的数据），before 为上一页的游标（取比它更新的数据）
+    '''
+    time_col, id_col = order_by
+    query = query.order_by(None)
+    cursor = decode_cursor(before) if before else None
+
+    if cursor is not None:
+        # 向前翻页：按正序取游标之后的 per_page 条，再倒过来
+        t, i = cursor
+        rows = (query.filter(or_(time_col > t, and_(time_col == t, id_col > i)))
+                .order_by(time_col.asc(), id_col.asc())
+                .limit(per_page + 1).all())
+        has_prev = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        has_next = True
+    else:
+        cursor = decode_cursor(after) if after else None
+        q = query
+        if cursor is not None:
+            t, i = cursor
+            q = q.filter(or_(time_col < t, and_(time_col == t, id_col < i)))
+        # 多取一条，用来判断是否还有下一页，不需要 COUNT(*)
+        rows = q.order_by(time_col.desc(), id_col.desc()).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = cursor is not None
+
+    def key_of(item):
+        return encode_cursor(getattr(item, time_col.key), getattr(item, id_col.key))
+
+    return CursorPagination(
+        query, items, per_page,
+        has_next=has_next and bool(items),
+        has_prev=has_prev and bool(items),
+        next_cursor=key_of(items[-1]) if has_next and items else None,
+        prev_cursor=key_of(items[0]) if has_prev and items else None,
+        count_key=count_key,
+        total=total)
+
+
+def paginate(query, order_by, per_page, count_key, total=None):
+    '''列表页统一使用的分页入口
+
+    启用游标分页时返回 CursorPagination，否则返回 query.paginate() 的结果；
+    页码分页也按 order_by 倒序排列，两种模式的顺序一致。
+    total 为调用方已知的总数（例如 User.followers_count），传入后不再执行 COUNT(*)
+    '''
+    after = request.args.get('after')
+    before = request.args.get('before')
+    if current_app.config['CURSOR_PAGINATION'] or after or before:
+        return cursor_paginate(query, order_by, per_page,
+                               after=after, before=before, count_key=count_key, total=total)
+    time_col, id_col = order_by
+    pagination = query.order_by(None).order_by(time_col.desc(), id_col.desc()).paginate(
+        page=request.args.get('page', 1, type=int),
+        per_page=per_page,
+        error_out=False,
+        count=total is None
+    )
+    if total is not None:
+        pagination.total = total
+    return pagination
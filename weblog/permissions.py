@@ -0,0 +1,44 @@
+'''
+角色 id -> 权限位掩码 的进程内缓存
+
+模板里每张博客卡片、每条评论都要判断 current_user.is_administrator / is_moderator，
+角色又几乎不变，所以每个角色的权限位掩码第一次用到时记下来（取自已经加载的 Role 对象，
+user_loader 加载当前用户时已经把角色 JOIN 进来了），之后的权限判断只是一次字典查找和位运算。
+本进程修改角色后在事务提交时清空（见 models 中的 _collect_role_changes），
+其他进程修改的角色最多 ROLE_CACHE_TIMEOUT 秒后生效。
+'''
+
+import time
+import threading
+
+
+class RolePermissionCache:
+    '''{角色 id: 权限位掩码} 缓存，用法与 Flask 扩展相同：role_permissions.init_app(app)'''
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+        self._data = {}  # 角色 id -> (过期时间, 权限位掩码)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('ROLE_CACHE_TIMEOUT', 300)
+        self.timeout = app.config['ROLE_CACHE_TIMEOUT']
+        app.extensions['role_permissions'] = self
+
+    def get(self, role_id):
+        '''返回权限位掩码，没有缓存或已过期时返回 None'''
+        entry = self._data.get(role_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, role_id, permissions):
+        with self._lock:
+            self._data[role_id] = (time.monotonic() + self.timeout, permissions)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+role_permissions = RolePermissionCache()
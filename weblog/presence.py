@@ -0,0 +1,133 @@
+'''
+用户在线状态（last_seen）的批量延迟写入
+
+原先每个已登录用户的请求都会调用 User.ping()，为了更新 last_seen 单独提交一次事务。
+这里改为：请求中只把 (user_id, 时间) 记到内存缓冲区，
+同一用户在 PRESENCE_THROTTLE_SECONDS 秒内的重复记录直接忽略，
+缓冲区由后台线程定时（PRESENCE_FLUSH_INTERVAL 秒）或攒够 PRESENCE_FLUSH_SIZE 条时，
+用一条批量 UPDATE 语句写入数据库；进程退出时再写一次，保证不丢数据。
+'''
+
+import atexit
+import time
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+from .models import db, User
+
+
+class Presence:
+    '''last_seen 写缓冲区，用法与 Flask 扩展相同：presence.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pending = {}      # user_id -> 最近一次访问时间，等待写入数据库
+        self._touched = {}      # user_id -> 上次被接受的时间（time.monotonic），用于节流
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PRESENCE_WRITE_BEHIND', True)
+        app.config.setdefault('PRESENCE_THROTTLE_SECONDS', 60)
+        app.config.setdefault('PRESENCE_FLUSH_INTERVAL', 10)
+        app.config.setdefault('PRESENCE_FLUSH_SIZE', 500)
+        self.app = app
+        app.extensions['presence'] = self
+        # 进程正常退出时把缓冲区里剩余的记录写入数据库
+        atexit.register(self.stop)
+
+    def touch(self, user):
+        '''记录用户的一次访问，返回值表示本次记录是否被接受（未被节流）'''
+        config = self.app.config
+        if not config['PRESENCE_WRITE_BEHIND']:
+            # 关闭延迟写入时，保持原来的行为：每次请求同步提交
+            user.ping()
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            last = self._touched.get(user.id)
+            if last is not None and now - last < config['PRESENCE_THROTTLE_SECONDS']:
+                return False
+            self._touched[user.id] = now
+            self._pending[user.id] = datetime.utcnow()
+            full = len(self._pending) >= config['PRESENCE_FLUSH_SIZE']
+
+        self._ensure_worker()
+        if full:
+            # 攒够一批，唤醒后台线程立即写入
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        '''把缓冲区中的记录用一条批量 UPDATE 写入数据库，返回写入的条数'''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._prune(time.monotonic())
+        if not pending:
+            return 0
+
+        rows = [{'_id': user_id, '_last_seen': seen} for user_id, seen in pending.items()]
+        table = User.__table__
+        stmt = (table.update()
+                .where(table.c.id == bindparam('_id'))
+                .values(last_seen=bindparam('_last_seen')))
+        # 不使用 db.session，避免与请求中的会话互相影响；executemany 只提交一次事务
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(stmt, rows)
+        except Exception:
+            # 写入失败时放回缓冲区，等下一次再写；期间若有更新的记录则以新的为准
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self._pending.setdefault(user_id, seen)
+            raise
+        return len(rows)
+
+    def stop(self):
+        '''停止后台线程，并写入剩余的记录'''
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self.app is not None:
+            self.flush()
+
+    def _prune(self, now):
+        '''清理已经过了节流期的记录，防止 _touched 无限增长（调用时需持有锁）'''
+        throttle = self.app.config['PRESENCE_THROTTLE_SECONDS']
+        expired = [uid for uid, last in self._touched.items() if now - last >= throttle]
+        for uid in expired:
+            del self._touched[uid]
+
+    def _ensure_worker(self):
+        '''第一次有记录时才启动后台线程，命令行工具和迁移脚本不会多出线程'''
+        if self._thread is not None or self._stopped.is_set():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='presence-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        interval = self.app.config['PRESENCE_FLUSH_INTERVAL']
+        while not self._stopped.is_set():
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('写入 last_seen 失败')
+
+
+presence = Presence()
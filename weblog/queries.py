@@ -0,0 +1,34 @@
+'''
+列表页共用的查询
+
+模板 _blogs.html、blog_list.html、tag.html 会访问每篇博客的 blog.author 和 blog.tags，
+_comments.html 会访问每条评论的 comment.author。
+如果直接分页 Blog.query，每篇博客都要再各查一次作者和标签（N+1 查询）。
+这里的查询函数预先加载这些关系，一页的查询次数与每页条数无关：
+    - 作者是多对一关系，用 joinedload 在同一条 SELECT 中 JOIN 进来
+    - 标签是多对多关系，用 selectinload 再发一条 WHERE blog_id IN (...) 查询
+'''
+
+from sqlalchemy.orm import joinedload, selectinload
+
+from .models import Blog, Comment
+
+
+def feed_query(query=None):
+    '''博客列表查询，按发表时间倒序，预加载作者和标签
+
+    query 为基础查询，例如 tag.blogs、user.blogs，缺省为全部博客
+    '''
+    if query is None:
+        query = Blog.query
+    return query.options(
+        joinedload(Blog.author),
+        selectinload(Blog.tags)
+    ).order_by(Blog.time_stamp.desc())
+
+
+def comment_query(blog):
+    '''博客的评论查询，按发表时间倒序，预加载评论者'''
+    return blog.comments.options(
+        joinedload(Comment.author)
+    ).order_by(Comment.time_stamp.desc())
@@ -0,0 +1,189 @@
+'''
+慢查询和 N+1 查询检查
+
+- 重复查询：同一个请求中，同一条语句（参数不同，IN (...) 中的参数个数不同也算同一条）
+  执行超过 QUERY_REPEAT_THRESHOLD 次时，记一条警告日志：视图、语句、执行次数，
+  以及第一次超过阈值时的调用位置（只保留本应用的代码和模板，例如
+  templates/_comments.html 中逐条评论访问 comment.author）；
+- 慢查询：单条语句超过 SLOW_QUERY_SECONDS 秒时，记一条警告日志，同样带上调用位置；
+- 查询预算：QUERY_BUDGETS = {视图: GET 请求最多执行的语句条数}，超出时记警告日志；
+  QUERY_BUDGET_STRICT = True（TestConfig 中打开）时直接抛出 QueryBudgetExceeded，
+  测试客户端会把异常抛给测试代码，页面新增的查询超出预算时测试失败（见 scripts/check_queries.py）。
+
+发现的问题按视图汇总，/_metrics 中有各视图的计数，/_metrics/queries 以 JSON 列出具体的语句和调用位置。
+'''
+
+import re
+import time
+import logging
+import threading
+import traceback
+from collections import defaultdict
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .metrics import labels
+
+
+logger = logging.getLogger(__name__)
+
+# 参数占位符：SQLite 的 ?，MySQL 的 %s，PostgreSQL 的 %(name)s，以及 :name
+PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+PLACEHOLDER_LIST = re.compile(r'\(\s*{0}(?:\s*,\s*{0})*\s*\)'.format(PLACEHOLDER))
+WHITESPACE = re.compile(r'\s+')
+
+# 调用位置最多保留的层数
+STACK_DEPTH = 8
+
+
+class QueryBudgetExceeded(Exception):
+    '''QUERY_BUDGET_STRICT = True 时，视图执行的语句条数超出 QUERY_BUDGETS 中的预算'''
+
+
+def statement_shape(statement):
+    '''去掉参数个数的差别，IN (?, ?, ?) 与 IN (?) 视为同一条语句'''
+    return PLACEHOLDER_LIST.sub('(?)', WHITESPACE.sub(' ', statement).strip())
+
+
+class QueryWatch:
+    '''慢查询和 N+1 查询检查，用法与 Flask 扩展相同：query_watch.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.threshold = 5
+        self.slow_seconds = 0.5
+        self.budgets = {}
+        self.strict = False
+        self.root = None
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_WATCH_ENABLED', True)
+        app.config.setdefault('QUERY_REPEAT_THRESHOLD', 5)
+        app.config.setdefault('SLOW_QUERY_SECONDS', 0.5)
+        app.config.setdefault('QUERY_BUDGETS', {})
+        app.config.setdefault('QUERY_BUDGET_STRICT', False)
+        self.app = app
+        self.enabled = app.config['QUERY_WATCH_ENABLED']
+        self.threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        self.slow_seconds = app.config['SLOW_QUERY_SECONDS']
+        self.budgets = dict(app.config['QUERY_BUDGETS'])
+        self.strict = app.config['QUERY_BUDGET_STRICT']
+        self.root = app.root_path
+        app.extensions['query_watch'] = self
+        if self.enabled:
+            app.after_request(self._check_request)
+
+    def reset(self):
+        with self._lock:
+            # 视图 -> {语句: {...}}
+            self.repeated = defaultdict(dict)
+            self.slow = defaultdict(dict)
+            # 视图 -> 超出预算的次数
+            self.over_budget = defaultdict(int)
+
+    def call_site(self):
+        '''当前调用栈中属于本应用的几层（视图、模型、模板），不含本模块和 SQLAlchemy 内部'''
+        frames = [frame for frame in traceback.extract_stack()
+                  if frame.filename.startswith(self.root) and frame.filename != __file__]
+        return ''.join(traceback.format_list(frames[-STACK_DEPTH:]))
+
+    def _record(self, statement, elapsed):
+        '''每条语句执行完调用一次'''
+        in_request = has_request_context()
+        if elapsed >= self.slow_seconds:
+            endpoint = (request.endpoint or 'none') if in_request else '-'
+            stack = self.call_site()
+            logger.warning('慢查询 %.3f 秒（%s）：%s\n%s', elapsed, endpoint, statement, stack)
+            with self._lock:
+                entry = self.slow[endpoint].setdefault(statement_shape(statement), {'count': 0, 'max_seconds': 0.0})
+                entry['count'] += 1
+                entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+                entry['stack'] = stack
+        if not in_request:
+            return
+        shapes = g.setdefault('query_shapes', {})
+        shape = statement_shape(statement)
+        entry = shapes.get(shape)
+        if entry is None:
+            shapes[shape] = entry = [0, None]
+        entry[0] += 1
+        if entry[0] == self.threshold + 1:
+            # 只在刚超过阈值时取一次调用栈
+            entry[1] = self.call_site()
+
+    def _check_request(self, response):
+        shapes = g.pop('query_shapes', None) or {}
+        endpoint = request.endpoint or 'none'
+        for shape, (count, stack) in shapes.items():
+            if count <= self.threshold:
+                continue
+            logger.warning('%s 中同一条语句执行了 %d 次，可能是 N+1 查询：%s\n%s', endpoint, count, shape, stack)
+            with self._lock:
+                entry = self.repeated[endpoint].setdefault(shape, {'requests': 0, 'max_count': 0})
+                entry['requests'] += 1
+                entry['max_count'] = max(entry['max_count'], count)
+                entry['stack'] = stack
+
+        # 预算是页面的，POST 同一个视图时还要写库（发表博客、时间线写扩散等），不计入
+        budget = self.budgets.get(endpoint) if request.method in ('GET', 'HEAD') else None
+        total = sum(count for count, _ in shapes.values())
+        if budget is not None and total > budget:
+            with self._lock:
+                self.over_budget[endpoint] += 1
+            message = '{} {} 执行了 {} 条语句，超出预算 {} 条'.format(request.method, request.full_path, total, budget)
+            if self.strict:
+                raise QueryBudgetExceeded(message + '：\n' + '\n'.join(
+                    '{:>4}  {}'.format(count, shape) for shape, (count, _) in shapes.items()))
+            logger.warning(message)
+        return response
+
+    def report(self):
+        '''按视图汇总的重复查询、慢查询和超出预算的次数'''
+        with self._lock:
+            endpoints = set(self.repeated) | set(self.slow) | set(self.over_budget)
+            return {endpoint: {
+                'budget': self.budgets.get(endpoint),
+                'over_budget': self.over_budget.get(endpoint, 0),
+                'repeated': [dict(entry, statement=shape) for shape, entry in self.repeated.get(endpoint, {}).items()],
+                'slow': [dict(entry, statement=shape) for shape, entry in self.slow.get(endpoint, {}).items()],
+            } for endpoint in sorted(endpoints)}
+
+    def prometheus(self):
+        '''各视图出现重复查询的请求数、慢查询数、超出预算的请求数，Prometheus 文本格式'''
+        lines = []
+        with self._lock:
+            for name, description, data in (
+                    ('weblog_repeated_query_requests_total', '出现重复查询（可能是 N+1）的请求数',
+                     {endpoint: sum(entry['requests'] for entry in shapes.values())
+                      for endpoint, shapes in self.repeated.items()}),
+                    ('weblog_slow_queries_total', '慢查询数',
+                     {endpoint: sum(entry['count'] for entry in shapes.values())
+                      for endpoint, shapes in self.slow.items()}),
+                    ('weblog_query_budget_exceeded_total', '执行的语句条数超出预算的请求数', self.over_budget)):
+                lines += ['# HELP {} {}'.format(name, description), '# TYPE {} counter'.format(name)]
+                lines += ['{}{} {}'.format(name, labels(endpoint=endpoint), count)
+                          for endpoint, count in sorted(data.items())]
+        return lines
+
+
+query_watch = QueryWatch()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if query_watch.enabled and context is not None:
+        context._query_watch_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_watch_start', None)
+    if start is not None:
+        query_watch._record(statement, time.perf_counter() - start)
@@ -0,0 +1,110 @@
+'''
+博客正文渲染：Markdown → HTML → 清洗 HTML → 处理链接
+
+Markdown 实例、bleach 的 Cleaner 和 Linker 只创建一次，反复使用；
+渲染结果按正文内容的哈希缓存（LRU），相同的正文（回滚、重复保存、虚拟数据）不会重复渲染。
+'''
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from markdown import Markdown
+from bleach.sanitizer import Cleaner
+from bleach.linkifier import Linker
+from bleach.css_sanitizer import CSSSanitizer
+
+
+# 渲染器版本号，保存在每篇博客的 body_html_version 列中
+# ！！！修改下面的标签、属性或 Markdown 扩展配置后，必须把版本号加一
+# 版本号不一致的博客在读取时会重新渲染
+RENDERER_VERSION = 1
+
+# 允许的 HTML 标签列表
+ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                'h1', 'h2', 'h3', 'p', 'img', 'div', 'span',
+                'table', 'tr', 'td', 'th', 'tbody', 'thead']
+
+# 允许的 HTML 属性
+ALLOWED_ATTRIBUTES = {
+    '*': ['class', 'id', 'style', 'data-lang'],
+    'a': ['href', 'rel', 'target'],
+    'img': ['src', 'alt'],
+    'pre': ['class', 'data-lang'],  # 添加 data-lang 属性支持
+    'code': ['class', 'data-lang', 'language-*', 'javascript', 'python', 'html', 'css'],
+    'div': ['style', 'class']
+}
+
+# 允许的 CSS 属性
+ALLOWED_CSS_PROPERTIES = ['color', 'text-align']
+
+MARKDOWN_EXTENSIONS = ['fenced_code',   # 支持 ``` 代码块语法
+                       'tables',        # 支持表格
+                       'nl2br']         # 支持换行
+
+MARKDOWN_EXTENSION_CONFIGS = {
+    'markdown.extensions.fenced_code': {
+        'lang_prefix': 'language-'  # 保留语言标识前缀,便于 highlight.js 识别
+    }
+}
+
+
+class BlogRenderer:
+    '''可复用的博客正文渲染器，带 LRU 缓存'''
+
+    def __init__(self, version=RENDERER_VERSION, cache_size=1024):
+        self.version = version
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()   # 正文哈希 -> 渲染结果，按最近使用排序
+        # Markdown、Cleaner、Linker 内部都有解析状态，不是线程安全的，渲染时需要加锁
+        self._lock = threading.Lock()
+        self._markdown = Markdown(extensions=MARKDOWN_EXTENSIONS,
+                                  extension_configs=MARKDOWN_EXTENSION_CONFIGS,
+                                  output_format='html5')
+        self._cleaner = Cleaner(tags=ALLOWED_TAGS,
+                                attributes=ALLOWED_ATTRIBUTES,
+                                css_sanitizer=CSSSanitizer(allowed_css_properties=ALLOWED_CSS_PROPERTIES))
+        self._linker = Linker()
+
+    @staticmethod
+    def cache_key(text):
+        '''缓存的键：正文内容的 SHA-1'''
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def render(self, text):
+        '''把 Markdown 文本渲染成安全的 HTML，命中缓存时直接返回'''
+        if not text:
+            return ''
+        key = self.cache_key(text)
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+            html = self._render(text)
+            self._cache[key] = html
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)  # 淘汰最久未使用的
+        return html
+
+    def _render(self, text):
+        '''实际的渲染流程：Markdown → HTML → 清洗 HTML → 处理链接'''
+        html = self._markdown.reset().convert(text)
+        return self._linker.linkify(self._cleaner.clean(html))
+
+    def is_stale(self, version):
+        '''判断以 version 版本渲染的 HTML 是否需要重新渲染'''
+        return version != self.version
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+
+renderer = BlogRenderer()
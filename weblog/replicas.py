@@ -0,0 +1,141 @@
+'''
+只读请求读从库（可选，SQLALCHEMY_REPLICAS 不为空时启用）
+
+首页、博客详情、博客列表、标签页、用户主页、关注/粉丝列表的 GET 请求只读数据库，
+这些请求中的 SELECT 交给从库执行，减轻主库的压力：
+- 只有 REPLICA_ENDPOINTS 中的视图的 GET/HEAD 请求读从库，POST 等写请求、
+  以及 GET 也会写库的视图（关注、删除评论、邮件链接等）全部使用主库；
+- INSERT/UPDATE/DELETE、flush、SELECT ... FOR UPDATE 始终在主库执行，
+  同一个事务写过数据之后，后面的查询也改回主库；
+- 读你所写：客户端自己提交过写操作后，REPLICA_STICKY_SECONDS 秒内的请求都读主库
+  （记在 Flask 会话中，登录用户和游客都有效），避免刚发表的博客、评论因为复制延迟看不到；
+- 有多个从库时，每个请求随机选一个，同一个请求中的查询都在这个从库上执行；
+- 要写进缓存的数据（整页缓存未命中时渲染的页面、标签云）读主库，见 use_primary。
+
+从库在 SQLALCHEMY_BINDS 中注册为 replica0、replica1 ……，连接池参数与主库相同，
+连接池状态同样在 /_metrics 中查看。本地可以用两个 SQLite 文件（或同一个 MySQL 上的两个库）
+分别充当主库和从库，用 flask sync-replicas 把主库复制到从库。
+'''
+
+import time
+import random
+import threading
+
+from flask import g, request, has_request_context, session as http_session
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# 会话中「读你所写」的截止时间
+STICKY_KEY = '_db_primary_until'
+
+# 默认读从库的视图
+READ_ONLY_ENDPOINTS = (
+    'front.index', 'front.blog', 'front.blogs', 'front.tag', 'front.tags',
+    'user.index', 'user.followed', 'user.followers',
+)
+
+
+class ReplicaRouter:
+    '''从库的配置和选择，用法与 Flask 扩展相同：replicas.init_app(app)，须在 db.init_app(app) 之前调用'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.binds = ()
+        self.endpoints = frozenset()
+        self.sticky_seconds = 5
+        self.reads = {}  # bind 名 -> 在从库执行的查询数
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('REPLICA_ENDPOINTS', READ_ONLY_ENDPOINTS)
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        self.app = app
+        self.endpoints = frozenset(app.config['REPLICA_ENDPOINTS'])
+        self.sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+        # 复制一份，不修改配置类上共用的字典
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.binds = tuple('replica{}'.format(i) for i in range(len(app.config['SQLALCHEMY_REPLICAS'])))
+        # Flask-SQLAlchemy 不会把 SQLALCHEMY_ENGINE_OPTIONS 用到其他 bind 上，这里为从库带上同样的连接池参数
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+        binds.update((bind, dict(options, url=url))
+                     for bind, url in zip(self.binds, app.config['SQLALCHEMY_REPLICAS']))
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self.reads = dict.fromkeys(self.binds, 0)
+        app.extensions['replicas'] = self
+
+    def choose(self):
+        '''当前请求应当读的从库的 bind 名，应当读主库时返回 None'''
+        if not self.binds or not has_request_context():
+            return None
+        if request.method not in ('GET', 'HEAD') or request.endpoint not in self.endpoints:
+            return None
+        if '_db_replica' not in g:
+            until = http_session.get(STICKY_KEY)
+            sticky = until is not None and until > time.time()
+            g._db_replica = None if sticky else random.choice(self.binds)
+        return g._db_replica
+
+    def count(self, bind):
+        with self._lock:
+            self.reads[bind] += 1
+
+    def use_primary(self):
+        '''当前请求余下的查询都读主库
+
+        填充缓存前调用：提交后缓存的代立即加一，从库却可能还没复制到这次提交，
+        从从库读到的旧数据会以新的代存进缓存，直到下次失效前一直返回旧页面
+        '''
+        if self.binds and has_request_context():
+            g._db_replica = None
+
+    def stick(self):
+        '''当前客户端刚提交了写操作，接下来 REPLICA_STICKY_SECONDS 秒内读主库'''
+        if self.binds and has_request_context():
+            http_session[STICKY_KEY] = time.time() + self.sticky_seconds
+            g._db_replica = None
+
+    def stats(self):
+        return {'replicas': list(self.binds), 'reads': dict(self.reads)}
+
+
+replicas = ReplicaRouter()
+
+
+def is_plain_select(clause):
+    # ORM 查询、关系的延迟加载、Session.get 传进来的都是 Select；FOR UPDATE 要锁主库上的行
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+
+class RoutingSession(FlaskSession):
+    '''按请求把只读查询交给从库的 Session，其他情况与 Flask-SQLAlchemy 的 Session 相同'''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and not self.info.get('wrote')
+                and is_plain_select(clause)):
+            key = replicas.choose()
+            if key is not None:
+                replicas.count(key)
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_written(session, flush_context):
+    '''事务中写过数据，之后的查询读主库；提交后当前客户端一段时间内读主库'''
+    session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _stick_to_primary(session):
+    if session.info.pop('wrote', None):
+        replicas.stick()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_written(session):
+    session.info.pop('wrote', None)
@@ -0,0 +1,520 @@
+'''
+全文搜索：博客标题、正文和评论的倒排索引
+
+分词：
+    中文（以及日文、韩文）没有空格分词，连续的 CJK 字符按二元组（bigram）切分，
+    「数据库设计」-> 数据、据库、库设、设计；只有一个字时保留单字。
+    英文、数字按单词切分并转成小写。
+    查询也用同样的方法分词；查询中的单个汉字匹配所有以它开头的二元组。
+
+排序使用 BM25，标题中的词按 SEARCH_TITLE_WEIGHT 倍计入词频。
+
+索引存放在 SEARCH_INDEX_DIR 目录中，由两部分组成：
+    - segment：由 flask rebuild-search-index 生成的只读文件，用 mmap 打开，
+      词典按词排序，查询时二分查找，不用把整个索引读入内存，多个进程共享操作系统的页缓存
+    - log：增量日志，每行一个 JSON。博客、评论的修改提交到数据库后（after_commit），
+      把新的词频追加到日志；每个进程查询前读取日志中新增的部分，应用到内存中的增量索引，
+      所以一个进程中的修改，其他进程下次查询时也能看到
+重建索引时，新的 segment 只包含重建开始前的数据，重建期间追加的日志会保留下来。
+日志只增不减，可以定期执行 flask rebuild-search-index 进行合并。
+'''
+
+import atexit
+import heapq
+import html
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+from array import array
+from collections import Counter, defaultdict
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只能依赖追加写本身的原子性
+    fcntl = None
+
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, joinedload
+
+from .models import db, Blog, Comment
+from .database import iter_chunks
+
+
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+TOKEN_RE = re.compile('([{0}]+)|([^\\W_{0}]+)'.format(_CJK))
+MAX_WORD_LENGTH = 32
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    '''把文本切分为索引词列表'''
+    terms = []
+    for cjk, word in TOKEN_RE.findall(text or ''):
+        if cjk:
+            if len(cjk) == 1:
+                terms.append(cjk)
+            else:
+                terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        elif len(word) <= MAX_WORD_LENGTH:
+            terms.append(word.lower())
+    return terms
+
+
+def document_terms(title, body, title_weight):
+    '''计算一篇文档的 (词频, 文档长度)'''
+    terms = Counter(tokenize(body))
+    for term in tokenize(title):
+        terms[term] += title_weight
+    return dict(terms), sum(terms.values())
+
+
+def strip_html(text):
+    '''去掉 HTML 标签，用于生成摘要'''
+    return html.unescape(re.sub(r'<[^>]+>', ' ', text or ''))
+
+
+# ---- 只读的 segment 文件 ----
+#
+#   头部      magic, 格式版本, 文档数, 词数, 文档总长度
+#   文档表    每篇文档：类型（b 博客 / c 评论）, id, 所属博客 id, 文档长度
+#   词典      每个词：词在词表中的偏移和长度, 倒排表偏移, 文档频率；按词的 UTF-8 字节排序
+#   词表      所有词的 UTF-8 字节
+#   倒排表    每个词对应 df 个 (文档序号, 词频)
+
+HEADER = struct.Struct('<4sIIIQ')
+DOC = struct.Struct('<cIII')
+TERM = struct.Struct('<IIII')
+POSTING = struct.Struct('<II')
+MAGIC = b'WLSI'
+FORMAT_VERSION = 1
+
+
+def write_segment(path, docs, postings):
+    '''写入 segment 文件
+
+    docs 为 [(类型, id, 博客 id, 文档长度), ...]，文档序号即列表下标；
+    postings 为 {词: [(文档序号, 词频), ...]}
+    '''
+    terms = sorted((term.encode('utf-8'), term) for term in postings)
+    term_bytes = bytearray()
+    term_table = bytearray()
+    posting_bytes = bytearray()
+    for encoded, term in terms:
+        entries = postings[term]
+        term_table += TERM.pack(len(term_bytes), len(encoded), len(posting_bytes) // POSTING.size, len(entries))
+        term_bytes += encoded
+        for doc_no, tf in entries:
+            posting_bytes += POSTING.pack(doc_no, tf)
+    total = sum(doc[3] for doc in docs)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(docs), len(terms), total))
+        for kind, id, blog_id, length in docs:
+            f.write(DOC.pack(kind.encode(), id, blog_id, length))
+        f.write(term_table)
+        f.write(term_bytes)
+        f.write(posting_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Segment:
+    '''用 mmap 打开的只读 segment 文件'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_docs, self.n_terms, self.total_len = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('不是可识别的搜索索引文件：{}'.format(path))
+        self._docs_at = HEADER.size
+        self._terms_at = self._docs_at + DOC.size * self.n_docs
+        self._words_at = self._terms_at + TERM.size * self.n_terms
+        if self.n_terms:
+            last_offset, last_len, _, _ = self._term_entry(self.n_terms - 1)
+            self._postings_at = self._words_at + last_offset + last_len
+        else:
+            self._postings_at = self._words_at
+        # 计算 BM25 时每个命中的文档都要用到长度，单独读成数组（每篇 4 字节）
+        self.lengths = array('I', (length for _, _, _, length in
+                                   DOC.iter_unpack(self._mm[self._docs_at:self._terms_at])))
+
+    def close(self):
+        self._mm.close()
+
+    def doc(self, doc_no):
+        '''返回 (类型, id, 博客 id, 文档长度)'''
+        kind, id, blog_id, length = DOC.unpack_from(self._mm, self._docs_at + DOC.size * doc_no)
+        return kind.decode(), id, blog_id, length
+
+    def keys(self):
+        '''遍历 (文档键, 文档序号, 文档长度)'''
+        for doc_no, (kind, id, _, length) in enumerate(
+                DOC.iter_unpack(self._mm[self._docs_at:self._terms_at])):
+            yield '{}:{}'.format(kind.decode(), id), doc_no, length
+
+    def _term_entry(self, i):
+        return TERM.unpack_from(self._mm, self._terms_at + TERM.size * i)
+
+    def _word(self, i):
+        offset, length, _, _ = self._term_entry(i)
+        start = self._words_at + offset
+        return self._mm[start:start + length]
+
+    def _find(self, encoded):
+        '''二分查找，返回第一个不小于 encoded 的词的下标'''
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def postings(self, term):
+        '''返回 [(文档序号, 词频), ...]'''
+        encoded = term.encode('utf-8')
+        i = self._find(encoded)
+        if i >= self.n_terms or self._word(i) != encoded:
+            return []
+        _, _, start, df = self._term_entry(i)
+        begin = self._postings_at + start * POSTING.size
+        return list(POSTING.iter_unpack(self._mm[begin:begin + df * POSTING.size]))
+
+    def prefixed(self, prefix):
+        '''以 prefix 开头的所有词'''
+        encoded = prefix.encode('utf-8')
+        i = self._find(encoded)
+        terms = []
+        while i < self.n_terms:
+            word = self._word(i)
+            if not word.startswith(encoded):
+                break
+            terms.append(word.decode('utf-8'))
+            i += 1
+        return terms
+
+
+class SearchIndex:
+    '''全文搜索索引，用法与 Flask 扩展相同：search_index.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.RLock()
+        self._segment = None
+        self._files = None          # (segment 文件标识, 日志文件标识)，变化时重新加载
+        self._log_offset = 0
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_ENABLED', True)
+        app.config.setdefault('SEARCH_INDEX_DIR', None)
+        app.config.setdefault('SEARCH_TITLE_WEIGHT', 3)
+        app.config.setdefault('SEARCH_RESULTS', 20)
+        self.app = app
+        self.directory = app.config['SEARCH_INDEX_DIR']
+        if not self.directory and app.testing:
+            # 测试时每个应用使用自己的临时索引目录，进程退出时删除
+            self.directory = tempfile.mkdtemp(prefix='weblog-search-')
+            atexit.register(shutil.rmtree, self.directory, True)
+        elif not self.directory:
+            self.directory = os.path.join(app.instance_path, 'search-index')
+        self.segment_path = os.path.join(self.directory, 'segment')
+        self.log_path = os.path.join(self.directory, 'log')
+        self.lock_path = os.path.join(self.directory, 'lock')
+        app.extensions['search_index'] = self
+
+    def _reset(self):
+        '''清空内存中的增量索引'''
+        self._base_keys = {}                    # segment 中的文档键 -> (文档序号, 文档长度)
+        self._dead = set()                      # segment 中已被修改或删除的文档序号
+        self._dead_len = 0
+        self._delta_docs = {}                   # 文档键 -> (博客 id, 文档长度, 词频)
+        self._delta_postings = defaultdict(dict)  # 词 -> {文档键: 词频}
+        self._delta_len = 0
+
+    # ---- 读取 ----
+
+    @staticmethod
+    def _file_id(path):
+        '''文件标识，文件被替换（os.replace）后会变化'''
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def refresh(self):
+        '''segment 或日志文件被替换时重新加载，否则只读取日志中新增的部分'''
+        with self._lock:
+            files = (self._file_id(self.segment_path), self._file_id(self.log_path))
+            # 旧日志删除后 inode 可能被新日志重用，日志变短也说明被替换了
+            if files[1] and os.path.getsize(self.log_path) < self._log_offset:
+                self._files = None
+            if files != self._files:
+                if self._segment is not None:
+                    self._segment.close()
+                self._segment = Segment(self.segment_path) if files[0] else None
+                self._reset()
+                if self._segment is not None:
+                    self._base_keys = {key: (doc_no, length) for key, doc_no, length in self._segment.keys()}
+                self._log_offset = 0
+                self._files = files
+            if not files[1]:
+                return
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._log_offset)
+                data = f.read()
+            # 只处理完整的行，写了一半的行留到下次
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                self._apply(json.loads(line))
+            self._log_offset += end
+
+    def _apply(self, entry):
+        key = entry['key']
+        self._remove(key)
+        if entry['op'] == 'put':
+            terms = entry['terms']
+            self._delta_docs[key] = (entry['blog_id'], entry['length'], terms)
+            self._delta_len += entry['length']
+            for term, tf in terms.items():
+                self._delta_postings[term][key] = tf
+
+    def _remove(self, key):
+        base = self._base_keys.get(key)
+        if base is not None and base[0] not in self._dead:
+            self._dead.add(base[0])
+            self._dead_len += base[1]
+        old = self._delta_docs.pop(key, None)
+        if old is not None:
+            self._delta_len -= old[1]
+            for term in old[2]:
+                postings = self._delta_postings[term]
+                postings.pop(key, None)
+                if not postings:
+                    del self._delta_postings[term]
+
+    def _expand(self, terms):
+        '''查询中的单个汉字展开为以它开头的所有二元组'''
+        expanded = []
+        for term in terms:
+            if len(term) == 1 and TOKEN_RE.match(term).group(1):
+                expanded.append(term)
+                if self._segment is not None:
+                    expanded.extend(self._segment.prefixed(term))
+                expanded.extend(t for t in self._delta_postings if t.startswith(term))
+            else:
+                expanded.append(term)
+        return list(dict.fromkeys(expanded))
+
+    def search(self, query, limit=None):
+        '''按 BM25 返回最相关的文档 [(分数, 类型, id, 博客 id), ...]'''
+        limit = limit or self.app.config['SEARCH_RESULTS']
+        self.refresh()
+        with self._lock:
+            segment = self._segment
+            n_base = segment.n_docs if segment else 0
+            n_docs = n_base - len(self._dead) + len(self._delta_docs)
+            if n_docs <= 0:
+                return []
+            total = (segment.total_len if segment else 0) - self._dead_len + self._delta_len
+            avgdl = total / n_docs or 1
+            # BM25 分母中与词频无关的部分：K1 * (1 - B + B * 文档长度 / 平均长度)
+            norm = K1 * (1 - B)
+            per_length = K1 * B / avgdl
+            lengths = segment.lengths if segment else ()
+            scores = defaultdict(float)
+            for term in self._expand(tokenize(query)):
+                matches = segment.postings(term) if segment is not None else []
+                if self._dead:
+                    matches = [(doc_no, tf) for doc_no, tf in matches if doc_no not in self._dead]
+                delta = self._delta_postings.get(term, {})
+                df = len(matches) + len(delta)
+                if not df:
+                    continue
+                weight = math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) * (K1 + 1)
+                for doc_no, tf in matches:
+                    scores[doc_no] += weight * tf / (tf + norm + per_length * lengths[doc_no])
+                for key, tf in delta.items():
+                    scores[key] += weight * tf / (tf + norm + per_length * self._delta_docs[key][1])
+            hits = []
+            for doc, score in heapq.nlargest(limit, scores.items(), key=lambda item: item[1]):
+                if isinstance(doc, int):
+                    kind, id, blog_id, _ = segment.doc(doc)
+                else:
+                    kind, id = doc.split(':')
+                    id = int(id)
+                    blog_id = self._delta_docs[doc][0]
+                hits.append((score, kind, id, blog_id))
+            return hits
+
+    def results(self, query, limit=None):
+        '''搜索并加载博客、评论，生成高亮摘要，供 /search 页面使用'''
+        hits = self.search(query, limit)
+        blog_ids = {blog_id for _, _, _, blog_id in hits}
+        comment_ids = [id for _, kind, id, _ in hits if kind == 'c']
+        blogs = ({blog.id: blog for blog in Blog.query.options(joinedload(Blog.author))
+                  .filter(Blog.id.in_(blog_ids))} if blog_ids else {})
+        comments = ({comment.id: comment for comment in Comment.query.filter(Comment.id.in_(comment_ids))}
+                    if comment_ids else {})
+        terms = self._expand(tokenize(query))
+        results = []
+        for score, kind, id, blog_id in hits:
+            blog = blogs.get(blog_id)
+            if blog is None:
+                continue  # 索引还没来得及更新的已删除博客
+            if kind == 'b':
+                text = strip_html(blog.body_html) or blog.body
+            else:
+                comment = comments.get(id)
+                if comment is None:
+                    continue
+                text = comment.body
+            results.append({'kind': kind, 'blog': blog, 'score': score,
+                            'title': highlight(blog.title or '', terms),
+                            'snippet': snippet(text, terms)})
+        return results
+
+    # ---- 写入 ----
+
+    def _append(self, entries):
+        '''把修改追加到日志，写日志和重建索引互斥'''
+        os.makedirs(self.directory, exist_ok=True)
+        data = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries).encode('utf-8')
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.log_path, 'ab') as f:
+                f.write(data)
+
+    def record(self, changes):
+        '''changes 为 {文档键: (博客 id, 标题, 正文) 或 None（删除）}'''
+        weight = self.app.config['SEARCH_TITLE_WEIGHT']
+        entries = []
+        for key, doc in changes.items():
+            if doc is None:
+                entries.append({'op': 'delete', 'key': key})
+            else:
+                blog_id, title, body = doc
+                terms, length = document_terms(title, body, weight)
+                entries.append({'op': 'put', 'key': key, 'blog_id': blog_id,
+                                'length': length, 'terms': terms})
+        if entries:
+            self._append(entries)
+
+    def rebuild(self, chunk_size=1000, progress=None):
+        '''从数据库重建 segment 文件，返回文档数'''
+        os.makedirs(self.directory, exist_ok=True)
+        # 重建开始时日志的长度，之后追加的修改保留到新日志中
+        start = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        weight = self.app.config['SEARCH_TITLE_WEIGHT']
+        docs = []
+        postings = defaultdict(list)
+
+        def add(kind, id, blog_id, title, body):
+            terms, length = document_terms(title, body, weight)
+            doc_no = len(docs)
+            docs.append((kind, id, blog_id, length))
+            for term, tf in terms.items():
+                postings[term].append((doc_no, tf))
+
+        for model, columns in ((Blog, (Blog.id, Blog.id, Blog.title, Blog.body)),
+                               (Comment, (Comment.id, Comment.blog_id, db.literal(''), Comment.body))):
+            kind = 'b' if model is Blog else 'c'
+            query = db.select(*columns)
+            if model is Comment:
+                query = query.where(db.or_(Comment.disable.is_(None), Comment.disable.is_(False)))
+            # 只读不写，配置了 SQLALCHEMY_STREAM_RESULTS 时用服务器端游标一次读完，见 weblog/database.py
+            for rows in iter_chunks(query, model.id, chunk_size):
+                for id, blog_id, title, body in rows:
+                    add(kind, id, blog_id, title, body)
+                if progress:
+                    progress(len(docs))
+
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            tail = b''
+            if os.path.exists(self.log_path):
+                with open(self.log_path, 'rb') as f:
+                    f.seek(start)
+                    tail = f.read()
+            with open(self.log_path + '.tmp', 'wb') as f:
+                f.write(tail)
+            os.replace(self.log_path + '.tmp', self.log_path)
+            write_segment(self.segment_path, docs, postings)
+        return len(docs)
+
+
+search_index = SearchIndex()
+
+
+def highlight(text, terms):
+    '''转义 text，并用 <mark> 标出查询词'''
+    if not terms:
+        return Markup.escape(text)
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                         re.IGNORECASE)
+    parts = []
+    last = 0
+    for match in pattern.finditer(text):
+        parts.append(Markup.escape(text[last:match.start()]))
+        parts.append(Markup('<mark>{}</mark>').format(match.group()))
+        last = match.end()
+    parts.append(Markup.escape(text[last:]))
+    return Markup('').join(parts)
+
+
+def snippet(text, terms, width=120):
+    '''截取第一个查询词附近的一段文本作为摘要'''
+    text = ' '.join((text or '').split())
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms]
+    positions = [p for p in positions if p >= 0]
+    start = max(min(positions) - width // 4, 0) if positions else 0
+    excerpt = text[start:start + width]
+    return Markup('{}{}{}').format('…' if start else '', highlight(excerpt, terms),
+                                   '…' if start + width < len(text) else '')
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_search_changes(session, flush_context):
+    '''记下本次事务中博客、评论的修改（此时属性都还在内存中），提交后再写入索引'''
+    changes = session.info.setdefault('search_changes', {})
+    for objects, deleted in ((session.new, False), (session.dirty, False), (session.deleted, True)):
+        for obj in objects:
+            if isinstance(obj, Blog):
+                if not deleted and obj in session.dirty and not any(
+                        inspect(obj).attrs[name].history.has_changes() for name in ('title', 'body')):
+                    continue
+                changes['b:{}'.format(obj.id)] = None if deleted else (obj.id, obj.title, obj.body)
+            elif isinstance(obj, Comment):
+                hidden = deleted or bool(obj.disable)
+                changes['c:{}'.format(obj.id)] = None if hidden else (obj.blog_id, '', obj.body)
+
+
+@event.listens_for(Session, 'after_commit')
+def _update_search_index(session):
+    changes = session.info.pop('search_changes', None)
+    if changes and search_index.app is not None and search_index.app.config['SEARCH_ENABLED']:
+        search_index.record(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_search_changes(session):
+    session.info.pop('search_changes', None)
@@ -0,0 +1,75 @@
+'''
+标签名 -> 标签 id 的进程内缓存
+
+发表、编辑博客时 Blog.tags_string 要把每个标签名解析成 Tag 对象（见 Tag.resolve），
+缓存命中的标签不用再查数据库。缓存只在事务提交后更新（回滚时插入的标签并不存在）。
+
+缓存中的 id 不再检查是否存在：如果标签已经被删除，博客会关联到不存在的标签，
+外键约束失败（MySQL 上返回 500）或者留下无效的关联，所以不能让缓存过期前标签被删除。
+标签只由 flask sweep-tags 删除（Tag.remove_unused），它在另一个进程中执行，本进程感知不到，因此：
+- 只缓存读取时正在使用（Tag.unused_since 为 NULL）的标签，有效期从读取时算起 TAG_CACHE_TIMEOUT 秒；
+- remove_unused 只删除未使用超过 TAG_CACHE_TIMEOUT 秒的标签。
+两边使用同一个 TAG_CACHE_TIMEOUT，各进程的时钟偏差要远小于它。
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TagIdCache:
+    '''LRU + 过期时间的 {标签名: 标签 id} 缓存，用法与 Flask 扩展相同：tag_ids.init_app(app)'''
+
+    def __init__(self, size=4096, timeout=300):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()  # 标签名 -> (过期时间, 标签 id)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        app.config.setdefault('TAG_CACHE_SIZE', 4096)
+        app.config.setdefault('TAG_CACHE_TIMEOUT', 300)
+        self.size = app.config['TAG_CACHE_SIZE']
+        self.timeout = app.config['TAG_CACHE_TIMEOUT']
+        app.extensions['tag_ids'] = self
+
+    def get_many(self, names):
+        '''返回 {标签名: 标签 id}，只包含命中的标签名'''
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for name in names:
+                entry = self._data.get(name)
+                if entry is None or entry[0] <= now:
+                    self._data.pop(name, None)
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(name)
+                found[name] = entry[1]
+                self.hits += 1
+        return found
+
+    def set_many(self, mapping, read_at=None):
+        '''写入 {标签名: 标签 id}，read_at 为从数据库读出它们的时间（time.monotonic()），有效期从它算起'''
+        expires = (time.monotonic() if read_at is None else read_at) + self.timeout
+        with self._lock:
+            for name, id in mapping.items():
+                self._data[name] = (expires, id)
+                self._data.move_to_end(name)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def forget(self, names):
+        '''标签被删除或改名后，让对应的记录失效'''
+        with self._lock:
+            for name in names:
+                self._data.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+tag_ids = TagIdCache()
@@ -0,0 +1,82 @@
+'''
+首页时间线：「我关注的人的博客」
+
+原来 User.followed_posts 每次都要把 follows 和 blog 两张表 JOIN 起来再排序，关注的人和博客越多越慢。
+现在改为写扩散（fan-out-on-write）：发表博客时把博客写进每个粉丝的 timeline 表（见 models.Timeline），
+读取时只按 (user_id, time_stamp) 索引取自己时间线的前几条。
+
+粉丝很多的作者（超过 TIMELINE_FANOUT_LIMIT）发一篇博客就要写很多行，这类作者不写扩散，
+读取时再按作者查出他们最近的博客，与时间线按时间合并（混合模式）。
+User.followed_posts 和 /timeline 页面都通过 home_timeline 读取。
+'''
+
+import time
+import threading
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from .models import db, User, Blog, Follow, Timeline
+from .queries import feed_query
+
+
+_hot_authors = (0, frozenset())  # (过期时间, 粉丝数超过阈值的作者 id)
+_hot_lock = threading.Lock()
+
+
+def hot_authors():
+    '''粉丝数超过 TIMELINE_FANOUT_LIMIT 的作者 id 集合，进程内缓存 TIMELINE_HOT_AUTHORS_TTL 秒'''
+    global _hot_authors
+    now = time.monotonic()
+    expires, authors = _hot_authors
+    if expires > now:
+        return authors
+    rows = db.session.execute(
+        db.select(User.id).where(User.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT'])
+    ).scalars()
+    authors = frozenset(rows)
+    with _hot_lock:
+        _hot_authors = (now + current_app.config['TIMELINE_HOT_AUTHORS_TTL'], authors)
+    return authors
+
+
+def _older(time_col, id_col, before):
+    '''排在游标 before = (time_stamp, id) 后面的行，与 pagination.cursor_paginate 的条件一致'''
+    t, i = before
+    return or_(time_col < t, and_(time_col == t, id_col < i))
+
+
+def home_timeline(user, limit, before=None):
+    '''user 关注的人的博客，按 (发表时间, id) 倒序取 limit 篇
+
+    before 为翻页游标 (time_stamp, id)，只取排在它后面的博客；返回的博客已预加载作者和标签
+    '''
+    # 写扩散部分：只走 timeline 表的 (user_id, time_stamp) 索引
+    query = db.select(Timeline.blog_id, Timeline.time_stamp).where(Timeline.user_id == user.id)
+    if before is not None:
+        query = query.where(_older(Timeline.time_stamp, Timeline.blog_id, before))
+    rows = db.session.execute(
+        query.order_by(Timeline.time_stamp.desc(), Timeline.blog_id.desc()).limit(limit)).all()
+
+    # 读扩散部分：关注的人里粉丝很多的作者，直接按作者取最近的博客
+    hot = hot_authors()
+    if hot:
+        followed_hot = db.session.execute(
+            db.select(Follow.followed_id).where(Follow.follower_id == user.id,
+                                                Follow.followed_id.in_(hot))
+        ).scalars().all()
+        if followed_hot:
+            query = db.select(Blog.id, Blog.time_stamp).where(Blog.author_id.in_(followed_hot))
+            if before is not None:
+                query = query.where(_older(Blog.time_stamp, Blog.id, before))
+            rows += db.session.execute(
+                query.order_by(Blog.time_stamp.desc(), Blog.id.desc()).limit(limit)).all()
+
+    # 作者粉丝数跨过阈值前后，同一篇博客可能两边都有，按 id 去重
+    latest = {}
+    for blog_id, time_stamp in rows:
+        latest[blog_id] = time_stamp
+    ids = sorted(latest, key=lambda id: (latest[id], id), reverse=True)[:limit]
+    if not ids:
+        return []
+    blogs = {blog.id: blog for blog in feed_query(Blog.query.filter(Blog.id.in_(ids)))}
+    return [blogs[id] for id in ids if id in blogs]
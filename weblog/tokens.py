@@ -0,0 +1,98 @@
+'''
+邮件链接中的令牌（验证邮箱、重置密码、更换邮箱）
+
+原先每次访问 User.serializer 都新建一个 TimedSerializer，loads 时也没有传 max_age，令牌永不过期，
+而且三种用途共用同一个令牌，验证邮箱的链接也能拿来重置密码。这里改为：
+- 每种用途一个 TimedSerializer，盐（salt）不同，随应用创建一次，令牌不能跨用途使用；
+- 每种用途有自己的有效期（TOKEN_*_MAX_AGE 秒），过期即失效；
+- 最近验证过的令牌记在一个小的 LRU 中（TOKEN_CACHE_SIZE 条），
+  邮件扫描器、浏览器预取反复打开同一个链接时直接返回结果，不用再验证签名；
+  已经用过的令牌（consume）同样记下来，再次点击直接拒绝，不再写数据库。
+LRU 在进程内，只是快速路径：重置密码令牌里还带着旧密码哈希的一部分，
+密码改过之后，其他进程也会拒绝它。
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+from itsdangerous import TimedSerializer, BadSignature
+
+
+# 用途 -> 有效期的配置项
+PURPOSES = {
+    'confirm': 'TOKEN_CONFIRM_MAX_AGE',
+    'reset': 'TOKEN_RESET_MAX_AGE',
+    'change-email': 'TOKEN_CHANGE_EMAIL_MAX_AGE',
+}
+
+# LRU 中已用过的令牌的标记
+CONSUMED = object()
+
+
+class TokenService:
+    '''令牌的生成和验证，用法与 Flask 扩展相同：tokens.init_app(app)'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self._serializers = {}
+        self._max_ages = {}
+        self._cache = OrderedDict()  # (用途, 令牌) -> (过期时间, 数据)
+        self._lock = threading.Lock()
+        self.size = 1024
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TOKEN_CONFIRM_MAX_AGE', 7 * 24 * 3600)
+        app.config.setdefault('TOKEN_RESET_MAX_AGE', 3600)
+        app.config.setdefault('TOKEN_CHANGE_EMAIL_MAX_AGE', 24 * 3600)
+        app.config.setdefault('TOKEN_CACHE_SIZE', 1024)
+        self.app = app
+        self.size = app.config['TOKEN_CACHE_SIZE']
+        self._serializers = {purpose: TimedSerializer(app.config['SECRET_KEY'], salt='weblog-' + purpose)
+                             for purpose in PURPOSES}
+        self._max_ages = {purpose: app.config[key] for purpose, key in PURPOSES.items()}
+        self._cache.clear()
+        app.extensions['tokens'] = self
+
+    def generate(self, purpose, **data):
+        '''生成令牌，data 为令牌中携带的数据（需要能 JSON 序列化）'''
+        return self._serializers[purpose].dumps(data)
+
+    def verify(self, purpose, token):
+        '''验证令牌，返回其中的数据；签名错误、已过期、已用过时返回 None'''
+        key = (purpose, token)
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return None if entry[1] is CONSUMED else dict(entry[1])
+        self.misses += 1
+
+        max_age = self._max_ages[purpose]
+        try:
+            data, signed_at = self._serializers[purpose].loads(token, max_age=max_age, return_timestamp=True)
+        except BadSignature:  # 过期时抛出的 SignatureExpired 也是它的子类
+            return None
+        # 缓存到令牌本身过期为止
+        self._remember(key, signed_at.timestamp() + max_age, data)
+        return dict(data)
+
+    def consume(self, purpose, token):
+        '''令牌已经用过，有效期内再次出现时直接拒绝'''
+        self._remember((purpose, token), time.time() + self._max_ages[purpose], CONSUMED)
+
+    def _remember(self, key, expires, data):
+        with self._lock:
+            self._cache[key] = (expires, data)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+
+tokens = TokenService()